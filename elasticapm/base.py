@@ -47,7 +47,7 @@ from elasticapm.conf import Config, VersionedConfig, constants
 from elasticapm.conf.constants import ERROR
 from elasticapm.metrics.base_metrics import MetricsRegistry
 from elasticapm.traces import Tracer, execution_context
-from elasticapm.utils import cgroup, cloud, compat, is_master_process, stacks, varmap
+from elasticapm.utils import RegexListMatcher, cgroup, cloud, compat, is_master_process, stacks, varmap
 from elasticapm.utils.encoding import enforce_label_format, keyword_field, shorten, transform
 from elasticapm.utils.logging import get_logger
 from elasticapm.utils.module_import import import_string
@@ -102,6 +102,8 @@ class Client(object):
         self.processors = []
         self.filter_exception_types_dict = {}
         self._service_info = None
+        # (transaction_ignore_urls, matcher), rebuilt when the config value changes
+        self._ignore_urls = (None, None)
         # setting server_version here is mainly used for testing
         self.server_version = inline.pop("server_version", None)
 
@@ -199,6 +201,8 @@ class Client(object):
             self._metrics.register("elasticapm.metrics.sets.breakdown.BreakdownMetricSet")
         if self.config.prometheus_metrics:
             self._metrics.register("elasticapm.metrics.sets.prometheus.PrometheusMetrics")
+        if self.config.adaptive_compression:
+            self._metrics.register("elasticapm.metrics.sets.transport.TransportMetricSet")
         self._thread_managers["metrics"] = self._metrics
         compat.atexit_register(self.close)
         if self.config.central_config:
@@ -243,6 +247,9 @@ class Client(object):
         )
 
         if data:
+            transaction = execution_context.get_transaction()
+            if transaction:
+                transaction.captured_errors += 1
             # queue data, and flush the queue if this is an unhandled exception
             self.queue(ERROR, data, flush=not handled)
             return data["id"]
@@ -598,11 +605,14 @@ class Client(object):
         return [seen.setdefault(path, import_string(path)) for path in processors if path not in seen]
 
     def should_ignore_url(self, url):
-        if self.config.transaction_ignore_urls:
-            for pattern in self.config.transaction_ignore_urls:
-                if pattern.match(url):
-                    return True
-        return False
+        patterns = self.config.transaction_ignore_urls
+        if not patterns:
+            return False
+        config_patterns, matcher = self._ignore_urls
+        if config_patterns is not patterns:
+            matcher = RegexListMatcher(patterns, method="match")
+            self._ignore_urls = (patterns, matcher)
+        return matcher.matches(url)
 
     def check_python_version(self):
         v = tuple(map(int, platform.python_version_tuple()[:2]))
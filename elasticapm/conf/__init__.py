@@ -560,17 +560,53 @@ class Config(_ConfigBase):
         default=30000,
     )
     breakdown_metrics = _BoolConfigValue("BREAKDOWN_METRICS", default=True)
+    transaction_duration_histograms = _BoolConfigValue("TRANSACTION_DURATION_HISTOGRAMS", default=False)
+    histogram_relative_error = _ConfigValue(
+        "HISTOGRAM_RELATIVE_ERROR", type=float, validators=[PrecisionValidator(4, 0.0001)], default=0.01
+    )
     prometheus_metrics = _BoolConfigValue("PROMETHEUS_METRICS", default=False)
     prometheus_metrics_prefix = _ConfigValue("PROMETHEUS_METRICS_PREFIX", default="prometheus.metrics.")
     disable_metrics = _ListConfigValue("DISABLE_METRICS", type=starmatch_to_regex, default=[])
     central_config = _BoolConfigValue("CENTRAL_CONFIG", default=True)
     api_request_size = _ConfigValue("API_REQUEST_SIZE", type=int, validators=[size_validator], default=768 * 1024)
     api_request_time = _ConfigValue("API_REQUEST_TIME", type=int, validators=[duration_validator], default=10 * 1000)
+    api_request_streaming = _BoolConfigValue("API_REQUEST_STREAMING", default=False)
+    api_request_senders = _ConfigValue("API_REQUEST_SENDERS", type=int, default=0)
+    api_request_spill_dir = _ConfigValue("API_REQUEST_SPILL_DIR", default=None)
+    api_request_spill_max_size = _ConfigValue(
+        "API_REQUEST_SPILL_MAX_SIZE", type=int, validators=[size_validator], default=100 * 1024 * 1024
+    )
+    per_thread_event_queue = _BoolConfigValue("PER_THREAD_EVENT_QUEUE", default=False)
+    adaptive_compression = _BoolConfigValue("ADAPTIVE_COMPRESSION", default=False)
     transaction_sample_rate = _ConfigValue(
         "TRANSACTION_SAMPLE_RATE", type=float, validators=[PrecisionValidator(4, 0.0001)], default=1.0
     )
+    sampled_transactions_per_minute = _ConfigValue("SAMPLED_TRANSACTIONS_PER_MINUTE", type=int, default=0)
+    transaction_sample_rate_min = _ConfigValue(
+        "TRANSACTION_SAMPLE_RATE_MIN", type=float, validators=[PrecisionValidator(4, 0.0001)], default=0.0001
+    )
+    tail_sampling_enabled = _BoolConfigValue("TAIL_SAMPLING_ENABLED", default=False)
+    tail_sampling_policy = _ConfigValue(
+        "TAIL_SAMPLING_POLICY", default="elasticapm.sampling.DefaultTailSamplingPolicy", required=True
+    )
+    tail_sampling_duration_percentile = _ConfigValue(
+        "TAIL_SAMPLING_DURATION_PERCENTILE", type=float, validators=[PrecisionValidator(2)], default=95.0
+    )
+    tail_sampling_max_buffered_spans = _ConfigValue("TAIL_SAMPLING_MAX_BUFFERED_SPANS", type=int, default=500)
     transaction_max_spans = _ConfigValue("TRANSACTION_MAX_SPANS", type=int, default=500)
+    span_pool_size = _ConfigValue("SPAN_POOL_SIZE", type=int, default=0)
+    deferred_serialization = _BoolConfigValue("DEFERRED_SERIALIZATION", default=False)
     stack_trace_limit = _ConfigValue("STACK_TRACE_LIMIT", type=int, default=500)
+    exit_span_min_duration = _ConfigValue(
+        "EXIT_SPAN_MIN_DURATION", type=int, validators=[duration_validator], default=0
+    )
+    span_compression_enabled = _BoolConfigValue("SPAN_COMPRESSION_ENABLED", default=False)
+    span_compression_exact_match_max_duration = _ConfigValue(
+        "SPAN_COMPRESSION_EXACT_MATCH_MAX_DURATION", type=int, validators=[duration_validator], default=50
+    )
+    span_compression_same_kind_max_duration = _ConfigValue(
+        "SPAN_COMPRESSION_SAME_KIND_MAX_DURATION", type=int, validators=[duration_validator], default=0
+    )
     span_frames_min_duration = _ConfigValue(
         "SPAN_FRAMES_MIN_DURATION",
         default=5,
@@ -76,6 +76,8 @@ MASK = "[REDACTED]"
 
 EXCEPTION_CHAIN_MAX_DEPTH = 50
 
+DROPPED_SPANS_STATS_LIMIT = 128
+
 ERROR = "error"
 TRANSACTION = "transaction"
 SPAN = "span"
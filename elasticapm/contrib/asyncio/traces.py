@@ -41,31 +41,20 @@ class async_capture_span(capture_span):
 
         @functools.wraps(func)
         async def decorated(*args, **kwds):
-            async with self:
+            async with self._for_call():
                 return await func(*args, **kwds)
 
         return decorated
 
     async def __aenter__(self):
-        transaction = execution_context.get_transaction()
-        if transaction and transaction.is_sampled:
-            return transaction.begin_span(
-                self.name,
-                self.type,
-                context=self.extra,
-                leaf=self.leaf,
-                labels=self.labels,
-                span_subtype=self.subtype,
-                span_action=self.action,
-                sync=False,
-                start=self.start,
-            )
+        return self._begin_span(sync=False)
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        transaction = execution_context.get_transaction()
+        transaction = self._get_transaction()
+        span, self._span = self._span, None
         if transaction and transaction.is_sampled:
             try:
-                span = transaction.end_span(self.skip_frames)
+                span = transaction.end_span(self.skip_frames, span=span)
                 if exc_val and not isinstance(span, DroppedSpan):
                     try:
                         exc_val._elastic_apm_span_id = span.id
@@ -175,6 +175,7 @@ def handle_sqs(operation_name, service, instance, args, kwargs, context):
 def modify_span_sqs(span, args, kwargs):
     if span.id:
         trace_parent = span.transaction.trace_parent.copy_from(span_id=span.id)
+        span.dist_tracing_propagated = True
     else:
         # this is a dropped span, use transaction id instead
         transaction = execution_context.get_transaction()
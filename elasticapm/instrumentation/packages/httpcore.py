@@ -92,6 +92,9 @@ class HTTPCoreInstrumentation(AbstractInstrumentedModule):
                 # It's possible that there are only dropped spans, e.g. if we started dropping spans.
                 # In this case, the transaction.id is used
                 parent_id = leaf_span.id if leaf_span else transaction.id
+                if leaf_span:
+                    # the span id is propagated, so this span can't be compressed
+                    leaf_span.dist_tracing_propagated = True
                 trace_parent = transaction.trace_parent.copy_from(
                     span_id=parent_id, trace_options=TracingOptions(recorded=True)
                 )
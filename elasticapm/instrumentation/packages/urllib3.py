@@ -123,6 +123,9 @@ class Urllib3Instrumentation(AbstractInstrumentedModule):
                 leaf_span = leaf_span.parent
 
             parent_id = leaf_span.id if leaf_span else transaction.id
+            if leaf_span:
+                # the span id is propagated, so this span can't be compressed
+                leaf_span.dist_tracing_propagated = True
             trace_parent = transaction.trace_parent.copy_from(
                 span_id=parent_id, trace_options=TracingOptions(recorded=True)
             )
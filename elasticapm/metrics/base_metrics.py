@@ -28,8 +28,12 @@
 #  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import itertools
+import math
 import threading
 import time
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
 
 from elasticapm.conf import constants
@@ -42,6 +46,9 @@ logger = get_logger("elasticapm.metrics")
 
 DISTINCT_LABEL_LIMIT = 1000
 
+# number of stripes the metrics of a metric set are distributed over, each with its own lock
+METRICS_SHARDS = 16
+
 
 class MetricsRegistry(ThreadManager):
     def __init__(self, client, tags=None):
@@ -115,13 +122,27 @@ class MetricsRegistry(ThreadManager):
         return self.client.config.disable_metrics or []
 
 
+class MetricsShard(object):
+    __slots__ = ("lock", "metrics")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # maps (metric class, name, labels) to (metric, creation sequence number). The dict is never modified once
+        # it has been published. Instead, it is replaced by a modified copy when a metric is added, so it can be
+        # read without the lock.
+        self.metrics = {}
+
+
 class MetricsSet(object):
     def __init__(self, registry):
-        self._lock = threading.Lock()
-        self._counters = {}
-        self._gauges = {}
-        self._timers = {}
-        self._histograms = {}
+        self._shards = [MetricsShard() for _ in range(METRICS_SHARDS)]
+        # used to collect metrics in the order they have been created in
+        self._sequence = itertools.count()
+        # hands out a slot for each new metric, so that no more than DISTINCT_LABEL_LIMIT metrics are created,
+        # even if metrics are created concurrently in several shards
+        self._slots = itertools.count()
+        # metrics that have been resolved once, keyed by a caller-defined key, see bind()
+        self._handles = {}
         self._registry = registry
         self._label_limit_logged = False
 
@@ -133,7 +154,7 @@ class MetricsSet(object):
         :param labels: a flat key/value map of labels
         :return: the counter object
         """
-        return self._metric(self._counters, Counter, name, reset_on_collect, labels)
+        return self._metric(Counter, name, reset_on_collect, labels)
 
     def gauge(self, name, reset_on_collect=False, **labels):
         """
@@ -143,7 +164,7 @@ class MetricsSet(object):
         :param labels: a flat key/value map of labels
         :return: the gauge object
         """
-        return self._metric(self._gauges, Gauge, name, reset_on_collect, labels)
+        return self._metric(Gauge, name, reset_on_collect, labels)
 
     def timer(self, name, reset_on_collect=False, unit=None, **labels):
         """
@@ -154,15 +175,51 @@ class MetricsSet(object):
         :param labels: a flat key/value map of labels
         :return: the timer object
         """
-        return self._metric(self._timers, Timer, name, reset_on_collect, labels, unit)
+        return self._metric(Timer, name, reset_on_collect, labels, unit)
 
     def histogram(self, name, reset_on_collect=False, unit=None, buckets=None, **labels):
-        return self._metric(self._histograms, Histogram, name, reset_on_collect, labels, unit, buckets=buckets)
+        return self._metric(Histogram, name, reset_on_collect, labels, unit, buckets=buckets)
+
+    def log_linear_histogram(self, name, reset_on_collect=False, unit=None, relative_error=0.01, **labels):
+        """
+        Returns an existing or creates and returns a new log-linear histogram
+        :param name: name of the histogram
+        :param reset_on_collect: indicate if the histogram should be reset when collecting
+        :param unit: Unit of the observed metric
+        :param relative_error: maximum relative error of values reported for the recorded values
+        :param labels: a flat key/value map of labels
+        :return: the histogram object
+        """
+        return self._metric(LogLinearHistogram, name, reset_on_collect, labels, unit, relative_error=relative_error)
 
-    def _metric(self, container, metric_class, name, reset_on_collect, labels, unit=None, **kwargs):
+    def bind(self, handle_key, metric):
+        """
+        Binds a metric to a key, so it can be looked up with `handle()` later on. This avoids building
+        and normalizing the labels of frequently updated metrics on every update.
+
+            timer = metricset.handle(("duration", name))
+            if timer is None:
+                timer = metricset.bind(("duration", name), metricset.timer("duration", name=name))
+
+        :param handle_key: a hashable key that identifies the name and labels of the metric, e.g. a tuple
+        :param metric: the metric, as returned by `counter()`, `gauge()`, `timer()` or `histogram()`
+        :return: the metric
+        """
+        if len(self._handles) < DISTINCT_LABEL_LIMIT:
+            self._handles[handle_key] = metric
+        return metric
+
+    def handle(self, handle_key):
+        """
+        Returns the metric bound to the given key, or None if no metric has been bound to it
+        :param handle_key: the key used in `bind()`
+        :return: the metric or None
+        """
+        return self._handles.get(handle_key)
+
+    def _metric(self, metric_class, name, reset_on_collect, labels, unit=None, **kwargs):
         """
         Returns an existing or creates and returns a metric
-        :param container: the container for the metric
         :param metric_class: the class of the metric
         :param name: name of the metric
         :param reset_on_collect: indicate if the metric should be reset to 0 when collecting
@@ -171,26 +228,47 @@ class MetricsSet(object):
         """
 
         labels = self._labels_to_key(labels)
-        key = (name, labels)
-        with self._lock:
-            if key not in container:
-                if any(pattern.match(name) for pattern in self._registry.ignore_patterns):
-                    metric = noop_metric
-                elif (
-                    len(self._gauges) + len(self._counters) + len(self._timers) + len(self._histograms)
-                    >= DISTINCT_LABEL_LIMIT
-                ):
-                    if not self._label_limit_logged:
-                        self._label_limit_logged = True
-                        logger.warning(
-                            "The limit of %d metricsets has been reached, no new metricsets will be created."
-                            % DISTINCT_LABEL_LIMIT
-                        )
-                    metric = noop_metric
-                else:
-                    metric = metric_class(name, reset_on_collect=reset_on_collect, unit=unit, **kwargs)
-                container[key] = metric
-            return container[key]
+        key = (metric_class, name, labels)
+        shard = self._shards[hash(key) % METRICS_SHARDS]
+        entry = shard.metrics.get(key)
+        if entry is not None:
+            return entry[0]
+        with shard.lock:
+            entry = shard.metrics.get(key)
+            if entry is not None:
+                return entry[0]
+            if next(self._slots) >= DISTINCT_LABEL_LIMIT:
+                if not self._label_limit_logged:
+                    self._label_limit_logged = True
+                    logger.warning(
+                        "The limit of %d metricsets has been reached, no new metricsets will be created."
+                        % DISTINCT_LABEL_LIMIT
+                    )
+                # not stored, so the shards never hold more than DISTINCT_LABEL_LIMIT entries
+                return noop_metric
+            if any(pattern.match(name) for pattern in self._registry.ignore_patterns):
+                metric = noop_metric
+            else:
+                metric = metric_class(name, reset_on_collect=reset_on_collect, unit=unit, **kwargs)
+            metrics = shard.metrics.copy()
+            metrics[key] = (metric, next(self._sequence))
+            shard.metrics = metrics
+            return metric
+
+    def _metrics_by_class(self):
+        """
+        Returns a snapshot of all metrics of this metric set
+        :return: a dict mapping metric classes to lists of (name, labels, metric) tuples, in order of creation
+        """
+        entries = []
+        for shard in self._shards:
+            # the published dict of a shard is never modified, so it can be iterated safely, see #717
+            entries.extend(compat.iteritems(shard.metrics))
+        entries.sort(key=lambda entry: entry[1][1])
+        metrics = defaultdict(list)
+        for (metric_class, name, labels), (metric, _) in entries:
+            metrics[metric_class].append((name, labels, metric))
+        return metrics
 
     def collect(self):
         """
@@ -207,25 +285,32 @@ class MetricsSet(object):
         self.before_collect()
         timestamp = int(time.time() * 1000000)
         samples = defaultdict(dict)
-        if self._counters:
-            # iterate over a copy of the dict to avoid threading issues, see #717
-            for (name, labels), counter in compat.iteritems(self._counters.copy()):
+        metrics = self._metrics_by_class()
+        counters, gauges, timers, histograms, log_linear_histograms = (
+            metrics[Counter],
+            metrics[Gauge],
+            metrics[Timer],
+            metrics[Histogram],
+            metrics[LogLinearHistogram],
+        )
+        if counters:
+            for name, labels, counter in counters:
                 if counter is not noop_metric:
                     val = counter.val
                     if val or not counter.reset_on_collect:
                         samples[labels].update({name: {"value": val}})
                     if counter.reset_on_collect:
                         counter.reset()
-        if self._gauges:
-            for (name, labels), gauge in compat.iteritems(self._gauges.copy()):
+        if gauges:
+            for name, labels, gauge in gauges:
                 if gauge is not noop_metric:
                     val = gauge.val
                     if val or not gauge.reset_on_collect:
                         samples[labels].update({name: {"value": val, "type": "gauge"}})
                     if gauge.reset_on_collect:
                         gauge.reset()
-        if self._timers:
-            for (name, labels), timer in compat.iteritems(self._timers.copy()):
+        if timers:
+            for name, labels, timer in timers:
                 if timer is not noop_metric:
                     val, count = timer.val
                     if val or not timer.reset_on_collect:
@@ -236,37 +321,20 @@ class MetricsSet(object):
                         samples[labels].update({name + ".count": {"value": count}})
                     if timer.reset_on_collect:
                         timer.reset()
-        if self._histograms:
-            for (name, labels), histo in compat.iteritems(self._histograms.copy()):
+        if histograms:
+            for name, labels, histo in histograms:
                 if histo is not noop_metric:
-                    counts = histo.val
+                    counts = histo.counts(reset=histo.reset_on_collect)
                     if counts or not histo.reset_on_collect:
-                        # For the bucket values, we follow the approach described by Prometheus's
-                        # histogram_quantile function
-                        # (https://prometheus.io/docs/prometheus/latest/querying/functions/#histogram_quantile)
-                        # to achieve consistent percentile aggregation results:
-                        #
-                        # "The histogram_quantile() function interpolates quantile values by assuming a linear
-                        # distribution within a bucket. (...) If a quantile is located in the highest bucket,
-                        # the upper bound of the second highest bucket is returned. A lower limit of the lowest
-                        # bucket is assumed to be 0 if the upper bound of that bucket is greater than 0. In that
-                        # case, the usual linear interpolation is applied within that bucket. Otherwise, the upper
-                        # bound of the lowest bucket is returned for quantiles located in the lowest bucket."
-                        bucket_midpoints = []
-                        for i, bucket_le in enumerate(histo.buckets):
-                            if i == 0:
-                                if bucket_le > 0:
-                                    bucket_le /= 2.0
-                            elif i == len(histo.buckets) - 1:
-                                bucket_le = histo.buckets[i - 1]
-                            else:
-                                bucket_le = histo.buckets[i - 1] + (bucket_le - histo.buckets[i - 1]) / 2.0
-                            bucket_midpoints.append(bucket_le)
                         samples[labels].update(
-                            {name: {"counts": counts, "values": bucket_midpoints, "type": "histogram"}}
+                            {name: {"counts": counts, "values": histo.bucket_midpoints, "type": "histogram"}}
                         )
-                    if histo.reset_on_collect:
-                        histo.reset()
+        if log_linear_histograms:
+            for name, labels, histo in log_linear_histograms:
+                if histo is not noop_metric:
+                    values, counts = histo.snapshot(reset=histo.reset_on_collect).val
+                    if counts or not histo.reset_on_collect:
+                        samples[labels].update({name: {"counts": counts, "values": values, "type": "histogram"}})
 
         if samples:
             for labels, sample in compat.iteritems(samples):
@@ -422,41 +490,222 @@ class Timer(BaseMetric):
 class Histogram(BaseMetric):
     DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 7.5, 10, float("inf"))
 
-    __slots__ = BaseMetric.__slots__ + ("_lock", "_buckets", "_counts", "_lock", "_unit")
+    __slots__ = BaseMetric.__slots__ + ("_lock", "_buckets", "_bucket_midpoints", "_counts", "_empty_counts", "_unit")
 
     def __init__(self, name=None, reset_on_collect=False, unit=None, buckets=None):
         self._lock = threading.Lock()
-        self._buckets = buckets or Histogram.DEFAULT_BUCKETS
-        if self._buckets[-1] != float("inf"):
-            self._buckets.append(float("inf"))
-        self._counts = [0] * len(self._buckets)
+        buckets = list(buckets or Histogram.DEFAULT_BUCKETS)
+        if buckets[-1] != float("inf"):
+            buckets.append(float("inf"))
+        self._buckets = buckets
+        self._bucket_midpoints = self._get_bucket_midpoints(buckets)
+        self._empty_counts = array("q", [0]) * len(buckets)
+        self._counts = array("q", self._empty_counts)
         self._unit = unit
         super(Histogram, self).__init__(name, reset_on_collect=reset_on_collect)
 
+    @staticmethod
+    def _get_bucket_midpoints(buckets):
+        # For the bucket values, we follow the approach described by Prometheus's
+        # histogram_quantile function
+        # (https://prometheus.io/docs/prometheus/latest/querying/functions/#histogram_quantile)
+        # to achieve consistent percentile aggregation results:
+        #
+        # "The histogram_quantile() function interpolates quantile values by assuming a linear
+        # distribution within a bucket. (...) If a quantile is located in the highest bucket,
+        # the upper bound of the second highest bucket is returned. A lower limit of the lowest
+        # bucket is assumed to be 0 if the upper bound of that bucket is greater than 0. In that
+        # case, the usual linear interpolation is applied within that bucket. Otherwise, the upper
+        # bound of the lowest bucket is returned for quantiles located in the lowest bucket."
+        bucket_midpoints = []
+        for i, bucket_le in enumerate(buckets):
+            if i == 0:
+                if bucket_le > 0:
+                    bucket_le /= 2.0
+            elif i == len(buckets) - 1:
+                bucket_le = buckets[i - 1]
+            else:
+                bucket_le = buckets[i - 1] + (bucket_le - buckets[i - 1]) / 2.0
+            bucket_midpoints.append(bucket_le)
+        return bucket_midpoints
+
     def update(self, value, count=1):
-        pos = 0
-        while value > self._buckets[pos]:
-            pos += 1
+        # index of the first bucket with an upper bound greater than or equal to the value
+        pos = bisect_left(self._buckets, value)
         with self._lock:
             self._counts[pos] += count
 
+    def counts(self, reset=False):
+        """
+        Returns the counts of all buckets
+        :param reset: if True, the counts are reset at the same time
+        :return: a list of counts
+        """
+        with self._lock:
+            counts = self._counts
+            if not reset:
+                return counts.tolist()
+            self._counts = array("q", self._empty_counts)
+        return counts.tolist()
+
     @property
     def val(self):
-        with self._lock:
-            return self._counts
+        return self.counts()
 
     @val.setter
     def val(self, value):
+        counts = array("q", (int(count) for count in value))
         with self._lock:
-            self._counts = value
+            self._counts = counts
 
     @property
     def buckets(self):
         return self._buckets
 
+    @property
+    def bucket_midpoints(self):
+        return self._bucket_midpoints
+
+    def reset(self):
+        with self._lock:
+            self._counts = array("q", self._empty_counts)
+
+
+class LogLinearHistogram(BaseMetric):
+    """
+    A histogram of non-negative integer values, e.g. durations in microseconds, with log-linear buckets
+    similar to HDR histograms.
+
+    Values below 2 ** (precision + 1) are counted exactly. Above that, every power of two is split into
+    2 ** precision buckets of equal width. The bucket of a value is calculated with a few bit operations,
+    and the midpoint of a bucket is within the configured relative error of all values in the bucket.
+    """
+
+    __slots__ = BaseMetric.__slots__ + ("_lock", "_counts", "_precision", "_unit")
+
+    def __init__(self, name=None, reset_on_collect=False, unit=None, relative_error=0.01, precision=None):
+        """
+        :param name: name of the histogram
+        :param reset_on_collect: indicate if the histogram should be reset when collecting
+        :param unit: unit of the observed values
+        :param relative_error: the maximum relative error of bucket midpoints, between 0 and 1
+        :param precision: number of bits used to split each power of two, overrides relative_error
+        """
+        self._lock = threading.Lock()
+        if precision is None:
+            # the relative error of a bucket midpoint is at most 2 ** -(precision + 1)
+            precision = max(int(math.ceil(-math.log(relative_error, 2))) - 1, 0)
+        self._precision = precision
+        self._counts = array("Q")
+        self._unit = unit
+        super(LogLinearHistogram, self).__init__(name, reset_on_collect=reset_on_collect)
+
+    @property
+    def precision(self):
+        return self._precision
+
+    def bucket_index(self, value):
+        """
+        Returns the index of the bucket of a value
+        :param value: a non-negative integer
+        :return: the bucket index
+        """
+        shift = value.bit_length() - self._precision - 1
+        if shift <= 0:
+            return value
+        return (shift << self._precision) + (value >> shift)
+
+    def bucket_bounds(self, index):
+        """
+        Returns the range of values in a bucket
+        :param index: the bucket index
+        :return: a tuple of the lowest and highest value in the bucket
+        """
+        shift = (index >> self._precision) - 1
+        if shift <= 0:
+            return index, index
+        top = index - (shift << self._precision)
+        return top << shift, ((top + 1) << shift) - 1
+
+    def update(self, value, count=1):
+        index = self.bucket_index(max(int(value), 0))
+        with self._lock:
+            counts = self._counts
+            if index >= len(counts):
+                counts.extend(itertools.repeat(0, index + 1 - len(counts)))
+            counts[index] += count
+
+    def merge(self, other):
+        """
+        Adds the counts of another histogram with the same precision to this histogram
+        :param other: a LogLinearHistogram
+        :return: the histogram itself
+        """
+        if other._precision != self._precision:
+            raise ValueError("Can't merge histograms with precisions %d and %d" % (self._precision, other._precision))
+        other_counts = other.snapshot()._counts
+        with self._lock:
+            counts = self._counts
+            if len(other_counts) > len(counts):
+                counts.extend(itertools.repeat(0, len(other_counts) - len(counts)))
+            for index, count in enumerate(other_counts):
+                if count:
+                    counts[index] += count
+        return self
+
+    def snapshot(self, reset=False):
+        """
+        Returns a copy of this histogram
+        :param reset: if True, this histogram is reset at the same time
+        :return: a new LogLinearHistogram
+        """
+        snapshot = LogLinearHistogram(self.name, reset_on_collect=self.reset_on_collect, unit=self._unit)
+        snapshot._precision = self._precision
+        with self._lock:
+            if reset:
+                snapshot._counts, self._counts = self._counts, array("Q")
+            else:
+                snapshot._counts = array("Q", self._counts)
+        return snapshot
+
+    def percentile(self, percentile):
+        """
+        Returns the value at the given percentile, within the relative error of the histogram
+        :param percentile: a percentile between 0 and 100
+        :return: the bucket midpoint, or None if the histogram is empty
+        """
+        counts = self.snapshot()._counts
+        total = sum(counts)
+        if not total:
+            return None
+        rank = max(int(math.ceil(total * percentile / 100.0)), 1)
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                low, high = self.bucket_bounds(index)
+                return (low + high) / 2.0
+
+    @property
+    def val(self):
+        """
+        Returns the midpoints and counts of all non-empty buckets
+        :return: a tuple of a list of values and a list of counts
+        """
+        with self._lock:
+            counts = array("Q", self._counts)
+        values = []
+        non_empty_counts = []
+        for index, count in enumerate(counts):
+            if count:
+                low, high = self.bucket_bounds(index)
+                values.append((low + high) / 2.0)
+                non_empty_counts.append(count)
+        return values, non_empty_counts
+
     def reset(self):
         with self._lock:
-            self._counts = [0] * len(self._buckets)
+            self._counts = array("Q")
 
 
 class NoopMetric(object):
@@ -40,32 +40,63 @@ class PrometheusMetrics(MetricsSet):
     def __init__(self, registry):
         super(PrometheusMetrics, self).__init__(registry)
         self._prometheus_registry = prometheus_client.REGISTRY
+        # maps (metric type, name, labels) of Prometheus series to [metric, last value]
+        self._series = {}
+        # metrics whose value has changed since the last collection
+        self._changed = set()
 
     def before_collect(self):
+        self._changed = set()
         for metric in self._prometheus_registry.collect():
             metric_type = self.METRIC_MAP.get(metric.type, None)
             if not metric_type:
                 continue
             metric_type(self, metric.name, metric.samples, metric.unit)
 
+    def _metrics_by_class(self):
+        # only series that have changed since the last collection are sent
+        metrics = super(PrometheusMetrics, self)._metrics_by_class()
+        for metric_class, class_metrics in metrics.items():
+            metrics[metric_class] = [entry for entry in class_metrics if entry[2] in self._changed]
+        return metrics
+
+    def _update(self, metric_type, name, labels, value, **kwargs):
+        """
+        Updates the metric of a Prometheus series, if its value has changed.
+
+        The metric is looked up by the labels of the series as returned by Prometheus, whose order is stable
+        for a given series. This avoids normalizing the labels for every sample.
+
+        :param metric_type: one of "counter", "gauge", "timer" and "histogram"
+        :param name: name of the Prometheus metric
+        :param labels: labels of the series
+        :param value: the new value of the metric
+        :param kwargs: additional arguments used to create the metric
+        """
+        name = self._registry.client.config.prometheus_metrics_prefix + name
+        key = (metric_type, name, tuple(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            kwargs.update(labels)
+            series = self._series[key] = [getattr(self, metric_type)(name, **kwargs), None]
+        if series[1] != value:
+            series[0].val = series[1] = value
+            self._changed.add(series[0])
+
     def _prom_counter_handler(self, name, samples, unit):
         # Counters can be converted 1:1 from Prometheus to our
         # format. Each pair of samples represents a distinct labelset for a
         # given name. The pair consists of the value, and a "created" timestamp.
         # We only use the former.
         for total_sample, _ in grouper(samples, 2):
-            self.counter(
-                self._registry.client.config.prometheus_metrics_prefix + name, **total_sample.labels
-            ).val = total_sample.value
+            self._update("counter", name, total_sample.labels, total_sample.value)
 
     def _prom_gauge_handler(self, name, samples, unit):
         # Counters can be converted 1:1 from Prometheus to our
         # format. Each sample represents a distinct labelset for a
         # given name
         for sample in samples:
-            self.gauge(
-                self._registry.client.config.prometheus_metrics_prefix + name, **sample.labels
-            ).val = sample.value
+            self._update("gauge", name, sample.labels, sample.value)
 
     def _prom_summary_handler(self, name, samples, unit):
         # Prometheus Summaries are analogous to our Timers, having
@@ -74,10 +105,7 @@ class PrometheusMetrics(MetricsSet):
         # grouped into 3-pairs of (count, sum, creation_timestamp).
         # Each 3-pair represents a labelset.
         for count_sample, sum_sample, _ in grouper(samples, 3):
-            self.timer(self._registry.client.config.prometheus_metrics_prefix + name, **count_sample.labels).val = (
-                sum_sample.value,
-                count_sample.value,
-            )
+            self._update("timer", name, count_sample.labels, (sum_sample.value, count_sample.value))
 
     def _prom_histogram_handler(self, name, samples, unit):
         # Prometheus histograms are structured as a series of counts
@@ -90,7 +118,6 @@ class PrometheusMetrics(MetricsSet):
         prev_val = 0
         counts = []
         values = []
-        name = self._registry.client.config.prometheus_metrics_prefix + name
         while sample_pos < len(samples):
             sample = samples[sample_pos]
             if "le" in sample.labels:
@@ -101,7 +128,7 @@ class PrometheusMetrics(MetricsSet):
 
             else:
                 # we reached the end of one set of buckets/values, this is the "count" sample
-                self.histogram(name, unit=unit, buckets=values, **sample.labels).val = counts
+                self._update("histogram", name, sample.labels, counts, unit=unit, buckets=values)
                 prev_val = 0
                 counts = []
                 values = []
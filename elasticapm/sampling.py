@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import bisect
+import random
+import threading
+import timeit
+from collections import deque
+
+_time_func = timeit.default_timer
+
+
+class TailSamplingPolicy(object):
+    """
+    Base class for tail sampling policies.
+
+    A policy decides whether the spans of a transaction are sent, once the transaction has ended, or earlier, if
+    the transaction buffered more than `tail_sampling_max_buffered_spans` spans. Policies are instantiated
+    once per tracer with the agent config, and are called from any thread that ends a transaction.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def should_keep(self, transaction, duration, final=True):
+        """
+        :param transaction: the transaction
+        :param duration: the duration of the transaction in seconds, or the time since its start if `final` is False
+        :param final: False if the decision is forced before the end of the transaction
+        :return: a falsy value if the transaction should be discarded. Otherwise, the probability with which the
+            transaction has been kept, which is used as its sample rate, or True if it is kept in any case.
+        """
+        raise NotImplementedError()
+
+
+class DefaultTailSamplingPolicy(TailSamplingPolicy):
+    """
+    Keeps transactions that captured an error, failed, or were slower than the
+    `tail_sampling_duration_percentile` percentile of the recent transactions of the same type.
+    All other transactions are kept with a probability of `transaction_sample_rate`.
+    """
+
+    #: number of recent durations per transaction type that the percentile is computed from
+    window_size = 1000
+
+    #: number of durations that have to be recorded before the percentile is used
+    min_samples = 20
+
+    def __init__(self, config):
+        super(DefaultTailSamplingPolicy, self).__init__(config)
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def should_keep(self, transaction, duration, final=True):
+        if transaction.captured_errors or transaction.outcome == "failure":
+            keep = True
+        elif self._is_slow(transaction.transaction_type, duration):
+            keep = True
+        else:
+            sample_rate = self.config.transaction_sample_rate
+            keep = (sample_rate == 1.0 or sample_rate > random.random()) and sample_rate
+        if final:
+            self._record(transaction.transaction_type, duration)
+        return keep
+
+    def _is_slow(self, transaction_type, duration):
+        with self._lock:
+            window = self._windows.get(transaction_type)
+            if window is None or len(window[1]) < self.min_samples:
+                return False
+            durations = window[1]
+            index = min(len(durations) - 1, int(len(durations) * self.config.tail_sampling_duration_percentile / 100))
+            return duration >= durations[index]
+
+    def _record(self, transaction_type, duration):
+        with self._lock:
+            window = self._windows.get(transaction_type)
+            if window is None:
+                # recent durations in insertion order, and the same durations in sorted order
+                window = self._windows[transaction_type] = (deque(), [])
+            recent, durations = window
+            if len(recent) >= self.window_size:
+                oldest = recent.popleft()
+                del durations[bisect.bisect_left(durations, oldest)]
+            recent.append(duration)
+            bisect.insort(durations, duration)
+
+
+class SampleRateController(object):
+    """
+    Adjusts the head sampling rate of transactions to stay within a budget of
+    `sampled_transactions_per_minute`.
+
+    The throughput of each transaction type is measured in windows of `interval` seconds and smoothed
+    across windows. After each window, the budget is split between transaction types by max-min fairness:
+    types with a throughput below their fair share are sampled fully, and the remaining budget is split
+    evenly between the busier types. The rate never drops below `transaction_sample_rate_min`, and never
+    exceeds `transaction_sample_rate`.
+
+    Transaction types are used instead of transaction names, as names are usually not known yet when
+    the sampling decision is made.
+    """
+
+    #: length of a measurement window in seconds
+    interval = 10.0
+
+    #: weight of the last window in the smoothed throughput
+    smoothing = 0.5
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._window_start = _time_func()
+        self._counts = {}
+        self._throughputs = {}
+        self._rates = {}
+
+    def sample_rate(self, transaction_type, max_rate):
+        """
+        Counts a new transaction, and returns the sample rate that should be used for it
+
+        :param transaction_type: type of the transaction
+        :param max_rate: the configured sample rate
+        :return: the sample rate, rounded to 4 decimals
+        """
+        now = _time_func()
+        with self._lock:
+            if now - self._window_start >= self.interval:
+                self._update(now)
+            self._counts[transaction_type] = self._counts.get(transaction_type, 0) + 1
+            rate = self._rates.get(transaction_type, 1.0)
+        return min(max_rate, rate)
+
+    def _update(self, now):
+        elapsed = now - self._window_start
+        self._window_start = now
+        throughputs = {}
+        for transaction_type in set(self._counts) | set(self._throughputs):
+            throughput = self._counts.get(transaction_type, 0) * 60.0 / elapsed
+            if transaction_type in self._throughputs:
+                throughput = self.smoothing * throughput + (1 - self.smoothing) * self._throughputs[transaction_type]
+            if throughput >= 1:
+                throughputs[transaction_type] = throughput
+        self._counts = {}
+        self._throughputs = throughputs
+        budget = float(self.config.sampled_transactions_per_minute)
+        min_rate = self.config.transaction_sample_rate_min
+        rates = {}
+        remaining = len(throughputs)
+        for transaction_type, throughput in sorted(throughputs.items(), key=lambda item: item[1]):
+            share = budget / remaining
+            if throughput <= share:
+                rate = 1.0
+                budget -= throughput
+            else:
+                rate = share / throughput
+                budget -= share
+            remaining -= 1
+            # same precision as the transaction_sample_rate config option
+            rates[transaction_type] = max(min_rate, round(rate, 4), 0.0001)
+        self._rates = rates
@@ -31,18 +31,22 @@
 import functools
 import random
 import re
+import sys
 import threading
 import time
 import timeit
-from collections import defaultdict
+import weakref
+from collections import deque
+from functools import lru_cache
 
 from elasticapm.conf import constants
 from elasticapm.conf.constants import LABEL_RE, SPAN, TRANSACTION
 from elasticapm.context import init_execution_context
-from elasticapm.metrics.base_metrics import Timer
-from elasticapm.utils import compat, encoding, get_name_from_func
+from elasticapm.sampling import SampleRateController
+from elasticapm.utils import RegexListMatcher, compat, encoding, get_name_from_func, ids
 from elasticapm.utils.disttracing import TraceParent, TracingOptions
 from elasticapm.utils.logging import get_logger
+from elasticapm.utils.module_import import import_string
 
 __all__ = ("capture_span", "label", "set_transaction_name", "set_custom_context", "set_user_context")
 
@@ -56,26 +60,67 @@ execution_context = init_execution_context()
 
 
 class ChildDuration(object):
-    __slots__ = ("obj", "_nesting_level", "_start", "_duration", "_lock")
+    """
+    Tracks the time during which at least one child of a span or transaction was running.
+
+    As long as all spans of the transaction are started and ended in the thread that started the transaction,
+    the updates are not synchronized. Once another thread is involved, they are serialized by the lock of the
+    transaction, see `Transaction._span_tree_lock`.
+    """
 
-    def __init__(self, obj):
-        self.obj = obj
+    __slots__ = ("_transaction", "_nesting_level", "_start", "_end", "_duration")
+
+    def __init__(self, transaction=None):
+        self._transaction = transaction
         self._nesting_level = 0
         self._start = None
+        self._end = None
         self._duration = 0
-        self._lock = threading.Lock()
 
     def start(self, timestamp):
-        with self._lock:
-            self._nesting_level += 1
-            if self._nesting_level == 1:
-                self._start = timestamp
+        transaction = self._transaction
+        if transaction is None:
+            self._child_started(timestamp)
+            return
+        lock = transaction._span_tree_lock()
+        if lock is None:
+            try:
+                self._child_started(timestamp)
+            finally:
+                transaction._end_unsynchronized_update()
+        else:
+            with lock:
+                self._child_started(timestamp)
 
     def stop(self, timestamp):
-        with self._lock:
-            self._nesting_level -= 1
-            if self._nesting_level == 0:
-                self._duration += timestamp - self._start
+        transaction = self._transaction
+        if transaction is None:
+            self._child_stopped(timestamp)
+            return
+        lock = transaction._span_tree_lock()
+        if lock is None:
+            try:
+                self._child_stopped(timestamp)
+            finally:
+                transaction._end_unsynchronized_update()
+        else:
+            with lock:
+                self._child_stopped(timestamp)
+
+    def _child_started(self, timestamp):
+        if self._nesting_level == 0:
+            self._start = self._end = timestamp
+        elif timestamp < self._start:
+            # children that run in parallel don't necessarily start in order
+            self._start = timestamp
+        self._nesting_level += 1
+
+    def _child_stopped(self, timestamp):
+        if timestamp > self._end:
+            self._end = timestamp
+        self._nesting_level -= 1
+        if self._nesting_level == 0:
+            self._duration += self._end - self._start
 
     @property
     def duration(self):
@@ -83,10 +128,12 @@ class ChildDuration(object):
 
 
 class BaseSpan(object):
-    def __init__(self, labels=None):
-        self._child_durations = ChildDuration(self)
+    def __init__(self, labels=None, transaction=None):
+        self._child_durations = ChildDuration(transaction)
         self.labels = {}
         self.outcome = None
+        # an ended child span that is held back, as it might be compressed with its next sibling
+        self.compression_buffer = None
         if labels:
             self.label(**labels)
 
@@ -99,6 +146,15 @@ class BaseSpan(object):
     def end(self, skip_frames=0, duration=None):
         raise NotImplementedError()
 
+    def report_compression_buffer(self):
+        """
+        Queues the child span that is held back for compression, if any
+        """
+        buffered = self.compression_buffer
+        if buffered is not None:
+            self.compression_buffer = None
+            buffered.report()
+
     def label(self, **labels):
         """
         Label this span with one or multiple key/value labels. Keys should be strings, values can be strings, booleans,
@@ -120,9 +176,7 @@ class BaseSpan(object):
     def set_failure(self):
         self.outcome = "failure"
 
-    @staticmethod
-    def get_dist_tracing_id():
-        return "%016x" % random.getrandbits(64)
+    get_dist_tracing_id = staticmethod(ids.hex_id_64)
 
 
 class Transaction(BaseSpan):
@@ -142,13 +196,24 @@ class Transaction(BaseSpan):
         self.tracer = tracer
 
         self.dropped_spans = 0
+        self.dropped_spans_stats = {}
+        self.captured_errors = 0
         self.context = {}
 
         self._is_sampled = is_sampled
         self.sample_rate = sample_rate
         self._span_counter = 0
-        self._span_timers = defaultdict(Timer)
+        # maps (span type, span subtype) to the summed self time and count of ended spans
+        self._span_timers = {}
         self._span_timers_lock = threading.Lock()
+        # breakdown updates are only synchronized once a thread other than this one is involved
+        self._thread_ident = threading.get_ident()
+        self._multithreaded = False
+        # set while the starting thread is in the middle of an unsynchronized update
+        self._unsynchronized_update = False
+        # holds snapshots of ended spans while the tail sampling decision is pending
+        self._tail_sampling_buffer = None
+        self._tail_sampling_discarded = False
         try:
             self._breakdown = self.tracer._agent._metrics.get_metricset(
                 "elasticapm.metrics.sets.breakdown.BreakdownMetricSet"
@@ -161,39 +226,84 @@ class Transaction(BaseSpan):
             )
         except (LookupError, AttributeError):
             self._transaction_metrics = None
-        super(Transaction, self).__init__()
+        super(Transaction, self).__init__(transaction=self)
 
     def end(self, skip_frames=0, duration=None):
         self.duration = duration if duration is not None else (_time_func() - self.start_time)
+        self.report_compression_buffer()
         if self._transaction_metrics:
-            self._transaction_metrics.timer(
-                "transaction.duration",
-                reset_on_collect=True,
-                unit="us",
-                **{"transaction.name": self.name, "transaction.type": self.transaction_type}
-            ).update(int(self.duration * 1000000))
+            self._duration_timer().update(int(self.duration * 1000000))
+            if self.tracer.config.transaction_duration_histograms:
+                self._duration_histogram().update(int(self.duration * 1000000))
         if self._breakdown:
-            for (span_type, span_subtype), timer in compat.iteritems(self._span_timers):
-                labels = {
-                    "span.type": span_type,
-                    "transaction.name": self.name,
-                    "transaction.type": self.transaction_type,
-                }
-                if span_subtype:
-                    labels["span.subtype"] = span_subtype
-                val = timer.val
-                self._breakdown.timer("span.self_time", reset_on_collect=True, unit="us", **labels).update(
-                    int(val[0] * 1000000), val[1]
-                )
-            labels = {"transaction.name": self.name, "transaction.type": self.transaction_type}
+            lock = self._span_tree_lock()
+            if lock is None:
+                span_timers = list(compat.iteritems(self._span_timers))
+                self._end_unsynchronized_update()
+            else:
+                with lock:
+                    span_timers = list(compat.iteritems(self._span_timers))
+            for (span_type, span_subtype), (self_time, count) in span_timers:
+                self._self_time_timer(span_type, span_subtype).update(int(self_time * 1000000), count)
             if self.is_sampled:
-                self._breakdown.counter("transaction.breakdown.count", reset_on_collect=True, **labels).inc()
-                self._breakdown.timer(
-                    "span.self_time",
+                key = ("transaction.breakdown.count", self.name, self.transaction_type)
+                counter = self._breakdown.handle(key)
+                if counter is None:
+                    counter = self._breakdown.bind(
+                        key,
+                        self._breakdown.counter(
+                            "transaction.breakdown.count",
+                            reset_on_collect=True,
+                            **{"transaction.name": self.name, "transaction.type": self.transaction_type}
+                        ),
+                    )
+                counter.inc()
+                self._self_time_timer("app", None).update(
+                    int((self.duration - self._child_durations.duration) * 1000000)
+                )
+
+    def _duration_timer(self):
+        key = ("transaction.duration", self.name, self.transaction_type)
+        timer = self._transaction_metrics.handle(key)
+        if timer is None:
+            timer = self._transaction_metrics.bind(
+                key,
+                self._transaction_metrics.timer(
+                    "transaction.duration",
                     reset_on_collect=True,
                     unit="us",
-                    **{"span.type": "app", "transaction.name": self.name, "transaction.type": self.transaction_type}
-                ).update(int((self.duration - self._child_durations.duration) * 1000000))
+                    **{"transaction.name": self.name, "transaction.type": self.transaction_type}
+                ),
+            )
+        return timer
+
+    def _duration_histogram(self):
+        key = ("transaction.duration.histogram", self.name, self.transaction_type)
+        histogram = self._transaction_metrics.handle(key)
+        if histogram is None:
+            histogram = self._transaction_metrics.bind(
+                key,
+                self._transaction_metrics.log_linear_histogram(
+                    "transaction.duration.histogram",
+                    reset_on_collect=True,
+                    unit="us",
+                    relative_error=self.tracer.config.histogram_relative_error,
+                    **{"transaction.name": self.name, "transaction.type": self.transaction_type}
+                ),
+            )
+        return histogram
+
+    def _self_time_timer(self, span_type, span_subtype):
+        key = ("span.self_time", self.name, self.transaction_type, span_type, span_subtype)
+        timer = self._breakdown.handle(key)
+        if timer is None:
+            labels = {"span.type": span_type, "transaction.name": self.name, "transaction.type": self.transaction_type}
+            if span_subtype:
+                labels["span.subtype"] = span_subtype
+            timer = self._breakdown.bind(
+                key, self._breakdown.timer("span.self_time", reset_on_collect=True, unit="us", **labels)
+            )
+        return timer
 
     def _begin_span(
         self,
@@ -207,17 +317,27 @@ class Transaction(BaseSpan):
         span_action=None,
         sync=None,
         start=None,
+        parent=None,
     ):
-        parent_span = execution_context.get_span()
+        if parent is None:
+            detached = False
+            parent_span = execution_context.get_span()
+        else:
+            detached = True
+            parent_span = None if parent is self else parent
         tracer = self.tracer
+        pooling = bool(tracer.config.span_pool_size)
         if parent_span and parent_span.leaf:
-            span = DroppedSpan(parent_span, leaf=True)
+            span = (pooling and tracer.reuse_span(tracer._dropped_span_pool)) or DroppedSpan.__new__(DroppedSpan)
+            span.__init__(parent_span, leaf=True, transaction=self, detached=detached)
         elif tracer.config.transaction_max_spans and self._span_counter > tracer.config.transaction_max_spans - 1:
             self.dropped_spans += 1
-            span = DroppedSpan(parent_span)
+            span = (pooling and tracer.reuse_span(tracer._dropped_span_pool)) or DroppedSpan.__new__(DroppedSpan)
+            span.__init__(parent_span, transaction=self, detached=detached)
             self._span_counter += 1
         else:
-            span = Span(
+            span = (pooling and tracer.reuse_span(tracer._span_pool)) or Span.__new__(Span)
+            span.__init__(
                 transaction=self,
                 name=name,
                 span_type=span_type or "code.custom",
@@ -230,10 +350,12 @@ class Transaction(BaseSpan):
                 span_action=span_action,
                 sync=sync,
                 start=start,
+                detached=detached,
             )
             span.frames = tracer.frames_collector_func()
             self._span_counter += 1
-        execution_context.set_span(span)
+        if not detached:
+            execution_context.set_span(span)
         return span
 
     def begin_span(
@@ -247,9 +369,17 @@ class Transaction(BaseSpan):
         span_action=None,
         sync=None,
         start=None,
+        parent=None,
     ):
         """
         Begin a new span
+
+        By default, the span is a child of the currently active span, and becomes the active span itself.
+        If a `parent` is given, the span is a child of that span (or transaction) instead, and the active span
+        is left untouched, both when beginning and ending the span. This allows tracing work that runs
+        concurrently, e.g. in a thread pool or in gathered coroutines. Such a span has to be ended by passing it
+        to `end_span`.
+
         :param name: name of the span
         :param span_type: type of the span
         :param context: a context dict
@@ -259,6 +389,7 @@ class Transaction(BaseSpan):
         :param span_action: action of the span , e.g. "query"
         :param sync: indicate if the span is synchronous or not. In most cases, `None` should be used
         :param start: timestamp, mostly useful for testing
+        :param parent: the transaction or span to use as parent of the new span
         :return: the Span object
         """
         return self._begin_span(
@@ -272,25 +403,30 @@ class Transaction(BaseSpan):
             span_action=span_action,
             sync=sync,
             start=start,
+            parent=parent,
         )
 
-    def end_span(self, skip_frames=0, duration=None, outcome="unknown"):
+    def end_span(self, skip_frames=0, duration=None, outcome="unknown", span=None):
         """
-        End the currently active span
+        End the currently active span, or the given span
         :param skip_frames: numbers of frames to skip in the stack trace
         :param duration: override duration, mostly useful for testing
         :param outcome: outcome of the span, either success, failure or unknown
+        :param span: the span to end, needed for spans that have been started with an explicit parent
         :return: the ended span
         """
-        span = execution_context.get_span()
         if span is None:
-            raise LookupError()
+            span = execution_context.get_span()
+            if span is None:
+                raise LookupError()
 
         # only overwrite span outcome if it is still unknown
         if not span.outcome or span.outcome == "unknown":
             span.outcome = outcome
 
         span.end(skip_frames=skip_frames, duration=duration)
+        if self.tracer.config.span_pool_size:
+            self.tracer.recycle_span(span)
         return span
 
     def ensure_parent_id(self):
@@ -300,40 +436,105 @@ class Transaction(BaseSpan):
         the RUM transaction with the backend transaction.
         """
         if self.trace_parent.span_id == self.id:
-            self.trace_parent.span_id = "%016x" % random.getrandbits(64)
+            self.trace_parent.span_id = ids.hex_id_64()
             logger.debug("Set parent id to generated %s", self.trace_parent.span_id)
         return self.trace_parent.span_id
 
     def to_dict(self):
-        self.context["tags"] = self.labels
-        result = {
-            "id": self.id,
-            "trace_id": self.trace_parent.trace_id,
-            "name": encoding.keyword_field(self.name or ""),
-            "type": encoding.keyword_field(self.transaction_type),
-            "duration": self.duration * 1000,  # milliseconds
-            "result": encoding.keyword_field(str(self.result)),
-            "timestamp": int(self.timestamp * 1000000),  # microseconds
-            "outcome": self.outcome,
-            "sampled": self.is_sampled,
-            "span_count": {"started": self._span_counter - self.dropped_spans, "dropped": self.dropped_spans},
-        }
-        if self.sample_rate is not None:
-            result["sample_rate"] = float(self.sample_rate)
-        if self.trace_parent:
-            result["trace_id"] = self.trace_parent.trace_id
-            # only set parent_id if this transaction isn't the root
-            if self.trace_parent.span_id and self.trace_parent.span_id != self.id:
-                result["parent_id"] = self.trace_parent.span_id
-        if self.is_sampled:
-            result["context"] = self.context
-        return result
+        return TransactionSnapshot(self).to_dict()
 
     def track_span_duration(self, span_type, span_subtype, self_duration):
-        # TODO: once asynchronous spans are supported, we should check if the transaction is already finished
-        # TODO: and, if it has, exit without tracking.
+        if self.duration is not None:
+            # spans with an explicit parent can outlive their transaction, whose breakdown has already been tracked
+            return
+        lock = self._span_tree_lock()
+        if lock is None:
+            try:
+                self._add_span_self_time(span_type, span_subtype, self_duration)
+            finally:
+                self._end_unsynchronized_update()
+        else:
+            with lock:
+                self._add_span_self_time(span_type, span_subtype, self_duration)
+
+    def _add_span_self_time(self, span_type, span_subtype, self_duration):
+        timer = self._span_timers.get((span_type, span_subtype))
+        if timer is None:
+            self._span_timers[(span_type, span_subtype)] = [self_duration, 1]
+        else:
+            timer[0] += self_duration
+            timer[1] += 1
+
+    def _span_tree_lock(self):
+        """
+        Returns the lock that serializes breakdown updates of the spans of this transaction, or None as long as
+        only the thread that started the transaction has started or ended spans. If None is returned, the
+        caller has to call `_end_unsynchronized_update()` once it is done with the update.
+
+        Once another thread is involved, the lock is used for all further updates. The first update of another
+        thread waits until an unsynchronized update that the starting thread is in the middle of is done. As
+        the starting thread flags its update before it checks for other threads, and other threads announce
+        themselves before they check the flag, at least one of them always sees the other.
+        """
+        if threading.get_ident() == self._thread_ident:
+            self._unsynchronized_update = True
+            if not self._multithreaded:
+                return None
+            self._unsynchronized_update = False
+        else:
+            self._multithreaded = True
+            while self._unsynchronized_update:
+                time.sleep(0)
+        return self._span_timers_lock
+
+    def _end_unsynchronized_update(self):
+        self._unsynchronized_update = False
+
+    def track_dropped_span(self, span):
+        """
+        Counts a span that has been dropped because of `exit_span_min_duration`, and adds it to the
+        per-destination statistics of this transaction. A composite span counts as all the spans it represents.
+
+        :param span: the dropped span
+        """
+        if span.composite:
+            count, duration = span.composite["count"], span.composite["sum"]
+        else:
+            count, duration = 1, span.duration
+        self.dropped_spans += count
+        # spans that have been compressed into the composite span were taken off the span counter.
+        # As they are all dropped now, they are counted again, so that the number of started spans is right
+        self._span_counter += count - 1
+        resource = span._destination_resource
+        if not resource:
+            return
+        key = (resource, span.outcome)
+        with self._span_timers_lock:
+            stats = self.dropped_spans_stats.get(key)
+            if stats is None:
+                if len(self.dropped_spans_stats) >= constants.DROPPED_SPANS_STATS_LIMIT:
+                    return
+                stats = self.dropped_spans_stats[key] = [0, 0]
+            stats[0] += count
+            stats[1] += duration
+
+    def buffer_span(self, span):
+        """
+        Holds back an ended span until the tail sampling decision for this transaction has been made.
+        If the buffer is full, the decision is made immediately.
+
+        :param span: the ended span
+        :return: False if the decision has already been made, and the span has not been buffered
+        """
         with self._span_timers_lock:
-            self._span_timers[(span_type, span_subtype)].update(self_duration)
+            buffered = self._tail_sampling_buffer
+            if buffered is None:
+                return False
+            buffered.append(SpanSnapshot(span))
+            full = len(buffered) >= self.tracer.config.tail_sampling_max_buffered_spans
+        if full:
+            self.tracer.make_tail_sampling_decision(self, final=False)
+        return True
 
     @property
     def is_sampled(self):
@@ -353,17 +554,31 @@ class Transaction(BaseSpan):
                 self.trace_parent.add_tracestate(constants.TRACESTATE.SAMPLE_RATE, self.sample_rate)
 
 
+@lru_cache(128)
+def _split_span_type(span_type):
+    """
+    Splits an old style dotted span type, e.g. "db.mysql.query", into type, subtype and action
+
+    :param span_type: the dotted span type
+    :return: a (type, subtype, action) tuple. Action is None if the span type has only two parts
+    """
+    type_bits = span_type.split(".")
+    if len(type_bits) == 2:
+        return type_bits[0], type_bits[1], None
+    return type_bits[0], type_bits[1], type_bits[2]
+
+
 class Span(BaseSpan):
     __slots__ = (
         "id",
         "transaction",
         "name",
-        "type",
-        "subtype",
-        "action",
+        "_raw_type",
+        "_type",
+        "_subtype",
+        "_action",
         "context",
         "leaf",
-        "timestamp",
         "start_time",
         "duration",
         "parent",
@@ -372,6 +587,10 @@ class Span(BaseSpan):
         "labels",
         "sync",
         "outcome",
+        "composite",
+        "dist_tracing_propagated",
+        "compression_buffer",
+        "detached",
         "_child_durations",
     )
 
@@ -389,6 +608,7 @@ class Span(BaseSpan):
         span_action=None,
         sync=None,
         start=None,
+        detached=False,
     ):
         """
         Create a new Span
@@ -404,6 +624,7 @@ class Span(BaseSpan):
         :param span_action: sub type of the span, e.g. query
         :param sync: indicate if the span was executed synchronously or asynchronously
         :param start: timestamp, mostly useful for testing
+        :param detached: if True, beginning and ending this span doesn't change the active span
         """
         self.start_time = start or _time_func()
         self.id = self.get_dist_tracing_id()
@@ -411,59 +632,79 @@ class Span(BaseSpan):
         self.name = name
         self.context = context if context is not None else {}
         self.leaf = leaf
-        # timestamp is bit of a mix of monotonic and non-monotonic time sources.
-        # we take the (non-monotonic) transaction timestamp, and add the (monotonic) difference of span
-        # start time and transaction start time. In this respect, the span timestamp is guaranteed to grow
-        # monotonically with respect to the transaction timestamp
-        self.timestamp = transaction.timestamp + (self.start_time - transaction.start_time)
         self.duration = None
         self.parent = parent
         self.parent_span_id = parent_span_id
         self.frames = None
         self.sync = sync
-        if span_subtype is None and "." in span_type:
-            # old style dottet type, let's split it up
-            type_bits = span_type.split(".")
-            if len(type_bits) == 2:
-                span_type, span_subtype = type_bits[:2]
-            else:
-                span_type, span_subtype, span_action = type_bits[:3]
-        self.type = span_type
-        self.subtype = span_subtype
-        self.action = span_action
+        self.composite = None
+        self.dist_tracing_propagated = False
+        self.detached = detached
+        # the type is only parsed when it is needed, see _parse_type
+        self._raw_type = span_type
+        self._type = None
+        self._subtype = span_subtype
+        self._action = span_action
         if self.transaction._breakdown:
             p = self.parent if self.parent else self.transaction
             p.child_started(self.start_time)
-        super(Span, self).__init__(labels=labels)
+        super(Span, self).__init__(labels=labels, transaction=transaction)
 
     def to_dict(self):
-        result = {
-            "id": self.id,
-            "transaction_id": self.transaction.id,
-            "trace_id": self.transaction.trace_parent.trace_id,
-            # use either the explicitly set parent_span_id, or the id of the parent, or finally the transaction id
-            "parent_id": self.parent_span_id or (self.parent.id if self.parent else self.transaction.id),
-            "name": encoding.keyword_field(self.name),
-            "type": encoding.keyword_field(self.type),
-            "subtype": encoding.keyword_field(self.subtype),
-            "action": encoding.keyword_field(self.action),
-            "timestamp": int(self.timestamp * 1000000),  # microseconds
-            "duration": self.duration * 1000,  # milliseconds
-            "outcome": self.outcome,
-        }
-        if self.transaction.sample_rate is not None:
-            result["sample_rate"] = float(self.transaction.sample_rate)
-        if self.sync is not None:
-            result["sync"] = self.sync
-        if self.labels:
-            if self.context is None:
-                self.context = {}
-            self.context["tags"] = self.labels
-        if self.context:
-            result["context"] = self.context
-        if self.frames:
-            result["stacktrace"] = self.frames
-        return result
+        return SpanSnapshot(self).to_dict()
+
+    @property
+    def timestamp(self):
+        # timestamp is bit of a mix of monotonic and non-monotonic time sources.
+        # we take the (non-monotonic) transaction timestamp, and add the (monotonic) difference of span
+        # start time and transaction start time. In this respect, the span timestamp is guaranteed to grow
+        # monotonically with respect to the transaction timestamp
+        return self.transaction.timestamp + (self.start_time - self.transaction.start_time)
+
+    def _parse_type(self):
+        span_type = self._raw_type
+        if self._subtype is None and "." in span_type:
+            # old style dotted type, let's split it up
+            span_type, self._subtype, span_action = _split_span_type(span_type)
+            if span_action is not None:
+                self._action = span_action
+        self._type = span_type
+
+    @property
+    def type(self):
+        if self._type is None:
+            self._parse_type()
+        return self._type
+
+    @type.setter
+    def type(self, value):
+        if self._type is None:
+            self._parse_type()
+        self._type = value
+
+    @property
+    def subtype(self):
+        if self._type is None:
+            self._parse_type()
+        return self._subtype
+
+    @subtype.setter
+    def subtype(self, value):
+        if self._type is None:
+            self._parse_type()
+        self._subtype = value
+
+    @property
+    def action(self):
+        if self._type is None:
+            self._parse_type()
+        return self._action
+
+    @action.setter
+    def action(self, value):
+        if self._type is None:
+            self._parse_type()
+        self._action = value
 
     def end(self, skip_frames=0, duration=None):
         """
@@ -480,14 +721,110 @@ class Span(BaseSpan):
             self.frames = tracer.frames_processing_func(self.frames)[skip_frames:]
         else:
             self.frames = None
-        execution_context.set_span(self.parent)
-        tracer.queue_func(SPAN, self.to_dict())
+        if not self.detached:
+            execution_context.set_span(self.parent)
+        self.report_compression_buffer()
+        p = self.parent if self.parent else self.transaction
         if self.transaction._breakdown:
-            p = self.parent if self.parent else self.transaction
             p.child_ended(self.start_time + self.duration)
             self.transaction.track_span_duration(
                 self.type, self.subtype, self.duration - self._child_durations.duration
             )
+        if self.detached:
+            # siblings of a detached span may end concurrently, so it is neither compressed nor flushes
+            # the compression buffer of its parent
+            self.report()
+            return
+        if not tracer.config.span_compression_enabled or not self.is_compression_eligible():
+            p.report_compression_buffer()
+            self.report()
+            return
+        buffered = p.compression_buffer
+        if buffered is not None:
+            if buffered.try_to_compress(self):
+                return
+            buffered.report()
+        p.compression_buffer = self
+
+    def report(self):
+        """
+        Queues this span for sending, unless it is a fast exit span that can be discarded.
+        In that case, the span is only added to the dropped spans statistics of the transaction.
+        """
+        tracer = self.transaction.tracer
+        if self.is_discardable() and self.duration < tracer.config.exit_span_min_duration / 1000.0:
+            self.transaction.track_dropped_span(self)
+            return
+        if self.transaction._tail_sampling_buffer is not None and self.transaction.buffer_span(self):
+            return
+        if self.transaction._tail_sampling_discarded:
+            return
+        tracer.queue_func(SPAN, SpanSnapshot(self) if tracer.config.deferred_serialization else self.to_dict())
+
+    def is_discardable(self):
+        """
+        Only successful leaf spans whose ID hasn't been propagated to other services can be discarded
+        """
+        return self.leaf and not self.dist_tracing_propagated and self.outcome != "failure"
+
+    def is_compression_eligible(self):
+        """
+        Only successful leaf spans whose ID hasn't been propagated to other services can be compressed
+        """
+        return self.leaf and not self.dist_tracing_propagated and self.outcome in (None, "unknown", "success")
+
+    def is_same_kind(self, other):
+        return (
+            self.type == other.type
+            and self.subtype == other.subtype
+            and self._destination_resource == other._destination_resource
+        )
+
+    @property
+    def _destination_resource(self):
+        return self.context.get("destination", {}).get("service", {}).get("resource") if self.context else None
+
+    def try_to_compress(self, sibling):
+        """
+        Tries to merge an ended sibling span into this span.
+
+        Spans with the same name are merged with the `exact_match` strategy, if both are shorter than
+        `span_compression_exact_match_max_duration`. Spans that only have the same type, subtype and
+        destination are merged with the `same_kind` strategy, if both are shorter than
+        `span_compression_same_kind_max_duration`. Once a span is a composite, it only accepts siblings
+        that fit its strategy.
+
+        :param sibling: the sibling span, which ended after this span
+        :return: True if the sibling has been merged into this span
+        """
+        if not self.is_same_kind(sibling):
+            return False
+        config = self.transaction.tracer.config
+        exact_match_max_duration = config.span_compression_exact_match_max_duration / 1000.0
+        same_kind_max_duration = config.span_compression_same_kind_max_duration / 1000.0
+        if self.composite:
+            strategy = self.composite["compression_strategy"]
+            if strategy == "exact_match":
+                compressible = self.name == sibling.name and sibling.duration <= exact_match_max_duration
+            else:
+                compressible = sibling.duration <= same_kind_max_duration
+        elif self.name == sibling.name and max(self.duration, sibling.duration) <= exact_match_max_duration:
+            strategy, compressible = "exact_match", True
+        elif self._destination_resource and max(self.duration, sibling.duration) <= same_kind_max_duration:
+            strategy, compressible = "same_kind", True
+            self.name = "Calls to " + self._destination_resource
+        else:
+            compressible = False
+        if not compressible:
+            return False
+        if not self.composite:
+            self.composite = {"compression_strategy": strategy, "count": 1, "sum": self.duration}
+        self.composite["count"] += 1
+        self.composite["sum"] += sibling.duration
+        self.duration = sibling.start_time + sibling.duration - self.start_time
+        # the merged span doesn't count towards transaction_max_spans
+        self.transaction._span_counter -= 1
+        return True
 
     def update_context(self, key, data):
         """
@@ -505,16 +842,20 @@ class Span(BaseSpan):
 
 
 class DroppedSpan(BaseSpan):
-    __slots__ = ("leaf", "parent", "id")
+    __slots__ = ("leaf", "parent", "id", "transaction", "detached")
 
-    def __init__(self, parent, leaf=False):
+    def __init__(self, parent, leaf=False, transaction=None, detached=False):
         self.parent = parent
         self.leaf = leaf
         self.id = None
+        self.transaction = transaction
+        self.detached = detached
         super(DroppedSpan, self).__init__()
 
     def end(self, skip_frames=0, duration=None):
-        execution_context.set_span(self.parent)
+        if not self.detached:
+            execution_context.set_span(self.parent)
+        self.report_compression_buffer()
 
     def child_started(self, timestamp):
         pass
@@ -550,6 +891,178 @@ class DroppedSpan(BaseSpan):
         return
 
 
+def _copy_context(context):
+    """
+    Copies a context dict, including the dicts it contains, as those are updated in place, e.g. by `set_context`
+    """
+    if not context:
+        return {}
+    return {key: value.copy() if type(value) is dict else value for key, value in compat.iteritems(context)}
+
+
+class TransactionSnapshot(object):
+    """
+    A snapshot of an ended transaction. It is cheap to create on the application thread,
+    while the work of converting it into a dict is done in `to_dict()`, which can be deferred
+    to the event processor thread.
+    """
+
+    __slots__ = (
+        "id",
+        "trace_id",
+        "parent_id",
+        "name",
+        "type",
+        "duration",
+        "result",
+        "timestamp",
+        "outcome",
+        "sampled",
+        "sample_rate",
+        "spans_started",
+        "spans_dropped",
+        "dropped_spans_stats",
+        "labels",
+        "context",
+    )
+
+    def __init__(self, transaction):
+        trace_parent = transaction.trace_parent
+        self.id = transaction.id
+        self.trace_id = trace_parent.trace_id
+        # only set parent_id if this transaction isn't the root
+        self.parent_id = trace_parent.span_id if trace_parent.span_id != transaction.id else None
+        self.name = transaction.name
+        self.type = transaction.transaction_type
+        self.duration = transaction.duration
+        self.result = transaction.result
+        self.timestamp = transaction.timestamp
+        self.outcome = transaction.outcome
+        self.sampled = transaction.is_sampled
+        self.sample_rate = transaction.sample_rate
+        self.spans_started = transaction._span_counter - transaction.dropped_spans
+        self.spans_dropped = transaction.dropped_spans
+        self.dropped_spans_stats = [
+            (resource, outcome, count, duration)
+            for (resource, outcome), (count, duration) in compat.iteritems(transaction.dropped_spans_stats)
+        ]
+        self.labels = transaction.labels.copy()
+        self.context = _copy_context(transaction.context)
+
+    def to_dict(self):
+        # the context is a copy that is owned by the snapshot
+        self.context["tags"] = self.labels
+        result = {
+            "id": self.id,
+            "trace_id": self.trace_id,
+            "name": encoding.keyword_field(self.name or ""),
+            "type": encoding.keyword_field(self.type),
+            "duration": self.duration * 1000,  # milliseconds
+            "result": encoding.keyword_field(str(self.result)),
+            "timestamp": int(self.timestamp * 1000000),  # microseconds
+            "outcome": self.outcome,
+            "sampled": self.sampled,
+            "span_count": {"started": self.spans_started, "dropped": self.spans_dropped},
+        }
+        if self.sample_rate is not None:
+            result["sample_rate"] = float(self.sample_rate)
+        if self.parent_id:
+            result["parent_id"] = self.parent_id
+        if self.dropped_spans_stats:
+            result["dropped_spans_stats"] = [
+                {
+                    "destination_service_resource": encoding.keyword_field(resource),
+                    "outcome": outcome,
+                    "duration": {"count": count, "sum": {"us": int(duration * 1000000)}},
+                }
+                for resource, outcome, count, duration in self.dropped_spans_stats
+            ]
+        if self.sampled:
+            result["context"] = self.context
+        return result
+
+
+class SpanSnapshot(object):
+    """
+    A snapshot of an ended span, see TransactionSnapshot
+    """
+
+    __slots__ = (
+        "id",
+        "transaction_id",
+        "trace_id",
+        "parent_id",
+        "name",
+        "type",
+        "subtype",
+        "action",
+        "timestamp",
+        "duration",
+        "outcome",
+        "sample_rate",
+        "sync",
+        "labels",
+        "context",
+        "frames",
+        "composite",
+    )
+
+    def __init__(self, span):
+        transaction = span.transaction
+        self.id = span.id
+        self.transaction_id = transaction.id
+        self.trace_id = transaction.trace_parent.trace_id
+        # use either the explicitly set parent_span_id, or the id of the parent, or finally the transaction id
+        self.parent_id = span.parent_span_id or (span.parent.id if span.parent else transaction.id)
+        self.name = span.name
+        self.type = span.type
+        self.subtype = span.subtype
+        self.action = span.action
+        self.timestamp = span.timestamp
+        self.duration = span.duration
+        self.outcome = span.outcome
+        self.sample_rate = transaction.sample_rate
+        self.sync = span.sync
+        self.labels = span.labels.copy()
+        self.context = _copy_context(span.context)
+        self.frames = list(span.frames) if span.frames else None
+        self.composite = span.composite
+
+    def to_dict(self):
+        result = {
+            "id": self.id,
+            "transaction_id": self.transaction_id,
+            "trace_id": self.trace_id,
+            "parent_id": self.parent_id,
+            "name": encoding.keyword_field(self.name),
+            "type": encoding.keyword_field(self.type),
+            "subtype": encoding.keyword_field(self.subtype),
+            "action": encoding.keyword_field(self.action),
+            "timestamp": int(self.timestamp * 1000000),  # microseconds
+            "duration": self.duration * 1000,  # milliseconds
+            "outcome": self.outcome,
+        }
+        if self.sample_rate is not None:
+            result["sample_rate"] = float(self.sample_rate)
+        if self.sync is not None:
+            result["sync"] = self.sync
+        context = self.context
+        if self.labels:
+            # the context is a copy that is owned by the snapshot
+            context["tags"] = self.labels
+        if context:
+            result["context"] = context
+        if self.frames:
+            result["stacktrace"] = self.frames
+        if self.composite:
+            result["composite"] = {
+                "compression_strategy": self.composite["compression_strategy"],
+                "count": self.composite["count"],
+                "sum": self.composite["sum"] * 1000,  # milliseconds
+            }
+        return result
+
+
 class Tracer(object):
     def __init__(self, frames_collector_func, frames_processing_func, queue_func, config, agent):
         self.config = config
@@ -557,7 +1070,13 @@ class Tracer(object):
         self.frames_processing_func = frames_processing_func
         self.frames_collector_func = frames_collector_func
         self._agent = agent
-        self._ignore_patterns = [re.compile(p) for p in config.transactions_ignore_patterns or []]
+        # (transactions_ignore_patterns, matcher), rebuilt when the config value changes
+        self._ignore_patterns = (None, None)
+        self._tail_sampling_policy = None
+        self._sample_rate_controller = None
+        # ended spans that can be reused for new spans, see reuse_span
+        self._span_pool = deque()
+        self._dropped_span_pool = deque()
 
     @property
     def span_frames_min_duration(self):
@@ -566,6 +1085,63 @@ class Tracer(object):
         else:
             return self.config.span_frames_min_duration / 1000.0
 
+    def recycle_span(self, span):
+        """
+        Puts an ended span into the pool, so that it can be reused for a new span.
+
+        The span might still be referenced, e.g. by user code, a compression buffer or a child span.
+        That's why this is only checked in `reuse_span`.
+
+        :param span: the ended span
+        """
+        if type(span) is DroppedSpan:
+            pool = self._dropped_span_pool
+            # dropped spans are reused independently of other spans, so they must not keep their parent from
+            # being reused. The parent is only needed to restore the active span when the dropped span ends.
+            span.parent = span.transaction = None
+        else:
+            pool = self._span_pool
+        if len(pool) < self.config.span_pool_size and hasattr(sys, "getrefcount"):
+            pool.append(span)
+
+    def reuse_span(self, pool):
+        """
+        Takes the oldest span out of the pool that isn't referenced anywhere else.
+        Spans that are still referenced are removed from the pool and left to the garbage collector.
+
+        Spans are taken in the order they ended. As child spans end before their parents, they are reused first,
+        which removes their reference to the parent.
+
+        :param pool: the span pool or the dropped span pool
+        :return: a span that has to be re-initialized with `__init__`, or None if there is none
+        """
+        if not hasattr(sys, "getrefcount"):
+            # without reference counts (e.g. on PyPy), it can't be ensured that a span isn't referenced anymore
+            return None
+        while True:
+            try:
+                span = pool.popleft()
+            except IndexError:
+                return None
+            # the only references are the local variable and the argument of getrefcount
+            if sys.getrefcount(span) == 2 and not weakref.getweakrefcount(span):
+                if span.__dict__:
+                    # attributes that have been set by user code
+                    span.__dict__.clear()
+                return span
+
+    @property
+    def tail_sampling_policy(self):
+        if self._tail_sampling_policy is None:
+            self._tail_sampling_policy = import_string(self.config.tail_sampling_policy)(self.config)
+        return self._tail_sampling_policy
+
+    @property
+    def sample_rate_controller(self):
+        if self._sample_rate_controller is None:
+            self._sample_rate_controller = SampleRateController(self.config)
+        return self._sample_rate_controller
+
     def begin_transaction(self, transaction_type, trace_parent=None, start=None):
         """
         Start a new transactions and bind it in a thread-local variable
@@ -576,17 +1152,25 @@ class Tracer(object):
 
         :returns the Transaction object
         """
+        tail_sampling = False
         if trace_parent:
             is_sampled = bool(trace_parent.trace_options.recorded)
             sample_rate = trace_parent.tracestate_dict.get(constants.TRACESTATE.SAMPLE_RATE)
+        elif self.config.tail_sampling_enabled:
+            # record everything, the decision is made once the transaction has ended
+            is_sampled = tail_sampling = True
+            sample_rate = str(self.config.transaction_sample_rate)
         else:
-            is_sampled = (
-                self.config.transaction_sample_rate == 1.0 or self.config.transaction_sample_rate > random.random()
-            )
+            transaction_sample_rate = self.config.transaction_sample_rate
+            if self.config.sampled_transactions_per_minute:
+                transaction_sample_rate = self.sample_rate_controller.sample_rate(
+                    transaction_type, transaction_sample_rate
+                )
+            is_sampled = transaction_sample_rate == 1.0 or transaction_sample_rate > random.random()
             if not is_sampled:
                 sample_rate = "0"
             else:
-                sample_rate = str(self.config.transaction_sample_rate)
+                sample_rate = str(transaction_sample_rate)
 
         transaction = Transaction(
             self,
@@ -599,11 +1183,13 @@ class Tracer(object):
         if trace_parent is None:
             transaction.trace_parent = TraceParent(
                 constants.TRACE_CONTEXT_VERSION,
-                "%032x" % random.getrandbits(128),
+                ids.hex_id_128(),
                 transaction.id,
                 TracingOptions(recorded=is_sampled),
             )
             transaction.trace_parent.add_tracestate(constants.TRACESTATE.SAMPLE_RATE, sample_rate)
+        if tail_sampling:
+            transaction._tail_sampling_buffer = []
         execution_context.set_transaction(transaction)
         return transaction
 
@@ -624,14 +1210,50 @@ class Tracer(object):
                 return
             if transaction.result is None:
                 transaction.result = result
-            self.queue_func(TRANSACTION, transaction.to_dict())
+            if transaction._tail_sampling_buffer is not None or transaction._tail_sampling_discarded:
+                self.make_tail_sampling_decision(transaction)
+            if self.config.deferred_serialization:
+                self.queue_func(TRANSACTION, TransactionSnapshot(transaction))
+            else:
+                self.queue_func(TRANSACTION, transaction.to_dict())
         return transaction
 
+    def make_tail_sampling_decision(self, transaction, final=True):
+        """
+        Asks the tail sampling policy whether to keep the transaction, and queues or discards its buffered spans
+
+        :param transaction: the transaction
+        :param final: False if the decision is forced before the transaction has ended
+        """
+        with transaction._span_timers_lock:
+            buffered, transaction._tail_sampling_buffer = transaction._tail_sampling_buffer, None
+        if buffered is not None:
+            duration = transaction.duration if final else _time_func() - transaction.start_time
+            keep = self.tail_sampling_policy.should_keep(transaction, duration, final=final)
+            if keep:
+                # the transaction is weighted by 1 / sample rate, so the probability with which it has actually
+                # been kept is recorded instead of the configured sample rate
+                transaction.sample_rate = str(float(keep))
+                transaction.trace_parent.add_tracestate(constants.TRACESTATE.SAMPLE_RATE, transaction.sample_rate)
+                for snapshot in buffered:
+                    snapshot.sample_rate = transaction.sample_rate
+                    self.queue_func(SPAN, snapshot if self.config.deferred_serialization else snapshot.to_dict())
+            else:
+                transaction._tail_sampling_discarded = True
+        if final and transaction._tail_sampling_discarded:
+            # spans that are still running when an early decision is made have to be ended as usual,
+            # so the transaction is only marked as unsampled once it has ended
+            transaction.is_sampled = False
+
     def _should_ignore(self, transaction_name):
-        for pattern in self._ignore_patterns:
-            if pattern.search(transaction_name):
-                return True
-        return False
+        patterns = self.config.transactions_ignore_patterns
+        if not patterns:
+            return False
+        config_patterns, matcher = self._ignore_patterns
+        if config_patterns is not patterns:
+            matcher = RegexListMatcher([re.compile(p) for p in patterns])
+            self._ignore_patterns = (patterns, matcher)
+        return matcher.matches(transaction_name)
 
 
 class capture_span(object):
@@ -647,6 +1269,8 @@ class capture_span(object):
         "duration",
         "start",
         "sync",
+        "parent",
+        "_span",
     )
 
     def __init__(
@@ -662,6 +1286,7 @@ class capture_span(object):
         start=None,
         duration=None,
         sync=None,
+        parent=None,
     ):
         self.name = name
         self.type = span_type
@@ -674,39 +1299,45 @@ class capture_span(object):
         self.start = start
         self.duration = duration
         self.sync = sync
+        # if a parent transaction or span is given, the span doesn't become the active span, see
+        # Transaction.begin_span. The span is then kept here until it is ended in __exit__.
+        self.parent = parent
+        self._span = None
 
     def __call__(self, func):
         self.name = self.name or get_name_from_func(func)
 
         @functools.wraps(func)
         def decorated(*args, **kwds):
-            with self:
+            with self._for_call():
                 return func(*args, **kwds)
 
         return decorated
 
+    def _for_call(self):
+        """
+        Returns the instance to use for one call of a decorated function. Spans with an explicit parent are
+        kept on the instance, so concurrent calls need their own copy.
+        """
+        if self.parent is None:
+            return self
+        instance = self.__class__.__new__(self.__class__)
+        for attr in capture_span.__slots__:
+            setattr(instance, attr, getattr(self, attr))
+        instance._span = None
+        return instance
+
     def __enter__(self):
-        transaction = execution_context.get_transaction()
-        if transaction and transaction.is_sampled:
-            return transaction.begin_span(
-                self.name,
-                self.type,
-                context=self.extra,
-                leaf=self.leaf,
-                labels=self.labels,
-                span_subtype=self.subtype,
-                span_action=self.action,
-                start=self.start,
-                sync=self.sync,
-            )
+        return self._begin_span(sync=self.sync)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        transaction = execution_context.get_transaction()
+        transaction = self._get_transaction()
+        span, self._span = self._span, None
 
         if transaction and transaction.is_sampled:
             try:
                 outcome = "failure" if exc_val else "success"
-                span = transaction.end_span(self.skip_frames, duration=self.duration, outcome=outcome)
+                span = transaction.end_span(self.skip_frames, duration=self.duration, outcome=outcome, span=span)
                 if exc_val and not isinstance(span, DroppedSpan):
                     try:
                         exc_val._elastic_apm_span_id = span.id
@@ -716,6 +1347,31 @@ class capture_span(object):
             except LookupError:
                 logger.debug("ended non-existing span %s of type %s", self.name, self.type)
 
+    def _get_transaction(self):
+        parent = self.parent
+        if parent is None:
+            return execution_context.get_transaction()
+        return parent if isinstance(parent, Transaction) else parent.transaction
+
+    def _begin_span(self, sync):
+        transaction = self._get_transaction()
+        if transaction and transaction.is_sampled:
+            span = transaction.begin_span(
+                self.name,
+                self.type,
+                context=self.extra,
+                leaf=self.leaf,
+                labels=self.labels,
+                span_subtype=self.subtype,
+                span_action=self.action,
+                start=self.start,
+                sync=sync,
+                parent=self.parent,
+            )
+            if self.parent is not None:
+                self._span = span
+            return span
+
 
 def label(**labels):
     """
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import asyncio
+import concurrent.futures
+import os
+import random
+import threading
+import timeit
+
+from elasticapm.transport import base
+from elasticapm.transport.http import Transport
+from elasticapm.utils import compat
+from elasticapm.utils.logging import get_logger
+from elasticapm.utils.threading import ThreadManager
+
+logger = get_logger("elasticapm.transport.asyncio_http")
+
+
+class AsyncioTransport(Transport):
+    """
+    A transport that processes events and sends them to the APM Server as a task on an asyncio event loop,
+    instead of in a thread of its own.
+
+    The task runs on the event loop that is running when the transport is started, or else on the event loop
+    of the first coroutine that queues an event. If an event is queued outside of any event loop before that,
+    a dedicated event loop is started in a thread.
+
+    Requests are sent with the urllib3 based HTTP transport from an executor thread, so that the event loop is
+    never blocked, while proxies and certificates are handled like in the default transport. Sending them with
+    non-blocking sockets on the event loop would require an asyncio HTTP client as an additional dependency. The
+    executor has a single thread, which mostly waits for the APM Server.
+    `api_request_streaming`, `api_request_senders` and `api_request_spill_dir` are not supported.
+    """
+
+    # batches of events that are larger than this (in bytes, before compression) are compressed in the executor,
+    # to not block the event loop
+    executor_compression_threshold = 64 * 1024
+
+    def __init__(self, url, *args, **kwargs):
+        super(AsyncioTransport, self).__init__(url, *args, **kwargs)
+        self._loop = None
+        self._loop_thread = None
+        self._task = None
+        self._wakeup = None
+        self._executor = None
+        self._buffer = None
+        self._start_lock = threading.Lock()
+
+    def _init_event_queue(self, chill_until, max_chill_time):
+        # the queue is shared between the event loop and other threads, so it has to be thread-safe.
+        # Instead of chilling in the queue, the task is only woken up once a batch is full
+        self._max_chill_time = max_chill_time
+        return compat.queue.Queue(maxsize=10000)
+
+    def _init_buffer(self, fileobj=None):
+        # writing to a streaming request can block, so the payloads are always buffered in memory
+        return base.Transport._init_buffer(self, fileobj=fileobj)
+
+    def start_thread(self, pid=None):
+        ThreadManager.start_thread(self, pid=pid)
+        loop = _get_running_loop()
+        if loop is not None and not self._closed:
+            self._start(loop)
+
+    def _start(self, loop=None):
+        """
+        Starts the event processing task on the given event loop, or a dedicated event loop if no loop is given
+        """
+        with self._start_lock:
+            if self._is_running():
+                return
+            if loop is None:
+                loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=loop.run_forever, name="eapm asyncio transport loop")
+                self._loop_thread.daemon = True
+                self._loop_thread.start()
+            self._loop = loop
+            self._loop_pid = os.getpid()
+            # a single thread for requests and compression, as the task awaits them one at a time anyway
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            if _get_running_loop() is loop:
+                self._task = loop.create_task(self._process_queue_async())
+            else:
+                self._task = asyncio.run_coroutine_threadsafe(self._process_queue_async(), loop)
+
+    def _is_running(self):
+        return (
+            self._loop is not None
+            and self._loop_pid == os.getpid()
+            and not self._loop.is_closed()
+            and not self._task.done()
+        )
+
+    def queue(self, event_type, data, flush=False):
+        if not self._is_running() and not self._closed:
+            self._start(_get_running_loop())
+        try:
+            self._flushed.clear()
+            self._event_queue.put_nowait((event_type, data, flush))
+        except compat.queue.Full:
+            logger.debug("Event of type %s dropped due to full event queue", event_type)
+            return
+        if flush or event_type == "close" or self._event_queue.qsize() >= self._max_batch_size:
+            self._wake_up()
+
+    def _wake_up(self):
+        wakeup, loop = self._wakeup, self._loop
+        if wakeup is None or loop is None:
+            # the task hasn't started yet, it will process all queued events once it does
+            return
+        if _get_running_loop() is loop:
+            wakeup.set()
+        else:
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # the loop has been closed in the meantime
+                pass
+
+    async def _process_queue_async(self):
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        if self.client:
+            self._metadata = self.client.build_metadata()
+            if not self.client.server_version:
+                await loop.run_in_executor(self._executor, self.fetch_server_info)
+
+        # add some randomness to timeout to avoid stampedes of several workers that are booted at the same time
+        max_flush_time = self._max_flush_time * random.uniform(0.9, 1.1) if self._max_flush_time else None
+
+        while True:
+            if self._event_queue.empty():
+                # wait until a batch is full, but at most until the next chill time or flush time is up
+                timeout = self._max_chill_time
+                if max_flush_time:
+                    timeout = max(0, min(timeout, max_flush_time - (timeit.default_timer() - self._last_flush)))
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+
+            batch = self._get_available_events(self._max_batch_size)
+            lines, flush, close = self._encode_batch(batch)
+            if lines:
+                # the buffer is kept on the transport, so that `close` can still send it if the loop has stopped
+                if self._buffer is None:
+                    self._buffer = self._init_buffer()
+                data = b"".join(lines)
+                if len(data) > self.executor_compression_threshold:
+                    await loop.run_in_executor(self._executor, self._buffer.write, data)
+                else:
+                    self._buffer.write(data)
+
+            if close:
+                buffer, self._buffer = self._buffer, None
+                if buffer is not None:
+                    try:
+                        await self._flush_async(buffer)
+                    except Exception as exc:
+                        logger.error(
+                            "Exception occurred while flushing the buffer "
+                            "before closing the transport connection: {0}".format(exc)
+                        )
+                self._flushed.set()
+                return  # time to go home!
+
+            buffer = self._buffer
+            queue_size = 0 if buffer is None or buffer.fileobj is None else buffer.fileobj.tell()
+            since_last_flush = timeit.default_timer() - self._last_flush
+
+            if flush:
+                logger.debug("forced flush")
+            elif max_flush_time and since_last_flush >= max_flush_time:
+                logger.debug(
+                    "flushing due to time since last flush %.3fs > max_flush_time %.3fs",
+                    since_last_flush,
+                    max_flush_time,
+                )
+                flush = True
+            elif self._max_buffer_size and queue_size > self._max_buffer_size:
+                logger.debug(
+                    "flushing since queue size %d bytes > max_queue_size %d bytes", queue_size, self._max_buffer_size
+                )
+                flush = True
+            if flush:
+                self._buffer = None
+                if buffer is not None:
+                    await self._flush_async(buffer)
+                self._last_flush = timeit.default_timer()
+                max_flush_time = self._max_flush_time * random.uniform(0.9, 1.1) if self._max_flush_time else None
+                self._flushed.set()
+            elif batch:
+                # give other tasks a chance to run between two batches
+                await asyncio.sleep(0)
+
+    async def _flush_async(self, buffer):
+        fileobj = buffer.fileobj  # get a reference to the fileobj before closing the gzip file
+        buffer.close()
+        if not self.state.should_try():
+            logger.error("dropping flushed data due to transport failure back-off")
+            self._buffer_pool.recycle(fileobj)
+            return
+        try:
+            await self.send_async(self._get_payload(fileobj))
+            self.handle_transport_success()
+        except Exception as e:
+            self.handle_transport_fail(e)
+        self._buffer_pool.recycle(fileobj)
+
+    async def send_async(self, data):
+        """
+        Sends data to the APM Server without blocking the event loop, by running `send` in the executor
+        of the transport.
+
+        :param data: the compressed request body
+        :return: the Location header of the response, if any
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._executor, self.send, data)
+
+    def _flush_remaining(self):
+        """
+        Sends the events that are still queued, and the buffer of the task, from the calling thread.
+        This is only safe if the event loop of the task doesn't run anymore.
+        """
+        buffer, self._buffer = self._buffer, None
+        if self._metadata is None and self.client:
+            # the task never got to run
+            self._metadata = self.client.build_metadata()
+        while True:
+            batch = self._get_available_events(self._max_batch_size)
+            lines, _, close = self._encode_batch(batch)
+            if lines:
+                if buffer is None:
+                    buffer = self._init_buffer()
+                buffer.write(b"".join(lines))
+            if close or not batch:
+                break
+        if buffer is not None:
+            try:
+                self._flush(buffer)
+            except Exception as exc:
+                logger.error(
+                    "Exception occurred while flushing the buffer "
+                    "before closing the transport connection: {0}".format(exc)
+                )
+        self._flushed.set()
+
+    def flush(self):
+        """
+        Trigger a flush of the queue.
+
+        If called from within the event loop of the transport, this method returns immediately, as waiting would
+        block the loop. Otherwise, it only returns once the queue has been flushed.
+        """
+        self.queue(None, None, flush=True)
+        if _get_running_loop() is self._loop:
+            return
+        if not self._flushed.wait(timeout=self._max_flush_time):
+            raise ValueError("flush timed out")
+
+    def close(self):
+        """
+        Sends the remaining events and stops the event processing task.
+
+        If called from within the event loop of the transport, this method returns immediately, and the task
+        finishes in the background.
+        """
+        if self._closed or self._loop is None or self._loop_pid != os.getpid():
+            return
+        loop = self._loop
+        # mark the transport as closed first, so that queueing the close event doesn't start a new task
+        self._closed = True
+        self.queue("close", None)
+        if _get_running_loop() is loop:
+            return
+        if loop.is_closed() or not loop.is_running():
+            # e.g. at exit of the interpreter, after the application's event loop has been stopped.
+            # The task can't finish anymore, so whatever it left behind is sent from this thread.
+            self._flush_remaining()
+        elif not self._flushed.wait(timeout=self._max_flush_time):
+            logger.error("Closing the transport connection timed out.")
+        if self._loop_thread is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            self._loop_thread.join(self._max_flush_time)
+            self._loop_thread = None
+        self._executor.shutdown(wait=False)
+
+    stop_thread = close
+
+
+def _get_running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    except AttributeError:  # Python 3.6
+        return asyncio._get_running_loop()
@@ -31,14 +31,16 @@
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import gzip
+import itertools
 import os
 import random
 import sys
 import threading
 import time
 import timeit
-from collections import defaultdict
+from collections import defaultdict, deque
 
+from elasticapm.transport import spill
 from elasticapm.utils import compat, json_encoder
 from elasticapm.utils.logging import get_logger
 from elasticapm.utils.threading import ThreadManager
@@ -55,11 +57,14 @@ class Transport(ThreadManager):
 
     async_mode = False
 
+    # minimum time in seconds between two requests that replay spilled data
+    spill_replay_interval = 0.2
+
     def __init__(
         self,
         client,
         compress_level=5,
-        json_serializer=json_encoder.dumps,
+        json_serializer=json_encoder.dumps_bytes,
         queue_chill_count=500,
         queue_chill_time=1.0,
         processors=None,
@@ -69,7 +74,7 @@ class Transport(ThreadManager):
         Create a new Transport instance
 
         :param compress_level: GZip compress level. If zero, no GZip compression will be used
-        :param json_serializer: serializer to use for JSON encoding
+        :param json_serializer: serializer to use for JSON encoding. Can return either text or UTF-8 encoded bytes
         :param kwargs:
         """
         self.client = client
@@ -79,13 +84,33 @@ class Transport(ThreadManager):
         self._json_serializer = json_serializer
         self._queued_data = None
         self._event_queue = self._init_event_queue(chill_until=queue_chill_count, max_chill_time=queue_chill_time)
-        self._is_chilled_queue = isinstance(self._event_queue, ChilledQueue)
+        self._is_chilled_queue = isinstance(self._event_queue, (ChilledQueue, PerThreadQueue))
         self._thread = None
         self._last_flush = timeit.default_timer()
         self._counts = defaultdict(int)
         self._flushed = threading.Event()
         self._closed = False
         self._processors = processors if processors is not None else []
+        # the event processor thread handles events in batches of at most this size. As the
+        # (chilled) queue wakes up the thread once it holds `queue_chill_count` events, this is
+        # what a batch typically looks like under load. Each batch is written to the buffer at once.
+        self._max_batch_size = max(1, queue_chill_count or 1)
+        self._compression_time = 0.0
+        if self.client and self.client.config.adaptive_compression:
+            self._compression_controller = CompressionLevelController(max_level=self._compress_level)
+        else:
+            self._compression_controller = None
+        # if configured, compressed payloads are handed off to a pool of sender threads, so that
+        # a slow APM Server doesn't hold up the event processor thread
+        self._num_senders = max(0, self.client.config.api_request_senders) if self.client else 0
+        self._sender_queue = None
+        self._senders = []
+        # the processor thread, the hand-off and every sender can hold a buffer at the same time
+        self._buffer_pool = BufferPool(max_free=1 + 2 * self._num_senders)
+        # if configured, payloads that can't be sent are spilled to disk, and replayed later
+        self._spill_queue = None
+        self._spill_thread = None
+        self._spill_stop = threading.Event()
         super(Transport, self).__init__()
         self.start_stop_order = sys.maxsize  # ensure that the transport thread is always started/stopped last
 
@@ -111,8 +136,7 @@ class Transport(ThreadManager):
         if self.client:
             self._metadata = self.client.build_metadata()
 
-        buffer = self._init_buffer()
-        buffer_written = False
+        buffer = None
         # add some randomness to timeout to avoid stampedes of several workers that are booted at the same time
         max_flush_time = self._max_flush_time * random.uniform(0.9, 1.1) if self._max_flush_time else None
 
@@ -122,13 +146,24 @@ class Transport(ThreadManager):
             timeout = max(0, max_flush_time - since_last_flush) if max_flush_time else None
             timed_out = False
             try:
-                event_type, data, flush = self._event_queue.get(block=True, timeout=timeout)
+                batch = [self._event_queue.get(block=True, timeout=timeout)]
             except compat.queue.Empty:
-                event_type, data, flush = None, None, None
+                batch = []
                 timed_out = True
-
-            if event_type == "close":
-                if buffer_written:
+            if batch:
+                batch.extend(self._get_available_events(self._max_batch_size - 1))
+
+            lines, flush, close = self._encode_batch(batch)
+            if lines:
+                if buffer is None:
+                    # the buffer is only created once there is something to put in it
+                    buffer = self._init_buffer()
+                start = timeit.default_timer()
+                buffer.write(b"".join(lines))
+                self._compression_time += timeit.default_timer() - start
+
+            if close:
+                if buffer is not None:
                     try:
                         self._flush(buffer)
                     except Exception as exc:
@@ -136,18 +171,14 @@ class Transport(ThreadManager):
                             "Exception occurred while flushing the buffer "
                             "before closing the transport connection: {0}".format(exc)
                         )
+                self._stop_senders()
+                self._stop_spill_replay()
                 self._flushed.set()
                 return  # time to go home!
 
-            if data is not None:
-                data = self._process_event(event_type, data)
-                if data is not None:
-                    buffer.write((self._json_serializer({event_type: data}) + "\n").encode("utf-8"))
-                    buffer_written = True
-                    self._counts[event_type] += 1
-
-            queue_size = 0 if buffer.fileobj is None else buffer.fileobj.tell()
+            queue_size = 0 if buffer is None or buffer.fileobj is None else buffer.fileobj.tell()
 
+            forced_flush = flush
             if flush:
                 logger.debug("forced flush")
             elif timed_out or timeout == 0:
@@ -166,15 +197,66 @@ class Transport(ThreadManager):
                 )
                 flush = True
             if flush:
-                if buffer_written:
+                if buffer is not None:
                     self._flush(buffer)
+                if forced_flush and self._sender_queue is not None:
+                    # a forced flush only completes once all payloads have been sent
+                    self._sender_queue.join()
+                if self._compression_controller is not None:
+                    # the compression level is only ever changed between two buffers
+                    self._update_compress_level(timeit.default_timer() - self._last_flush)
                 self._last_flush = timeit.default_timer()
-                buffer = self._init_buffer()
-                buffer_written = False
+                buffer = None
                 max_flush_time = self._max_flush_time * random.uniform(0.9, 1.1) if self._max_flush_time else None
                 self._flushed.set()
 
+    def _encode_batch(self, batch):
+        """
+        Runs a batch of events through the processors and serializes them. Stops at a "close" event.
+
+        :param batch: a list of (event_type, data, flush) tuples
+        :return: a tuple of the list of encoded lines, and whether a flush resp. a close was requested
+        """
+        flush = close = False
+        lines = []
+        for event_type, data, event_flush in batch:
+            if event_type == "close":
+                close = True
+                break
+            if data is not None:
+                data = self._process_event(event_type, data)
+                if data is not None:
+                    lines.append(self._encode_event(event_type, data))
+                    self._counts[event_type] += 1
+            flush = flush or event_flush
+        return lines, flush, close
+
+    def _get_available_events(self, max_events):
+        """
+        Removes up to `max_events` events from the event queue without blocking
+        :return: a list of events
+        """
+        queue = self._event_queue
+        if self._is_chilled_queue:
+            return queue.get_many(max_events)
+        events = []
+        while len(events) < max_events:
+            try:
+                events.append(queue.get(block=False))
+            except compat.queue.Empty:
+                break
+        return events
+
     def _process_event(self, event_type, data):
+        if hasattr(data, "to_dict"):
+            # serialization of this event has been deferred to the event processor thread
+            try:
+                data = data.to_dict()
+            except Exception:
+                logger.warning(
+                    "Dropped event of type %s due to exception during serialization", event_type, exc_info=True
+                )
+                return None
         # Run the data through processors
         for processor in self._processors:
             if not hasattr(processor, "event_types") or event_type in processor.event_types:
@@ -199,13 +281,51 @@ class Transport(ThreadManager):
                     return None
         return data
 
-    def _init_buffer(self):
-        buffer = gzip.GzipFile(fileobj=compat.BytesIO(), mode="w", compresslevel=self._compress_level)
-        data = (self._json_serializer({"metadata": self._metadata}) + "\n").encode("utf-8")
-        buffer.write(data)
+    def _init_buffer(self, fileobj=None):
+        """
+        Create a new gzip buffer, with the metadata already written to it
+
+        :param fileobj: file-like object that receives the compressed data. Defaults to a pooled in-memory buffer
+        :return: a GzipFile object
+        """
+        if fileobj is None:
+            # leave some room for the last batch, which is written before the size limit is checked
+            fileobj = self._buffer_pool.acquire((self._max_buffer_size or 768 * 1024) + 64 * 1024)
+        buffer = gzip.GzipFile(fileobj=fileobj, mode="w", compresslevel=self._compress_level)
+        buffer.write(self._encode_event("metadata", self._metadata))
         return buffer
 
+    def _update_compress_level(self, elapsed):
+        """
+        Lets the compression level controller pick the level for the next buffer, based on the time
+        spent compressing since the last flush, and the current backlog of the event queue.
+
+        :param elapsed: seconds since the last flush
+        """
+        level = self._compression_controller.update(self._compression_time, elapsed, self._event_queue.qsize())
+        self._compression_time = 0.0
+        if level != self._compress_level:
+            logger.debug("changing compression level from %d to %d", self._compress_level, level)
+            self._compress_level = level
+            try:
+                metricset = self.client._metrics.get_metricset("elasticapm.metrics.sets.transport.TransportMetricSet")
+            except (AttributeError, LookupError):
+                return
+            metricset.counter("agent.transport.compression_level.changes", reset_on_collect=True).inc()
+
+    def _encode_event(self, event_type, data):
+        """
+        Serializes an event to a line of NDJSON
+        :return: UTF-8 encoded bytes
+        """
+        line = self._json_serializer({event_type: data})
+        if not isinstance(line, bytes):
+            line = line.encode("utf-8")
+        return line + b"\n"
+
     def _init_event_queue(self, chill_until, max_chill_time):
+        if self.client and self.client.config.per_thread_event_queue:
+            return PerThreadQueue(maxsize=10000, chill_until=chill_until, max_chill_time=max_chill_time)
         # some libraries like eventlet monkeypatch queue.Queue and switch out the implementation.
         # In those cases we can't rely on internals of queue.Queue to be there, so we simply use
         # their queue and forgo the optimizations of ChilledQueue. In the case of eventlet, this
@@ -227,24 +347,148 @@ class Transport(ThreadManager):
         Flush the queue. This method should only be called from the event processing queue
         :return: None
         """
-        if not self.state.should_try():
+        fileobj = buffer.fileobj  # get a reference to the fileobj before closing the gzip file
+        # the gzip file has to be closed even if the data is dropped, otherwise it writes its trailer
+        # into the pooled buffer whenever it is garbage collected
+        buffer.close()
+        backing_off = not self.state.should_try()
+        if backing_off and self._spill_queue is None:
             logger.error("dropping flushed data due to transport failure back-off")
+            self._buffer_pool.recycle(fileobj)
         else:
-            fileobj = buffer.fileobj  # get a reference to the fileobj before closing the gzip file
-            buffer.close()
+            if self._sender_queue is not None and not backing_off:
+                # blocks if all senders are busy and the hand-off is full
+                self._sender_queue.put(fileobj)
+                return
+            if backing_off:
+                self._spill(self._get_payload(fileobj))
+            else:
+                self._send_payload(self._get_payload(fileobj))
+            # the buffer is only reused once nothing references the payload anymore
+            self._buffer_pool.recycle(fileobj)
+
+    def _get_payload(self, fileobj):
+        # StringIO on Python 2 does not have getbuffer, so we need to fall back to getvalue
+        return fileobj.getbuffer() if hasattr(fileobj, "getbuffer") else fileobj.getvalue()
+
+    def _send_payload(self, data):
+        try:
+            self.send(data)
+            self.handle_transport_success()
+        except Exception as e:
+            self.handle_transport_fail(e)
+            if self._spill_queue is not None:
+                if is_retryable(e):
+                    self._spill(data)
+                else:
+                    logger.error("dropping flushed data, as the APM Server rejected it")
+
+    def _spill(self, data):
+        """
+        Stores a payload in the spill directory, to be sent once the APM Server is available again
+        """
+        if self._spill_queue is None:
+            logger.error("dropping flushed data due to transport failure back-off")
+            return
+        try:
+            self._spill_queue.append(data)
+            logger.info("spilled %d bytes of flushed data to %s", len(data), self._spill_queue.directory)
+        except (IOError, OSError) as e:
+            logger.error("dropping flushed data, as it could not be spilled to disk: %s", e)
+
+    def _start_spill_replay(self):
+        root = self.client.config.api_request_spill_dir
+        directory = os.path.join(root, str(os.getpid()))
+        try:
+            spill.adopt_orphaned_segments(root, directory)
+            self._spill_queue = spill.SpillQueue(directory, self.client.config.api_request_spill_max_size)
+        except (IOError, OSError) as e:
+            logger.error("Could not set up spill directory %s: %s", directory, e)
+            self._spill_queue = None
+            return
+        self._spill_stop.clear()
+        self._spill_thread = threading.Thread(target=self._replay_spilled, name="eapm spill replay thread")
+        self._spill_thread.daemon = True
+        self._spill_thread.start()
+
+    def _stop_spill_replay(self):
+        if self._spill_thread is None:
+            return
+        self._spill_stop.set()
+        self._spill_thread.join(self._max_flush_time)
+        self._spill_thread = None
+        self._spill_queue.close()
 
-            # StringIO on Python 2 does not have getbuffer, so we need to fall back to getvalue
-            data = fileobj.getbuffer() if hasattr(fileobj, "getbuffer") else fileobj.getvalue()
+    def _replay_spilled(self):
+        """
+        Sends spilled payloads in the order they were spilled, at most one every `spill_replay_interval`
+        seconds, while the APM Server is available. Runs in the spill replay thread.
+        """
+        while not self._spill_stop.wait(self.spill_replay_interval):
+            # while backing off, only regular requests check if the APM Server is available again
+            if self.state.did_fail():
+                continue
+            entry = self._spill_queue.peek()
+            if entry is None:
+                continue
+            token, data = entry
             try:
                 self.send(data)
-                self.handle_transport_success()
             except Exception as e:
-                self.handle_transport_fail(e)
+                if is_retryable(e):
+                    self.handle_transport_fail(e)
+                    continue
+                # sending it again won't help, move on to the next payload
+                logger.error("dropping spilled data, as the APM Server rejected it: %s", e)
+            self._spill_queue.commit(token)
+
+    def _run_sender(self):
+        """
+        Sends payloads from the hand-off queue until it receives `None`. Runs in the sender threads.
+        """
+        while True:
+            fileobj = self._sender_queue.get()
+            try:
+                if fileobj is None:
+                    return
+                # the back-off state is shared by all senders, check again as it may have changed in the meantime
+                if not self.state.should_try():
+                    self._spill(self._get_payload(fileobj))
+                else:
+                    self._send_payload(self._get_payload(fileobj))
+                self._buffer_pool.recycle(fileobj)
+            finally:
+                self._sender_queue.task_done()
+
+    def _start_senders(self):
+        self._sender_queue = compat.queue.Queue(maxsize=self._num_senders)
+        self._senders = []
+        for i in range(self._num_senders):
+            thread = threading.Thread(target=self._run_sender, name="eapm sender thread %d" % i)
+            thread.daemon = True
+            thread.start()
+            self._senders.append(thread)
+
+    def _stop_senders(self):
+        """
+        Lets the sender threads send the payloads that are still in the hand-off queue, and stops them
+        """
+        if self._sender_queue is None:
+            return
+        for _ in self._senders:
+            self._sender_queue.put(None)
+        for thread in self._senders:
+            thread.join(self._max_flush_time)
+        self._senders = []
 
     def start_thread(self, pid=None):
         super(Transport, self).start_thread(pid=pid)
         if (not self._thread or self.pid != self._thread.pid) and not self._closed:
             try:
+                if self._num_senders:
+                    self._start_senders()
+                if self.client and self.client.config.api_request_spill_dir:
+                    self._start_spill_replay()
                 self._thread = threading.Thread(target=self._process_queue, name="eapm event processor thread")
                 self._thread.daemon = True
                 self._thread.pid = self.pid
@@ -302,6 +546,141 @@ class Transport(ThreadManager):
 AsyncTransport = Transport
 
 
+def is_retryable(exception):
+    """
+    Checks if a payload whose request failed with `exception` could be accepted if it is sent again later.
+
+    This is the case for connection errors, server errors, and rate limiting. Other client errors, like an
+    invalid or too large payload, or a missing secret token, are permanent.
+    """
+    status = getattr(exception, "status", None)
+    return status is None or status == 429 or status >= 500
+
+
+class PooledBuffer(object):
+    """
+    A write-only file-like object backed by a reusable bytearray
+    """
+
+    __slots__ = ("_data", "_size", "_view")
+
+    def __init__(self, capacity):
+        self._data = bytearray(capacity)
+        self._size = 0
+        self._view = None
+
+    def write(self, data):
+        size = len(data)
+        end = self._size + size
+        # grows the bytearray if the data doesn't fit anymore
+        self._data[self._size : end] = data
+        self._size = end
+        return size
+
+    def tell(self):
+        return self._size
+
+    def flush(self):
+        pass
+
+    def getbuffer(self):
+        """
+        :return: a memoryview of the data written so far, without copying it
+        """
+        if self._view is None:
+            self._view = memoryview(self._data)[: self._size]
+        return self._view
+
+    def reset(self):
+        """
+        Prepares the buffer for reuse, if nothing references its data anymore.
+
+        :return: True if the buffer can be reused
+        """
+        view = self._view
+        if view is not None:
+            # references: the attribute, the local variable, and the argument of getrefcount
+            if not hasattr(sys, "getrefcount") or sys.getrefcount(view) > 3:
+                return False
+            self._view = None
+            view.release()
+        try:
+            # fails if there are still exports of the bytearray, e.g. slices of the memoryview. Shrinking first
+            # means that the bytearray is never reallocated
+            if self._data:
+                self._data.append(self._data.pop())
+        except BufferError:
+            return False
+        self._size = 0
+        return True
+
+
+class BufferPool(object):
+    """
+    A pool of PooledBuffer objects, to avoid allocating a new buffer for every request to the APM Server
+    """
+
+    def __init__(self, max_free=1):
+        self.max_free = max_free
+        self._free = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, capacity):
+        """
+        :param capacity: initial capacity in bytes of a new buffer. Buffers grow as needed.
+        :return: an empty PooledBuffer
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return PooledBuffer(capacity)
+
+    def recycle(self, buffer):
+        """
+        Returns a buffer to the pool. Buffers that are still referenced elsewhere are left to the garbage collector.
+        """
+        if not isinstance(buffer, PooledBuffer) or not buffer.reset():
+            return
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
+
+
+class CompressionLevelController(object):
+    """
+    Adapts the gzip compression level to the load of the event processor thread.
+
+    The level is lowered if the event queue backs up, or if compression used more than `cpu_budget`
+    of the time between two flushes. Once the backlog is gone and compression uses less than half of
+    the budget, the level is raised again step by step, up to `max_level`.
+    """
+
+    def __init__(self, max_level, cpu_budget=0.1, high_backlog=2000, low_backlog=500, step_down=2, step_up=1):
+        self.max_level = max_level
+        self.level = max_level
+        self.cpu_budget = cpu_budget
+        self.high_backlog = high_backlog
+        self.low_backlog = low_backlog
+        self.step_down = step_down
+        self.step_up = step_up
+
+    def update(self, compression_time, elapsed, backlog):
+        """
+        Calculates the compression level to use for the next buffer
+
+        :param compression_time: seconds spent compressing data since the last update
+        :param elapsed: seconds since the last update
+        :param backlog: number of events waiting in the event queue
+        :return: the new compression level
+        """
+        load = compression_time / elapsed if elapsed > 0 else 0.0
+        if backlog > self.high_backlog or load > self.cpu_budget:
+            self.level = max(0, self.level - self.step_down)
+        elif backlog < self.low_backlog and load < self.cpu_budget / 2:
+            self.level = min(self.max_level, self.level + self.step_up)
+        return self.level
+
+
 class TransportState(object):
     ONLINE = 1
     ERROR = 0
@@ -310,24 +689,29 @@ class TransportState(object):
         self.status = self.ONLINE
         self.last_check = None
         self.retry_number = -1
+        # the state can be shared by several sender threads
+        self._lock = threading.Lock()
 
     def should_try(self):
-        if self.status == self.ONLINE:
-            return True
+        with self._lock:
+            if self.status == self.ONLINE:
+                return True
 
-        interval = min(self.retry_number, 6) ** 2
+            interval = min(self.retry_number, 6) ** 2
 
-        return timeit.default_timer() - self.last_check > interval
+            return timeit.default_timer() - self.last_check > interval
 
     def set_fail(self):
-        self.status = self.ERROR
-        self.retry_number += 1
-        self.last_check = timeit.default_timer()
+        with self._lock:
+            self.status = self.ERROR
+            self.retry_number += 1
+            self.last_check = timeit.default_timer()
 
     def set_success(self):
-        self.status = self.ONLINE
-        self.last_check = None
-        self.retry_number = -1
+        with self._lock:
+            self.status = self.ONLINE
+            self.last_check = None
+            self.retry_number = -1
 
     def did_fail(self):
         return self.status == self.ERROR
@@ -384,3 +768,155 @@ class ChilledQueue(compat.queue.Queue, object):
             ):
                 self.not_empty.notify()
                 self._last_unchill = time.time()
+
+    def get_many(self, max_items):
+        """
+        Remove and return up to `max_items` of the oldest items from the queue, without blocking.
+
+        The lock is only acquired once, instead of once per item.
+        """
+        with self.not_empty:
+            count = min(max_items, self._qsize())
+            items = [self._get() for _ in range(count)]
+            if count:
+                self.not_full.notify(count)
+        return items
+
+
+class PerThreadQueue(object):
+    """
+    A queue that gives every producing thread its own bounded buffer. Producers never contend for a shared
+    lock, the consumer drains the buffers of all threads in one go.
+
+    Items that are drained together are returned in the order in which they were put into the queue,
+    across all threads.
+
+    Like ChilledQueue, it only wakes up a waiting consumer if `chill` is False, if the buffer of the producing
+    thread holds more than `chill_until` items, or if the consumer hasn't been woken up for `max_chill_time`
+    seconds. Note that `maxsize` and `chill_until` apply per thread.
+    """
+
+    def __init__(self, maxsize=0, chill_until=100, max_chill_time=1.0):
+        self.maxsize = maxsize
+        self._chill_until = chill_until
+        self._max_chill_time = max_chill_time
+        self._last_unchill = time.time()
+        self._local = threading.local()
+        self._buffers = []
+        self._buffers_lock = threading.Lock()
+        self._not_empty = threading.Event()
+        self._sequence = itertools.count()
+        self._pending = deque()
+        self._dropped = defaultdict(int)
+
+    def put(self, item, block=True, timeout=None, chill=True):
+        """
+        Put an item into the buffer of the current thread.
+
+        If the buffer is full, the item is dropped and the Full exception is raised. The
+        `block` and `timeout` arguments are only accepted for compatibility with queue.Queue.
+        """
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._register_thread()
+        if self.maxsize > 0 and len(buffer.items) >= self.maxsize:
+            buffer.dropped += 1
+            raise compat.queue.Full
+        # deque.append is atomic, and next() on itertools.count is thread-safe in CPython
+        buffer.items.append((next(self._sequence), item))
+        if (
+            not chill
+            or len(buffer.items) > self._chill_until
+            or (time.time() - self._last_unchill) > self._max_chill_time
+        ):
+            self._not_empty.set()
+            self._last_unchill = time.time()
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the oldest item from the queue.
+
+        If `block` is True, wait for at most `timeout` seconds (or indefinitely if `timeout` is None)
+        until an item is available, else raise the Empty exception.
+        """
+        if not self._pending:
+            endtime = time.time() + timeout if timeout is not None else None
+            while True:
+                self._not_empty.clear()
+                self._drain()
+                if self._pending:
+                    break
+                if not block:
+                    raise compat.queue.Empty
+                remaining = endtime - time.time() if endtime is not None else None
+                if remaining is not None and remaining <= 0.0:
+                    raise compat.queue.Empty
+                self._not_empty.wait(remaining)
+        return self._pending.popleft()[1]
+
+    def get_many(self, max_items):
+        """
+        Remove and return up to `max_items` of the oldest items from the queue, without blocking.
+        """
+        if len(self._pending) < max_items:
+            self._drain()
+        pending = self._pending
+        return [pending.popleft()[1] for _ in range(min(max_items, len(pending)))]
+
+    def qsize(self):
+        return len(self._pending) + sum(len(buffer.items) for buffer in self._buffers)
+
+    def empty(self):
+        return not self.qsize()
+
+    @property
+    def dropped(self):
+        """
+        Number of items that were dropped due to full buffers, per thread name
+        """
+        with self._buffers_lock:
+            dropped = self._dropped.copy()
+            for buffer in self._buffers:
+                dropped[buffer.thread_name] += buffer.dropped - buffer.dropped_reported
+        return {name: count for name, count in compat.iteritems(dropped) if count}
+
+    def _register_thread(self):
+        buffer = _ThreadBuffer(threading.current_thread())
+        self._local.buffer = buffer
+        with self._buffers_lock:
+            self._buffers.append(buffer)
+        return buffer
+
+    def _drain(self):
+        drained = []
+        runs = 0
+        with self._buffers_lock:
+            for buffer in self._buffers[:]:
+                # we only take as many items as we saw, more could be appended by the producer concurrently
+                count = len(buffer.items)
+                if count:
+                    runs += 1
+                    popleft = buffer.items.popleft
+                    drained.extend(popleft() for _ in range(count))
+                dropped = buffer.dropped - buffer.dropped_reported
+                if dropped:
+                    buffer.dropped_reported += dropped
+                    self._dropped[buffer.thread_name] += dropped
+                    logger.debug("%d events of thread %s dropped due to full event queue", dropped, buffer.thread_name)
+                if not buffer.thread.is_alive() and not buffer.items:
+                    self._buffers.remove(buffer)
+        if runs > 1:
+            # the buffers are sorted by themselves, so this is a cheap merge of sorted runs
+            drained.sort(key=lambda entry: entry[0])
+        self._pending.extend(drained)
+
+
+class _ThreadBuffer(object):
+    __slots__ = ("items", "thread", "thread_name", "dropped", "dropped_reported")
+
+    def __init__(self, thread):
+        self.items = deque()
+        self.thread = thread
+        self.thread_name = thread.name
+        self.dropped = 0
+        self.dropped_reported = 0
@@ -33,7 +33,9 @@
 
 
 class TransportException(Exception):
-    def __init__(self, message, data=None, print_trace=True):
+    def __init__(self, message, data=None, print_trace=True, status=None):
         super(TransportException, self).__init__(message)
         self.data = data
         self.print_trace = print_trace
+        # HTTP status code of the response, None if no response was received
+        self.status = status
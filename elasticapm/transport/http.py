@@ -34,6 +34,7 @@ import hashlib
 import json
 import re
 import ssl
+import threading
 
 import urllib3
 from urllib3.exceptions import MaxRetryError, TimeoutError
@@ -56,6 +57,9 @@ class Transport(HTTPTransportBase):
         super(Transport, self).__init__(url, *args, **kwargs)
         url_parts = compat.urlparse.urlparse(url)
         pool_kwargs = {"cert_reqs": "CERT_REQUIRED", "ca_certs": self.ca_certs, "block": True}
+        if self._num_senders > 1:
+            # allow one connection per sender thread
+            pool_kwargs["maxsize"] = self._num_senders
         if self._server_cert and url_parts.scheme != "http":
             pool_kwargs.update(
                 {"assert_fingerprint": self.cert_fingerprint, "assert_hostname": False, "cert_reqs": ssl.CERT_NONE}
@@ -71,7 +75,14 @@ class Transport(HTTPTransportBase):
         else:
             self.http = urllib3.PoolManager(**pool_kwargs)
 
-    def send(self, data):
+    def send(self, data, chunked=False):
+        """
+        Send data to the APM Server
+
+        :param data: the (compressed) request body. If `chunked` is True, this can be an iterable of bytes
+        :param chunked: use chunked transfer encoding for the request
+        :return: the Location header of the response, if any
+        """
         response = None
 
         headers = self._headers.copy() if self._headers else {}
@@ -84,9 +95,16 @@ class Transport(HTTPTransportBase):
         try:
             try:
                 response = self.http.urlopen(
-                    "POST", url, body=data, headers=headers, timeout=self._timeout, preload_content=False
+                    "POST",
+                    url,
+                    body=data,
+                    headers=headers,
+                    timeout=self._timeout,
+                    preload_content=False,
+                    chunked=chunked,
                 )
-                logger.debug("Sent request, url=%s size=%.2fkb status=%s", url, len(data) / 1024.0, response.status)
+                size = data.tell() if chunked else len(data)
+                logger.debug("Sent request, url=%s size=%.2fkb status=%s", url, size / 1024.0, response.status)
             except Exception as e:
                 print_trace = True
                 if isinstance(e, MaxRetryError) and isinstance(e.reason, TimeoutError):
@@ -107,7 +125,7 @@ class Transport(HTTPTransportBase):
                     message = "HTTP %s: " % response.status
                     print_trace = True
                 message += body.decode("utf8", errors="replace")
-                raise TransportException(message, data, print_trace=print_trace)
+                raise TransportException(message, data, print_trace=print_trace, status=response.status)
             return response.getheader("Location")
         finally:
             if response:
@@ -129,7 +147,7 @@ class Transport(HTTPTransportBase):
                  Any element of the tuple can be None.
         """
         url = self._config_url
-        data = json_encoder.dumps(keys).encode("utf-8")
+        data = json_encoder.dumps_bytes(keys)
         headers = self._headers.copy()
         headers[b"Content-Type"] = "application/json"
         headers.pop(b"Content-Encoding", None)  # remove gzip content-encoding header
@@ -173,6 +191,28 @@ class Transport(HTTPTransportBase):
             self.fetch_server_info()
         super()._process_queue()
 
+    def _init_buffer(self, fileobj=None):
+        if (
+            fileobj is None
+            and self.client
+            and self.client.config.api_request_streaming
+            # while backing off, we don't even try to open a request
+            and self.state.should_try()
+        ):
+            fileobj = ChunkedRequestStream(self.send, timeout=self._timeout)
+        return super(Transport, self)._init_buffer(fileobj=fileobj)
+
+    def _flush(self, buffer):
+        stream = buffer.fileobj
+        if not isinstance(stream, ChunkedRequestStream):
+            return super(Transport, self)._flush(buffer)
+        buffer.close()
+        try:
+            stream.finish()
+            self.handle_transport_success()
+        except Exception as e:
+            self.handle_transport_fail(e)
+
     def fetch_server_info(self):
         headers = self._headers.copy() if self._headers else {}
         headers.update(self.auth_headers)
@@ -215,6 +255,102 @@ class Transport(HTTPTransportBase):
         return certifi.where() if (certifi and self.client.config.use_certifi) else None
 
 
+class ChunkedRequestStream(object):
+    """
+    A write-only file-like object that streams everything written to it as the body of
+    a chunked HTTP request. The request is started on a separate thread with the first write,
+    and is completed by calling `finish()`.
+
+    At most `max_pending_chunks` chunks are held in memory. If the request doesn't keep up,
+    writes block for at most `timeout` seconds, after which the request is aborted.
+    """
+
+    _END = object()
+
+    def __init__(self, send_func, timeout=None, max_pending_chunks=16):
+        self._send_func = send_func
+        self._timeout = timeout
+        self._chunks = compat.queue.Queue(maxsize=max_pending_chunks)
+        self._size = 0
+        self._thread = None
+        self._result = None
+        self._exception = None
+        self._aborted = False
+
+    def write(self, data):
+        size = len(data)
+        if size and not self._aborted:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="eapm streaming request")
+                self._thread.daemon = True
+                self._thread.start()
+            try:
+                self._chunks.put(bytes(data), timeout=self._timeout)
+            except compat.queue.Full:
+                self.abort(TransportException("Timed out while streaming data to APM Server"))
+        self._size += size
+        return size
+
+    def tell(self):
+        return self._size
+
+    def flush(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if self._aborted:
+                raise self._exception or TransportException("Streaming request aborted")
+            if chunk is self._END:
+                return
+            yield chunk
+
+    def abort(self, exception=None):
+        if not self._aborted:
+            self._exception = exception
+            self._aborted = True
+        try:
+            # wake up the request thread if it is waiting for data
+            self._chunks.put_nowait(self._END)
+        except compat.queue.Full:
+            pass
+
+    def finish(self):
+        """
+        Ends the request body and waits for the request to complete.
+
+        :return: the return value of the send function
+        :raises: any exception raised while sending the request
+        """
+        if self._thread is None:
+            return None
+        if not self._aborted:
+            try:
+                self._chunks.put(self._END, timeout=self._timeout)
+            except compat.queue.Full:
+                self.abort(TransportException("Timed out while streaming data to APM Server"))
+        self._thread.join(self._timeout)
+        if self._thread.is_alive():
+            self.abort()
+            raise TransportException("Timed out waiting for response of streaming request to APM Server")
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def _run(self):
+        try:
+            self._result = self._send_func(self, chunked=True)
+        except Exception as e:
+            self.abort(e)
+            # drain the queue to unblock writers that wait for a free slot
+            while True:
+                try:
+                    self._chunks.get_nowait()
+                except compat.queue.Empty:
+                    break
+
+
 def version_string_to_tuple(version):
     if version:
         version_parts = re.split(r"[.\-]", version)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import itertools
+import os
+import struct
+import threading
+import time
+
+from elasticapm.utils.logging import get_logger
+
+logger = get_logger("elasticapm.transport.spill")
+
+
+class SpillQueue(object):
+    """
+    Stores compressed payloads in size-capped segment files in a directory, so they can be sent to the
+    APM Server later.
+
+    Payloads are appended to the current segment as length-prefixed records. Once a segment reaches
+    `segment_size`, a new one is started. If all segments together exceed `max_size`, the oldest segments
+    are deleted. Payloads are read back in the order they were written, including payloads of segments
+    that were already in the directory when the queue was created.
+    """
+
+    _header = struct.Struct(">I")
+
+    def __init__(self, directory, max_size, segment_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = segment_size or max(1, max_size // 10)
+        self._lock = threading.Lock()
+        self._segments = []  # paths of the segment files, oldest first
+        self._sizes = {}
+        self._current = None  # file object of the segment that payloads are appended to
+        self._current_path = None
+        self._read_offset = 0  # position of the next payload to read in the oldest segment
+        self._sequence = itertools.count()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".spill"):
+                path = os.path.join(directory, name)
+                self._segments.append(path)
+                self._sizes[path] = os.path.getsize(path)
+        with self._lock:
+            self._evict()
+
+    @property
+    def size(self):
+        """
+        Total size of all segments in bytes
+        """
+        return sum(self._sizes.values())
+
+    def append(self, payload):
+        """
+        Appends a payload to the current segment
+
+        :param payload: bytes-like object
+        """
+        payload = bytes(payload)
+        record = self._header.pack(len(payload)) + payload
+        with self._lock:
+            if self._current is None or (
+                self._sizes[self._current_path] and self._sizes[self._current_path] + len(record) > self.segment_size
+            ):
+                self._start_segment()
+            self._current.write(record)
+            self._current.flush()
+            self._sizes[self._current_path] += len(record)
+            self._evict()
+
+    def peek(self):
+        """
+        Reads the oldest payload that hasn't been committed yet
+
+        :return: a tuple of a token that is passed to `commit()` once the payload has been sent, and the payload.
+                 None, if there are no payloads.
+        """
+        with self._lock:
+            while self._segments:
+                path = self._segments[0]
+                if self._read_offset >= self._sizes[path]:
+                    # all payloads of this segment have been replayed
+                    self._remove(path)
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        f.seek(self._read_offset)
+                        header = f.read(self._header.size)
+                        length = self._header.unpack(header)[0] if len(header) == self._header.size else -1
+                        payload = f.read(length) if length >= 0 else b""
+                except (IOError, OSError) as e:
+                    logger.warning("Could not read spilled data from %s: %s", path, e)
+                    self._remove(path)
+                    continue
+                if len(payload) != length:
+                    # truncated record, e.g. because the process was killed while writing it
+                    logger.warning("Skipping truncated spilled data in %s", path)
+                    self._remove(path)
+                    continue
+                return (path, self._read_offset, self._read_offset + self._header.size + length), payload
+            return None
+
+    def commit(self, token):
+        """
+        Marks the payload returned together with `token` by `peek()` as sent
+        """
+        path, offset, next_offset = token
+        with self._lock:
+            # the segment might have been evicted in the meantime
+            if self._segments and self._segments[0] == path and self._read_offset == offset:
+                self._read_offset = next_offset
+
+    def close(self):
+        with self._lock:
+            if self._current is not None:
+                self._current.close()
+                self._current = self._current_path = None
+
+    def _start_segment(self):
+        if self._current is not None:
+            self._current.close()
+        # the timestamp prefix keeps segments of different processes in order when they are adopted
+        name = "%016d-%d-%06d.spill" % (int(time.time() * 1000000), os.getpid(), next(self._sequence))
+        self._current_path = os.path.join(self.directory, name)
+        self._current = open(self._current_path, "ab")
+        self._segments.append(self._current_path)
+        self._sizes[self._current_path] = 0
+
+    def _evict(self):
+        while self._segments and self.size > self.max_size:
+            path = self._segments[0]
+            logger.warning(
+                "Deleting spilled data in %s, as the spill directory exceeds its size limit of %d bytes",
+                path,
+                self.max_size,
+            )
+            self._remove(path)
+
+    def _remove(self, path):
+        if path == self._current_path:
+            self._current.close()
+            self._current = self._current_path = None
+        if self._segments[0] == path:
+            self._read_offset = 0
+        self._segments.remove(path)
+        del self._sizes[path]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def adopt_orphaned_segments(root, directory):
+    """
+    Moves the segments of processes that are no longer running to `directory`.
+
+    Every process spills to its own subdirectory of `root`, named after its PID.
+
+    :param root: the spill directory
+    :param directory: the subdirectory of the current process
+    """
+    if os.name == "nt" or not os.path.isdir(root):
+        # os.kill() can't be used to check if a process is running on Windows
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.isdigit() or path == directory or not os.path.isdir(path) or _is_running(int(name)):
+            continue
+        for segment in os.listdir(path):
+            if segment.endswith(".spill"):
+                try:
+                    os.rename(os.path.join(path, segment), os.path.join(directory, segment))
+                except OSError:
+                    # another process adopted it first
+                    pass
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -31,7 +31,8 @@
 import base64
 import os
 import re
-from functools import partial
+import warnings
+from functools import lru_cache, partial
 
 from elasticapm.conf import constants
 from elasticapm.utils import compat, encoding
@@ -193,3 +194,62 @@ def starmatch_to_regex(pattern):
         else:
             res.append(re.escape(c))
     return re.compile(r"(?:%s)\Z" % "".join(res), options)
+
+
+_INLINE_FLAGS = ((re.ASCII, "a"), (re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x"))
+
+# numbered and named backreferences, as well as conditional references like (?(1)a|b), refer to groups of
+# the individual pattern, and can't be combined
+_BACKREFERENCE_RE = re.compile(r"\\\d|\(\?P=|\(\?\(")
+
+
+def combine_regexes(patterns):
+    """
+    Combines a list of compiled regular expressions into a single alternation. The flags of each pattern are
+    retained as scoped inline flags.
+
+    :param patterns: a list of compiled regular expressions
+    :return: the combined regular expression, or None if the patterns can't be combined
+    """
+    parts = []
+    for pattern in patterns:
+        if not isinstance(pattern.pattern, compat.text_type) or _BACKREFERENCE_RE.search(pattern.pattern):
+            return None
+        flags = "".join(flag for value, flag in _INLINE_FLAGS if pattern.flags & value)
+        parts.append("(?%s:%s)" % (flags, pattern.pattern))
+    try:
+        with warnings.catch_warnings():
+            # global inline flags in the middle of a pattern are deprecated
+            warnings.simplefilter("error")
+            return re.compile("|".join(parts))
+    except (re.error, DeprecationWarning):
+        return None
+
+
+class RegexListMatcher(object):
+    """
+    Checks if a string matches any of a list of compiled regular expressions.
+
+    The patterns are combined into a single regular expression where possible,
+    and the results for recently checked strings are cached.
+    """
+
+    def __init__(self, patterns, method="search", cache_size=1024):
+        """
+        :param patterns: a list of compiled regular expressions
+        :param method: the method used for matching, either "search" or "match"
+        :param cache_size: the maximum number of cached results
+        """
+        self.patterns = patterns
+        combined = combine_regexes(patterns) if len(patterns) > 1 else None
+        if combined is not None:
+            self._methods = [getattr(combined, method)]
+        else:
+            self._methods = [getattr(pattern, method) for pattern in patterns]
+        self.matches = lru_cache(cache_size)(self._matches)
+
+    def _matches(self, value):
+        for method in self._methods:
+            if method(value):
+                return True
+        return False
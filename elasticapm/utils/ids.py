@@ -0,0 +1,98 @@
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Random hex IDs for traces, transactions, spans and errors.
+
+IDs are generated from `os.urandom` in batches, which are hex-encoded in bulk. IDs are sliced off the current
+batch by the `__next__` method of a `map` iterator. As this happens in C, taking an ID is atomic under the GIL,
+and the batches can be shared between threads without locking. Batches are discarded in forked child processes,
+so parent and child never hand out the same IDs.
+"""
+
+import binascii
+import os
+
+BATCH_SIZE = 256
+
+_SLICES_64 = [slice(i, i + 16) for i in range(0, 16 * BATCH_SIZE, 16)]
+_SLICES_128 = [slice(i, i + 32) for i in range(0, 32 * BATCH_SIZE, 32)]
+
+# without os.register_at_fork (Python 3.6), the process ID has to be checked on every call
+_check_pid = not hasattr(os, "register_at_fork")
+
+_exhausted = iter(()).__next__
+_next_64 = _next_128 = _exhausted
+_pid = os.getpid()
+
+
+def _batch(num_bytes, slices):
+    encoded = binascii.hexlify(os.urandom(num_bytes * len(slices))).decode("ascii")
+    return map(encoded.__getitem__, slices).__next__
+
+
+def hex_id_64():
+    """
+    :return: a random 64 bit ID as 16 hex characters, used for transactions and spans
+    """
+    global _next_64
+    if _check_pid and _pid != os.getpid():
+        _reset()
+    try:
+        return _next_64()
+    except StopIteration:
+        # if several threads run out at the same time, each of them starts a new batch, which is wasteful but safe
+        _next_64 = _batch(8, _SLICES_64)
+        return _next_64()
+
+
+def hex_id_128():
+    """
+    :return: a random 128 bit ID as 32 hex characters, used for traces and errors
+    """
+    global _next_128
+    if _check_pid and _pid != os.getpid():
+        _reset()
+    try:
+        return _next_128()
+    except StopIteration:
+        _next_128 = _batch(16, _SLICES_128)
+        return _next_128()
+
+
+def _reset():
+    global _next_64, _next_128, _pid
+    _next_64 = _next_128 = _exhausted
+    _pid = os.getpid()
+
+
+if not _check_pid:
+    os.register_at_fork(after_in_child=_reset)
@@ -38,6 +38,11 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class BetterJSONEncoder(json.JSONEncoder):
     ENCODERS = {
@@ -63,5 +68,38 @@ def dumps(value, **kwargs):
     return json.dumps(value, cls=BetterJSONEncoder, **kwargs)
 
 
+def _orjson_default(obj):
+    if type(obj) in BetterJSONEncoder.ENCODERS:
+        return BetterJSONEncoder.ENCODERS[type(obj)](obj)
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+if orjson is not None:
+    # datetime objects are passed through to the default function to get the same format as with the standard library
+    # orjson serializes UUID objects natively, in their canonical form with dashes instead of the hex form that
+    # BetterJSONEncoder uses. There is no option to pass them through to the default function.
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps_bytes(value):
+        """
+        Serializes `value` to UTF-8 encoded JSON, using orjson.
+        """
+        try:
+            result = orjson.dumps(value, default=_orjson_default, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # orjson is stricter than the standard library in some cases, e.g. integers that exceed 64 bit
+            return dumps(value).encode("utf-8")
+        return result
+
+
+else:
+
+    def dumps_bytes(value):
+        """
+        Serializes `value` to UTF-8 encoded JSON, using the standard library.
+        """
+        return dumps(value).encode("utf-8")
+
+
 def loads(value, **kwargs):
     return json.loads(value, object_hook=better_decoder)
@@ -372,6 +372,19 @@ def test_ignore_patterns_with_none_transaction_name(elasticapm_client):
     assert t.name == ""
 
 
+def test_ignore_patterns_updated_by_config(elasticapm_client):
+    elasticapm_client.begin_transaction("web")
+    elasticapm_client.end_transaction("OPTIONS views.healthcheck", 200)
+    elasticapm_client.config.update(1, transactions_ignore_patterns="^OPTIONS,views.api.v2")
+    elasticapm_client.begin_transaction("web")
+    elasticapm_client.end_transaction("OPTIONS views.healthcheck", 200)
+    elasticapm_client.config.update(2, transactions_ignore_patterns="views.api.v2")
+    elasticapm_client.begin_transaction("web")
+    elasticapm_client.end_transaction("OPTIONS views.healthcheck", 200)
+
+    assert len(elasticapm_client.events[TRANSACTION]) == 2
+
+
 @pytest.mark.parametrize(
     "setting,url,result",
     [
@@ -389,6 +402,16 @@ def test_ignore_patterns_with_none_transaction_name(elasticapm_client):
 def test_should_ignore_url(elasticapm_client, setting, url, result):
     elasticapm_client.config.update(1, transaction_ignore_urls=setting)
     assert elasticapm_client.should_ignore_url(url) is result
+    # cached result
+    assert elasticapm_client.should_ignore_url(url) is result
+
+
+def test_should_ignore_url_updated_by_config(elasticapm_client):
+    elasticapm_client.config.update(1, transaction_ignore_urls="/foo*")
+    assert elasticapm_client.should_ignore_url("/foo/bar")
+    elasticapm_client.config.update(2, transaction_ignore_urls="/bar*")
+    assert not elasticapm_client.should_ignore_url("/foo/bar")
+    assert elasticapm_client.should_ignore_url("/bar/foo")
 
 
 @pytest.mark.parametrize("sending_elasticapm_client", [{"disable_send": True}], indirect=True)
@@ -504,7 +527,7 @@ def test_transaction_sampling(elasticapm_client, not_so_random):
         spans_per_transaction[span["transaction_id"]].append(span)
 
     # seed is fixed by not_so_random fixture
-    assert len([t for t in transactions if t["sampled"]]) == 3
+    assert len([t for t in transactions if t["sampled"]]) == 5
     for transaction in transactions:
         assert transaction["sampled"] or not transaction["id"] in spans_per_transaction
         assert transaction["sampled"] or not "context" in transaction
@@ -525,7 +548,7 @@ def test_transaction_sample_rate_dynamic(elasticapm_client, not_so_random):
         spans_per_transaction[span["transaction_id"]].append(span)
 
     # seed is fixed by not_so_random fixture
-    assert len([t for t in transactions if t["sampled"]]) == 3
+    assert len([t for t in transactions if t["sampled"]]) == 5
     for transaction in transactions:
         assert transaction["sampled"] or not transaction["id"] in spans_per_transaction
         assert transaction["sampled"] or not "context" in transaction
@@ -540,7 +563,7 @@ def test_transaction_sample_rate_dynamic(elasticapm_client, not_so_random):
     transactions = elasticapm_client.events[TRANSACTION]
 
     # seed is fixed by not_so_random fixture
-    assert len([t for t in transactions if t["sampled"]]) == 8
+    assert len([t for t in transactions if t["sampled"]]) == 10
 
 
 @pytest.mark.parametrize("elasticapm_client", [{"transaction_max_spans": 5}], indirect=True)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import pytest
+
+import elasticapm
+from elasticapm.conf import constants
+from elasticapm.conf.constants import SPAN, TRANSACTION
+
+
+def exit_span(resource, start, duration, **kwargs):
+    return elasticapm.capture_span(
+        "GET",
+        span_type="db",
+        span_subtype=resource,
+        extra={"destination": {"service": {"name": resource, "resource": resource, "type": "db"}}},
+        leaf=True,
+        start=start,
+        duration=duration,
+        **kwargs
+    )
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"exit_span_min_duration": "1ms"}], indirect=True)
+def test_fast_exit_spans_are_dropped(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    with exit_span("redis", start=1, duration=0.0005):
+        pass
+    with exit_span("redis", start=1.01, duration=0.0002):
+        pass
+    with exit_span("redis", start=1.02, duration=0.002):
+        pass
+    with pytest.raises(ValueError):
+        with exit_span("memcached", start=1.03, duration=0.0001):
+            raise ValueError()
+    with exit_span("memcached", start=1.04, duration=0.0003):
+        pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    spans = elasticapm_client.events[SPAN]
+    assert [(span["subtype"], span["outcome"]) for span in spans] == [("redis", "success"), ("memcached", "failure")]
+    transaction = elasticapm_client.events[TRANSACTION][0]
+    assert transaction["span_count"] == {"started": 2, "dropped": 3}
+    assert sorted(transaction["dropped_spans_stats"], key=lambda s: s["destination_service_resource"]) == [
+        {
+            "destination_service_resource": "memcached",
+            "outcome": "success",
+            "duration": {"count": 1, "sum": {"us": 300}},
+        },
+        {"destination_service_resource": "redis", "outcome": "success", "duration": {"count": 2, "sum": {"us": 700}}},
+    ]
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"exit_span_min_duration": "1ms"}], indirect=True)
+def test_non_exit_and_propagated_spans_are_not_dropped(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    with elasticapm.capture_span("internal", start=1, duration=0.0001):
+        pass
+    with exit_span("http", start=1.01, duration=0.0001) as span:
+        span.dist_tracing_propagated = True
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    assert len(elasticapm_client.events[SPAN]) == 2
+    assert "dropped_spans_stats" not in elasticapm_client.events[TRANSACTION][0]
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client", [{"exit_span_min_duration": "10ms", "span_compression_enabled": True}], indirect=True
+)
+def test_dropped_composite_span(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    with elasticapm.capture_span("internal", start=1, duration=0.02):
+        pass
+    for i in range(3):
+        with exit_span("redis", start=1.1 + i * 0.001, duration=0.0005):
+            pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    assert [span["name"] for span in elasticapm_client.events[SPAN]] == ["internal"]
+    transaction = elasticapm_client.events[TRANSACTION][0]
+    # the composite span counts as all the spans that have been compressed into it
+    assert transaction["span_count"] == {"started": 1, "dropped": 3}
+    assert transaction["dropped_spans_stats"] == [
+        {"destination_service_resource": "redis", "outcome": "success", "duration": {"count": 3, "sum": {"us": 1500}}}
+    ]
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"exit_span_min_duration": "1ms"}], indirect=True)
+def test_dropped_spans_stats_limit(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    for i in range(constants.DROPPED_SPANS_STATS_LIMIT + 10):
+        with exit_span("redis%d" % i, start=1 + i * 0.001, duration=0.0001):
+            pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    transaction = elasticapm_client.events[TRANSACTION][0]
+    assert transaction["span_count"]["dropped"] == constants.DROPPED_SPANS_STATS_LIMIT + 10
+    assert len(transaction["dropped_spans_stats"]) == constants.DROPPED_SPANS_STATS_LIMIT
+
+
+def test_exit_spans_not_dropped_by_default(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    with exit_span("redis", start=1, duration=0.0001):
+        pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    assert len(elasticapm_client.events[SPAN]) == 1
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import mock
+import pytest
+
+from elasticapm.conf import constants
+from elasticapm.conf.constants import TRANSACTION
+from elasticapm.sampling import SampleRateController
+
+
+@pytest.fixture()
+def clock():
+    with mock.patch("elasticapm.sampling._time_func") as time_func:
+        time_func.return_value = 0.0
+        yield time_func
+
+
+def run_window(controller, counts, clock, max_rate=1.0):
+    """Starts the given number of transactions per type, and returns the rates of the last ones"""
+    rates = {}
+    for transaction_type, count in counts.items():
+        for _ in range(count):
+            rates[transaction_type] = controller.sample_rate(transaction_type, max_rate)
+    clock.return_value += controller.interval
+    return rates
+
+
+def test_full_rate_until_first_measurement(clock):
+    controller = SampleRateController(mock.Mock(sampled_transactions_per_minute=60, transaction_sample_rate_min=0.0001))
+    assert run_window(controller, {"request": 1000}, clock) == {"request": 1.0}
+    # 1000 transactions in 10 seconds are 6000 per minute
+    assert controller.sample_rate("request", 1.0) == 0.01
+
+
+def test_budget_is_split_fairly(clock):
+    controller = SampleRateController(
+        mock.Mock(sampled_transactions_per_minute=600, transaction_sample_rate_min=0.0001)
+    )
+    # 60, 600 and 6000 transactions per minute
+    run_window(controller, {"celery": 10, "request": 100, "other": 1000}, clock)
+    rates = run_window(controller, {"celery": 10, "request": 100, "other": 1000}, clock)
+    # celery is sampled fully, the remaining budget of 540 is split between request and other
+    assert rates == {"celery": 1.0, "request": 0.45, "other": 0.045}
+
+
+def test_minimum_and_maximum_rate(clock):
+    controller = SampleRateController(mock.Mock(sampled_transactions_per_minute=60, transaction_sample_rate_min=0.1))
+    run_window(controller, {"request": 1000, "celery": 1}, clock)
+    assert controller.sample_rate("request", 1.0) == 0.1
+    assert controller.sample_rate("celery", 0.5) == 0.5
+
+
+def test_throughput_is_smoothed(clock):
+    controller = SampleRateController(mock.Mock(sampled_transactions_per_minute=60, transaction_sample_rate_min=0.0001))
+    run_window(controller, {"request": 100}, clock)
+    run_window(controller, {"request": 0}, clock)
+    # smoothed throughput is 300 per minute
+    assert controller.sample_rate("request", 1.0) == 0.2
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"sampled_transactions_per_minute": 60}], indirect=True)
+def test_effective_rate_is_propagated(elasticapm_client, clock):
+    controller = elasticapm_client.tracer.sample_rate_controller
+    run_window(controller, {"request": 100}, clock)
+    with mock.patch("elasticapm.traces.random.random", return_value=0.05):
+        transaction = elasticapm_client.begin_transaction("request")
+        elasticapm_client.end_transaction("test", "OK")
+        assert transaction.is_sampled
+        assert transaction.trace_parent.tracestate_dict[constants.TRACESTATE.SAMPLE_RATE] == "0.1"
+        assert elasticapm_client.events[TRANSACTION][0]["sample_rate"] == 0.1
+    with mock.patch("elasticapm.traces.random.random", return_value=0.5):
+        transaction = elasticapm_client.begin_transaction("request")
+        elasticapm_client.end_transaction("test", "OK")
+        assert not transaction.is_sampled
+        assert transaction.trace_parent.tracestate_dict[constants.TRACESTATE.SAMPLE_RATE] == "0"
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import pytest
+
+import elasticapm
+from elasticapm.conf.constants import SPAN, TRANSACTION
+
+destination = {"service": {"name": "postgresql", "resource": "postgresql", "type": "db"}}
+
+
+def db_span(name, start, duration=0.002, **kwargs):
+    return elasticapm.capture_span(
+        name,
+        span_type="db",
+        span_subtype="postgresql",
+        span_action="query",
+        extra={"destination": destination},
+        leaf=True,
+        start=start,
+        duration=duration,
+        **kwargs
+    )
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"span_compression_enabled": True}], indirect=True)
+def test_exact_match(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    for i in range(5):
+        with db_span("SELECT FROM users", start=1 + i * 0.01):
+            pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    spans = elasticapm_client.events[SPAN]
+    assert len(spans) == 1
+    span = spans[0]
+    assert span["name"] == "SELECT FROM users"
+    assert span["composite"] == {"compression_strategy": "exact_match", "count": 5, "sum": pytest.approx(10)}
+    # from the start of the first span to the end of the last span
+    assert span["duration"] == pytest.approx(42)
+    assert elasticapm_client.events[TRANSACTION][0]["span_count"]["started"] == 1
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [{"span_compression_enabled": True, "span_compression_same_kind_max_duration": "5ms"}],
+    indirect=True,
+)
+def test_same_kind(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    for i in range(3):
+        with db_span("SELECT FROM table%d" % i, start=1 + i * 0.01):
+            pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    spans = elasticapm_client.events[SPAN]
+    assert len(spans) == 1
+    assert spans[0]["name"] == "Calls to postgresql"
+    assert spans[0]["composite"]["compression_strategy"] == "same_kind"
+    assert spans[0]["composite"]["count"] == 3
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"span_compression_enabled": True}], indirect=True)
+def test_different_names_are_not_compressed_by_default(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    with db_span("SELECT FROM users", start=1):
+        pass
+    with db_span("SELECT FROM groups", start=1.01):
+        pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    spans = elasticapm_client.events[SPAN]
+    assert [span["name"] for span in spans] == ["SELECT FROM users", "SELECT FROM groups"]
+    assert not any("composite" in span for span in spans)
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"span_compression_enabled": True}], indirect=True)
+def test_slow_span_ends_composite(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    with db_span("SELECT FROM users", start=1):
+        pass
+    with db_span("SELECT FROM users", start=1.01):
+        pass
+    with db_span("SELECT FROM users", start=1.02, duration=0.1):
+        pass
+    with db_span("SELECT FROM users", start=1.2):
+        pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    spans = elasticapm_client.events[SPAN]
+    assert len(spans) == 3
+    assert spans[0]["composite"]["count"] == 2
+    assert "composite" not in spans[1]
+    assert "composite" not in spans[2]
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"span_compression_enabled": True}], indirect=True)
+def test_ineligible_spans_are_not_compressed(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    with db_span("SELECT FROM users", start=1):
+        pass
+    with db_span("SELECT FROM users", start=1.01) as span:
+        span.outcome = "failure"
+    with db_span("SELECT FROM users", start=1.02) as span:
+        span.dist_tracing_propagated = True
+    with elasticapm.capture_span(
+        "SELECT FROM users", span_type="db", span_subtype="postgresql", start=1.03, duration=0.002
+    ):
+        # not a leaf span
+        pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    assert len(elasticapm_client.events[SPAN]) == 4
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"span_compression_enabled": True}], indirect=True)
+def test_buffered_span_is_reported_when_parent_ends(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    with elasticapm.capture_span("parent", start=1, duration=1):
+        with db_span("SELECT FROM users", start=1.1):
+            pass
+        with db_span("SELECT FROM users", start=1.2):
+            pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    spans = elasticapm_client.events[SPAN]
+    assert [span["name"] for span in spans] == ["SELECT FROM users", "parent"]
+    assert spans[0]["composite"]["count"] == 2
+    assert spans[0]["parent_id"] == spans[1]["id"]
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client", [{"span_compression_enabled": True, "transaction_max_spans": 3}], indirect=True
+)
+def test_compressed_spans_dont_count_towards_max_spans(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    for i in range(10):
+        with db_span("SELECT FROM users", start=1 + i * 0.01):
+            pass
+    with elasticapm.capture_span("other", start=1.5, duration=0.01):
+        pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    spans = elasticapm_client.events[SPAN]
+    assert [span["name"] for span in spans] == ["SELECT FROM users", "other"]
+    assert elasticapm_client.events[TRANSACTION][0]["span_count"] == {"started": 2, "dropped": 0}
+
+
+def test_span_compression_disabled(elasticapm_client):
+    elasticapm_client.begin_transaction("test", start=1)
+    for i in range(3):
+        with db_span("SELECT FROM users", start=1 + i * 0.01):
+            pass
+    elasticapm_client.end_transaction("test", "OK", duration=1)
+    assert len(elasticapm_client.events[SPAN]) == 3
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import elasticapm
+from elasticapm.conf.constants import SPAN, TRANSACTION
+from elasticapm.contrib.asyncio.traces import async_capture_span
+from elasticapm.traces import DroppedSpan, execution_context
+
+
+def test_explicit_parent_does_not_change_active_span(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("test")
+    with elasticapm.capture_span("active") as active:
+        span = transaction.begin_span("detached", "test", parent=transaction)
+        assert execution_context.get_span() is active
+        transaction.end_span(span=span, outcome="success")
+        assert execution_context.get_span() is active
+    assert execution_context.get_span() is None
+    elasticapm_client.end_transaction("test", "OK")
+    spans = {span["name"]: span for span in elasticapm_client.events[SPAN]}
+    assert spans["detached"]["parent_id"] == transaction.id
+    assert spans["detached"]["outcome"] == "success"
+    assert spans["active"]["parent_id"] == transaction.id
+
+
+def test_end_detached_span_requires_span(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("test")
+    transaction.begin_span("detached", "test", parent=transaction)
+    with pytest.raises(LookupError):
+        transaction.end_span()
+    elasticapm_client.end_transaction("test", "OK")
+
+
+def test_thread_pool_fan_out(elasticapm_client):
+    elasticapm_client.begin_transaction("test")
+
+    def work(parent, i):
+        with elasticapm.capture_span("work", labels={"i": i}, parent=parent) as span:
+            with elasticapm.capture_span("nested", parent=span):
+                pass
+        return span
+
+    with elasticapm.capture_span("fan-out") as fan_out:
+        with ThreadPoolExecutor(4) as executor:
+            spans = list(executor.map(work, [fan_out] * 8, range(8)))
+        assert execution_context.get_span() is fan_out
+    elasticapm_client.end_transaction("test", "OK")
+    events = elasticapm_client.events[SPAN]
+    assert len(events) == 17
+    work_spans = [event for event in events if event["name"] == "work"]
+    assert sorted(span["context"]["tags"]["i"] for span in work_spans) == list(range(8))
+    assert all(span["parent_id"] == fan_out.id for span in work_spans)
+    nested_parents = {event["parent_id"] for event in events if event["name"] == "nested"}
+    assert nested_parents == {span.id for span in spans}
+
+
+def test_gathered_coroutines(elasticapm_client):
+    async def work(parent):
+        async with async_capture_span("work", parent=parent) as span:
+            await asyncio.sleep(0)
+            assert execution_context.get_span() is parent
+        return span
+
+    async def fan_out():
+        async with async_capture_span("fan-out") as parent:
+            spans = await asyncio.gather(*(work(parent) for _ in range(5)))
+            assert execution_context.get_span() is parent
+        return parent, spans
+
+    elasticapm_client.begin_transaction("test")
+    parent, spans = asyncio.get_event_loop().run_until_complete(fan_out())
+    elasticapm_client.end_transaction("test", "OK")
+    events = {event["id"]: event for event in elasticapm_client.events[SPAN]}
+    assert len(events) == 6
+    for span in spans:
+        assert events[span.id]["parent_id"] == parent.id
+        assert events[span.id]["sync"] is False
+
+
+def test_leaf_parent(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("test")
+    with elasticapm.capture_span("leaf", leaf=True) as leaf:
+        with elasticapm.capture_span("dropped", parent=leaf) as span:
+            assert isinstance(span, DroppedSpan)
+            assert execution_context.get_span() is leaf
+        # a span with an explicit dropped parent is dropped as well
+        with elasticapm.capture_span("dropped", parent=span) as span:
+            assert isinstance(span, DroppedSpan)
+            assert span.transaction is transaction
+    elasticapm_client.end_transaction("test", "OK")
+    assert [span["name"] for span in elasticapm_client.events[SPAN]] == ["leaf"]
+
+
+def test_span_outliving_transaction(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("test")
+    with elasticapm.capture_span("outliving", parent=transaction) as span:
+        elasticapm_client.end_transaction("test", "OK")
+    assert span.duration is not None
+    assert not transaction._span_timers
+    assert len(elasticapm_client.events[TRANSACTION]) == 1
+    assert len(elasticapm_client.events[SPAN]) == 1
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"span_compression_enabled": True}], indirect=True)
+def test_spans_with_explicit_parent_are_not_compressed(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("test")
+    for _ in range(3):
+        with elasticapm.capture_span(
+            "SELECT", span_type="db", span_subtype="mysql", leaf=True, parent=transaction, duration=0.001
+        ) as span:
+            span.context["destination"] = {"service": {"resource": "mysql"}}
+    elasticapm_client.end_transaction("test", "OK")
+    assert [span.get("composite") for span in elasticapm_client.events[SPAN]] == [None] * 3
+
+
+def test_decorator_with_parent_in_thread_pool(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("test")
+
+    @elasticapm.capture_span("work", parent=transaction)
+    def work(i):
+        time.sleep(0.001)
+        return i
+
+    with ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(work, range(32))) == list(range(32))
+    assert execution_context.get_span() is None
+    elasticapm_client.end_transaction("test", "OK")
+    spans = elasticapm_client.events[SPAN]
+    assert len(spans) == 32
+    assert len({span["id"] for span in spans}) == 32
+    assert all(span["parent_id"] == transaction.id for span in spans)
+
+
+def test_async_decorator_with_parent(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("test")
+
+    @async_capture_span("work", parent=transaction)
+    async def work():
+        await asyncio.sleep(0)
+
+    async def fan_out():
+        await asyncio.gather(*(work() for _ in range(10)))
+
+    asyncio.get_event_loop().run_until_complete(fan_out())
+    elasticapm_client.end_transaction("test", "OK")
+    spans = elasticapm_client.events[SPAN]
+    assert len({span["id"] for span in spans}) == 10
+    assert all(span["parent_id"] == transaction.id for span in spans)
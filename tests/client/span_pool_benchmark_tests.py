@@ -0,0 +1,62 @@
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import gc
+import tracemalloc
+
+import pytest
+
+import elasticapm
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"span_pool_size": 0}, {"span_pool_size": 64}], indirect=True)
+def test_span_allocations(elasticapm_client, benchmark):
+    elasticapm_client.tracer.frames_collector_func = lambda: []
+    elasticapm_client.tracer.queue_func = lambda *args, **kwargs: None
+
+    def run():
+        elasticapm_client.begin_transaction("request")
+        for _ in range(50):
+            with elasticapm.capture_span("parent", labels={"a": "b"}):
+                with elasticapm.capture_span("child", span_type="db", span_subtype="mysql", leaf=True):
+                    pass
+        elasticapm_client.end_transaction("test", "OK")
+
+    run()  # fill the pool
+    collections = sum(stats["collections"] for stats in gc.get_stats())
+    tracemalloc.start()
+    try:
+        benchmark(run)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info["gc_collections"] = sum(stats["collections"] for stats in gc.get_stats()) - collections
+    benchmark.extra_info["peak_traced_memory"] = peak
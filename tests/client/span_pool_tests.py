@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import sys
+import weakref
+
+import pytest
+
+import elasticapm
+from elasticapm.conf.constants import SPAN
+from elasticapm.traces import DroppedSpan, Span
+
+pytestmark = pytest.mark.parametrize("elasticapm_client", [{"span_pool_size": 10}], indirect=True)
+
+
+def test_spans_are_reused(elasticapm_client):
+    elasticapm_client.begin_transaction("test")
+    ids = set()
+    for i in range(10):
+        with elasticapm.capture_span("test%d" % i, labels={"i": i}):
+            pass
+        ids.add(id(elasticapm_client.tracer._span_pool[-1]))
+    elasticapm_client.end_transaction("test", "OK")
+    assert len(ids) == 1
+    spans = elasticapm_client.events[SPAN]
+    assert len({span["id"] for span in spans}) == 10
+    assert [span["name"] for span in spans] == ["test%d" % i for i in range(10)]
+    assert [span["context"]["tags"] for span in spans] == [{"i": i} for i in range(10)]
+
+
+def test_referenced_spans_are_not_reused(elasticapm_client):
+    elasticapm_client.begin_transaction("test")
+    with elasticapm.capture_span("first") as first:
+        pass
+    first_id = first.id
+    with elasticapm.capture_span("second") as second:
+        pass
+    assert second is not first
+    assert first.name == "first"
+    assert first.id == first_id
+    elasticapm_client.end_transaction("test", "OK")
+
+
+def test_weakly_referenced_spans_are_not_reused(elasticapm_client):
+    elasticapm_client.begin_transaction("test")
+    with elasticapm.capture_span("first") as span:
+        ref = weakref.ref(span)
+    del span
+    with elasticapm.capture_span("second") as span:
+        assert span is not ref()
+    elasticapm_client.end_transaction("test", "OK")
+
+
+def test_nested_spans_are_reused(elasticapm_client):
+    for _ in range(3):
+        elasticapm_client.begin_transaction("test")
+        with elasticapm.capture_span("parent"):
+            with elasticapm.capture_span("child", leaf=True):
+                with elasticapm.capture_span("dropped"):
+                    pass
+        elasticapm_client.end_transaction("test", "OK")
+    tracer = elasticapm_client.tracer
+    assert len(tracer._span_pool) == 2
+    assert len(tracer._dropped_span_pool) == 1
+    assert all(type(span) is Span for span in tracer._span_pool)
+    assert type(tracer._dropped_span_pool[0]) is DroppedSpan
+    spans = elasticapm_client.events[SPAN]
+    assert [span["name"] for span in spans] == ["child", "parent"] * 3
+    for i in range(0, 6, 2):
+        assert spans[i]["parent_id"] == spans[i + 1]["id"]
+
+
+def test_pool_size(elasticapm_client):
+    elasticapm_client.config.update("1", span_pool_size=2)
+    elasticapm_client.begin_transaction("test")
+    with elasticapm.capture_span("1"):
+        with elasticapm.capture_span("2"):
+            with elasticapm.capture_span("3"):
+                with elasticapm.capture_span("4"):
+                    pass
+    elasticapm_client.end_transaction("test", "OK")
+    assert [span.name for span in elasticapm_client.tracer._span_pool] == ["4", "3"]
+
+
+def test_pooling_disabled(elasticapm_client):
+    elasticapm_client.config.update("1", span_pool_size=0)
+    elasticapm_client.begin_transaction("test")
+    with elasticapm.capture_span("test"):
+        pass
+    elasticapm_client.end_transaction("test", "OK")
+    assert not elasticapm_client.tracer._span_pool
+
+
+def test_pooling_without_reference_counts(elasticapm_client, monkeypatch):
+    monkeypatch.delattr(sys, "getrefcount")
+    tracer = elasticapm_client.tracer
+    tracer._span_pool.append(Span.__new__(Span))
+    assert tracer.reuse_span(tracer._span_pool) is None
+    elasticapm_client.begin_transaction("test")
+    with elasticapm.capture_span("first") as first:
+        pass
+    with elasticapm.capture_span("second") as second:
+        pass
+    elasticapm_client.end_transaction("test", "OK")
+    assert second is not first
+    assert first.name == "first"
+    assert [span["name"] for span in elasticapm_client.events[SPAN]] == ["first", "second"]
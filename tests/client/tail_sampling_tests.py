@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import mock
+import pytest
+
+import elasticapm
+from elasticapm.conf import constants
+from elasticapm.conf.constants import ERROR, SPAN, TRANSACTION
+from elasticapm.sampling import DefaultTailSamplingPolicy, TailSamplingPolicy
+from elasticapm.traces import execution_context
+from elasticapm.utils.disttracing import TraceParent
+
+
+class KeepSlowPolicy(TailSamplingPolicy):
+    def should_keep(self, transaction, duration, final=True):
+        return duration >= 1
+
+
+def run_transaction(client, duration, spans=1, exception=False):
+    client.begin_transaction("request", start=1)
+    for i in range(spans):
+        with elasticapm.capture_span("span%d" % i, start=1 + i * 0.001, duration=0.001):
+            pass
+    if exception:
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            client.capture_exception()
+    return client.end_transaction("test", "OK", duration=duration)
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [{"tail_sampling_enabled": True, "tail_sampling_policy": "tests.client.tail_sampling_tests.KeepSlowPolicy"}],
+    indirect=True,
+)
+def test_spans_are_sent_after_the_decision(elasticapm_client):
+    elasticapm_client.begin_transaction("request", start=1)
+    with elasticapm.capture_span("test", start=1, duration=0.001):
+        pass
+    assert not elasticapm_client.events[SPAN]
+    elasticapm_client.end_transaction("test", "OK", duration=2)
+    assert len(elasticapm_client.events[SPAN]) == 1
+    assert elasticapm_client.events[TRANSACTION][0]["sampled"]
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [{"tail_sampling_enabled": True, "tail_sampling_policy": "tests.client.tail_sampling_tests.KeepSlowPolicy"}],
+    indirect=True,
+)
+def test_discarded_transaction(elasticapm_client):
+    run_transaction(elasticapm_client, 0.5, spans=3)
+    assert not elasticapm_client.events[SPAN]
+    transaction = elasticapm_client.events[TRANSACTION][0]
+    assert not transaction["sampled"]
+    assert transaction["sample_rate"] == 0
+    assert "context" not in transaction
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [
+        {
+            "tail_sampling_enabled": True,
+            "tail_sampling_policy": "tests.client.tail_sampling_tests.KeepSlowPolicy",
+            "tail_sampling_max_buffered_spans": 5,
+        }
+    ],
+    indirect=True,
+)
+def test_early_decision_when_buffer_is_full(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("request", start=1)
+    with mock.patch.object(KeepSlowPolicy, "should_keep", return_value=True) as should_keep:
+        for i in range(7):
+            with elasticapm.capture_span("span%d" % i, start=1 + i * 0.001, duration=0.001):
+                pass
+            if i < 4:
+                assert not elasticapm_client.events[SPAN]
+        assert len(elasticapm_client.events[SPAN]) == 7
+        elasticapm_client.end_transaction("test", "OK", duration=0.5)
+    should_keep.assert_called_once_with(transaction, mock.ANY, final=False)
+    assert elasticapm_client.events[TRANSACTION][0]["sampled"]
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [
+        {
+            "tail_sampling_enabled": True,
+            "tail_sampling_policy": "tests.client.tail_sampling_tests.KeepSlowPolicy",
+            "tail_sampling_max_buffered_spans": 5,
+        }
+    ],
+    indirect=True,
+)
+def test_early_discard(elasticapm_client):
+    elasticapm_client.begin_transaction("request", start=1)
+    with mock.patch.object(KeepSlowPolicy, "should_keep", return_value=False) as should_keep:
+        with elasticapm.capture_span("parent", start=1, duration=0.1):
+            for i in range(7):
+                with elasticapm.capture_span("span%d" % i, start=1 + i * 0.001, duration=0.001):
+                    pass
+        assert execution_context.get_span() is None
+        elasticapm_client.end_transaction("test", "OK", duration=2)
+    assert should_keep.call_count == 1
+    assert not elasticapm_client.events[SPAN]
+    assert not elasticapm_client.events[TRANSACTION][0]["sampled"]
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [{"tail_sampling_enabled": True, "tail_sampling_policy": "tests.client.tail_sampling_tests.KeepSlowPolicy"}],
+    indirect=True,
+)
+def test_transactions_with_trace_parent_are_not_tail_sampled(elasticapm_client):
+    trace_parent = TraceParent.from_string("00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01")
+    elasticapm_client.begin_transaction("request", trace_parent=trace_parent)
+    with elasticapm.capture_span("test"):
+        pass
+    assert len(elasticapm_client.events[SPAN]) == 1
+    elasticapm_client.end_transaction("test", "OK", duration=0.5)
+    assert elasticapm_client.events[TRANSACTION][0]["sampled"]
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client", [{"tail_sampling_enabled": True, "transaction_sample_rate": 0.0001}], indirect=True
+)
+def test_default_policy(elasticapm_client):
+    policy = elasticapm_client.tracer.tail_sampling_policy
+    assert isinstance(policy, DefaultTailSamplingPolicy)
+    with mock.patch("elasticapm.sampling.random.random", return_value=0.5):
+        # errors are always kept
+        transaction = run_transaction(elasticapm_client, 0.01, exception=True)
+        assert transaction.is_sampled
+        assert elasticapm_client.events[ERROR][0]["transaction"]["sampled"]
+        # as long as there are not enough samples for the percentile, boring transactions are dropped
+        for i in range(policy.min_samples - 1):
+            assert not run_transaction(elasticapm_client, 0.01 * (i + 1)).is_sampled
+        # slow transactions are kept
+        assert run_transaction(elasticapm_client, 0.2).is_sampled
+        assert not run_transaction(elasticapm_client, 0.05).is_sampled
+    assert len(elasticapm_client.events[SPAN]) == 2
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client", [{"tail_sampling_enabled": True, "transaction_sample_rate": 0.1}], indirect=True
+)
+def test_sample_rate_of_kept_transactions(elasticapm_client):
+    with mock.patch("elasticapm.sampling.random.random", return_value=0.05):
+        # forced keeps are not weighted by the configured sample rate
+        forced = run_transaction(elasticapm_client, 0.01, exception=True)
+        random_keep = run_transaction(elasticapm_client, 0.01)
+    assert forced.trace_parent.tracestate_dict[constants.TRACESTATE.SAMPLE_RATE] == "1.0"
+    assert random_keep.trace_parent.tracestate_dict[constants.TRACESTATE.SAMPLE_RATE] == "0.1"
+    transactions = elasticapm_client.events[TRANSACTION]
+    assert transactions[0]["sample_rate"] == 1.0
+    assert transactions[1]["sample_rate"] == 0.1
+    assert [span["sample_rate"] for span in elasticapm_client.events[SPAN]] == [1.0, 0.1]
+
+
+def test_default_policy_percentile():
+    config = mock.Mock(transaction_sample_rate=0.0001, tail_sampling_duration_percentile=90.0)
+    policy = DefaultTailSamplingPolicy(config)
+    transaction = mock.Mock(captured_errors=0, outcome="success", transaction_type="request")
+    with mock.patch("elasticapm.sampling.random.random", return_value=0.5):
+        for i in range(policy.window_size + 100):
+            policy.should_keep(transaction, i % 100)
+        assert policy.should_keep(transaction, 90, final=False)
+        assert not policy.should_keep(transaction, 89, final=False)
+    assert len(policy._windows["request"][1]) == policy.window_size
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"tail_sampling_enabled": True}], indirect=True)
+def test_tail_sampling_with_deferred_serialization(elasticapm_client):
+    elasticapm_client.config.update("1", deferred_serialization=True)
+    run_transaction(elasticapm_client, 1, spans=2)
+    assert len(elasticapm_client.events[SPAN]) == 2
@@ -39,7 +39,14 @@ import pytest
 import elasticapm
 from elasticapm.conf import Config
 from elasticapm.conf.constants import SPAN, TRANSACTION
-from elasticapm.traces import Tracer, capture_span, execution_context
+from elasticapm.traces import (
+    SpanSnapshot,
+    Tracer,
+    TransactionSnapshot,
+    _split_span_type,
+    capture_span,
+    execution_context,
+)
 from elasticapm.utils.disttracing import TraceParent
 from tests.utils import assert_any_record_contains
 
@@ -471,6 +478,48 @@ def test_dotted_span_type_conversion(elasticapm_client):
     assert spans[3]["action"] is None
 
 
+def test_dotted_span_type_with_explicit_action(elasticapm_client):
+    elasticapm_client.begin_transaction("test")
+    with capture_span("foo", "type.subtype", span_action="action"):
+        pass
+    with capture_span("bar", "type.subtype", span_subtype="other"):
+        pass
+    elasticapm_client.end_transaction("test", "OK")
+    spans = elasticapm_client.events[SPAN]
+    assert (spans[0]["type"], spans[0]["subtype"], spans[0]["action"]) == ("type", "subtype", "action")
+    # the dotted type is only split up if no subtype is given
+    assert (spans[1]["type"], spans[1]["subtype"]) == ("type.subtype", "other")
+
+
+def test_span_type_is_parsed_lazily(elasticapm_client):
+    _split_span_type.cache_clear()
+    elasticapm_client.begin_transaction("test")
+    with capture_span("foo", "db.mysql.query") as span:
+        assert span._type is None
+        span.subtype = "postgresql"
+        assert (span.type, span.subtype, span.action) == ("db", "postgresql", "query")
+    for i in range(3):
+        with capture_span("bar", "db.mysql.query"):
+            pass
+    elasticapm_client.end_transaction("test", "OK")
+    assert [(span["type"], span["subtype"]) for span in elasticapm_client.events[SPAN]] == [
+        ("db", "postgresql"),
+        ("db", "mysql"),
+        ("db", "mysql"),
+        ("db", "mysql"),
+    ]
+    assert _split_span_type.cache_info().misses == 1
+
+
+def test_span_timestamp(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("test", start=10)
+    transaction.timestamp = 1000
+    with capture_span("foo", start=10.5, duration=1) as span:
+        assert span.timestamp == 1000.5
+    elasticapm_client.end_transaction("test", "OK")
+    assert elasticapm_client.events[SPAN][0]["timestamp"] == 1000500000
+
+
 def test_span_labelling(elasticapm_client):
     elasticapm_client.begin_transaction("test")
     with elasticapm.capture_span("test", labels={"foo": "bar", "ba.z": "baz.zinga"}) as span:
@@ -497,3 +546,46 @@ def test_span_sync(elasticapm_client):
 
     assert spans[2]["name"] == "foo"
     assert spans[2]["sync"]
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"deferred_serialization": True}], indirect=True)
+def test_deferred_serialization(elasticapm_client):
+    transport = elasticapm_client._transport
+    with mock.patch.object(transport, "_process_event", side_effect=transport._process_event) as mock_process:
+        elasticapm_client.begin_transaction("test")
+        with capture_span("test", labels={"foo": "bar"}):
+            pass
+        elasticapm_client.end_transaction("test", "OK")
+    assert [type(call[0][1]) for call in mock_process.call_args_list] == [SpanSnapshot, TransactionSnapshot]
+    span = elasticapm_client.events[SPAN][0]
+    transaction = elasticapm_client.events[TRANSACTION][0]
+    assert span["context"]["tags"] == {"foo": "bar"}
+    assert span["transaction_id"] == span["parent_id"] == transaction["id"]
+    assert transaction["name"] == "test"
+    assert transaction["result"] == "OK"
+    assert transaction["span_count"] == {"started": 1, "dropped": 0}
+
+
+def test_snapshots_dont_share_mutable_state(elasticapm_client):
+    context = {"db": {"statement": "SELECT 1"}}
+    elasticapm_client.begin_transaction("test")
+    elasticapm.set_custom_context({"a": 1})
+    elasticapm.label(foo="bar")
+    with capture_span("test", extra=context, labels={"foo": "bar"}) as span:
+        pass
+    transaction = elasticapm_client.end_transaction("test", "OK")
+    span_snapshot = SpanSnapshot(span)
+    transaction_snapshot = TransactionSnapshot(transaction)
+    # changes after the snapshots have been taken don't show up in them
+    span.labels["foo"] = "baz"
+    span.context["db"]["statement"] = "SELECT 2"
+    transaction.labels["foo"] = "baz"
+    transaction.context["custom"]["a"] = 2
+    span_dict = span_snapshot.to_dict()
+    transaction_dict = transaction_snapshot.to_dict()
+    assert span_dict["context"] == {"db": {"statement": "SELECT 1"}, "tags": {"foo": "bar"}}
+    assert transaction_dict["context"]["custom"] == {"a": 1}
+    assert transaction_dict["context"]["tags"] == {"foo": "bar"}
+    # serializing the snapshots doesn't change the context of the span or transaction
+    assert "tags" not in context
+    assert "tags" not in transaction.context
@@ -36,7 +36,15 @@ import mock
 import pytest
 
 from elasticapm.conf import constants
-from elasticapm.metrics.base_metrics import Counter, Gauge, MetricsRegistry, MetricsSet, NoopMetric, Timer
+from elasticapm.metrics.base_metrics import (
+    Counter,
+    Gauge,
+    LogLinearHistogram,
+    MetricsRegistry,
+    MetricsSet,
+    NoopMetric,
+    Timer,
+)
 from tests.utils import assert_any_record_contains
 
 
@@ -105,6 +113,89 @@ def test_metrics_histogram(elasticapm_client):
     assert d["samples"]["x"]["values"] == [0.5, 5.5, 55.0, 100]
 
 
+def test_metrics_histogram_many_buckets(elasticapm_client):
+    metricset = MetricsSet(MetricsRegistry(elasticapm_client))
+    buckets = [i * 10 for i in range(1, 500)]
+    hist = metricset.histogram("x", reset_on_collect=True, buckets=buckets)
+    assert len(buckets) == 499
+    for value in (0, 10, 10.5, 4990, 4990.1):
+        hist.update(value)
+    counts = list(metricset.collect())[0]["samples"]["x"]["counts"]
+    assert len(counts) == 500
+    assert (counts[0], counts[1], counts[498], counts[499]) == (2, 1, 1, 1)
+    assert sum(counts) == 5
+    # counts are reset on collect
+    assert list(metricset.collect())[0]["samples"]["x"]["counts"] == [0] * 500
+
+
+def test_metrics_histogram_set_counts(elasticapm_client):
+    metricset = MetricsSet(MetricsRegistry(elasticapm_client))
+    hist = metricset.histogram("x", buckets=[1, 10])
+    hist.val = [1.0, 2.0, 0.0]
+    hist.update(5)
+    assert hist.val == [1, 3, 0]
+
+
+@pytest.mark.parametrize("relative_error", [0.5, 0.1, 0.01, 0.001])
+def test_log_linear_histogram_relative_error(relative_error):
+    histo = LogLinearHistogram("x", relative_error=relative_error)
+    previous_high = -1
+    for index in range(histo.bucket_index(2 ** 40)):
+        low, high = histo.bucket_bounds(index)
+        assert low == previous_high + 1
+        assert histo.bucket_index(low) == histo.bucket_index(high) == index
+        assert (high - low) / 2.0 <= low * relative_error
+        previous_high = high
+
+
+def test_log_linear_histogram_small_values_are_exact():
+    histo = LogLinearHistogram("x", precision=3)
+    for value in range(16):
+        assert histo.bucket_bounds(histo.bucket_index(value)) == (value, value)
+    assert histo.bucket_bounds(histo.bucket_index(16)) == (16, 17)
+
+
+def test_log_linear_histogram_percentile():
+    histo = LogLinearHistogram("x", relative_error=0.01)
+    assert histo.percentile(50) is None
+    for value in range(1, 100001):
+        histo.update(value)
+    assert histo.percentile(50) == pytest.approx(50000, rel=0.01)
+    assert histo.percentile(99) == pytest.approx(99000, rel=0.01)
+    assert histo.percentile(100) == pytest.approx(100000, rel=0.01)
+
+
+def test_log_linear_histogram_snapshot_and_merge():
+    histo = LogLinearHistogram("x")
+    histo.update(10)
+    histo.update(1000, count=2)
+    snapshot = histo.snapshot(reset=True)
+    assert histo.val == ([], [])
+    histo.update(10)
+    values, counts = snapshot.val
+    assert values == [10, pytest.approx(1000, rel=0.01)]
+    assert counts == [1, 2]
+    assert histo.merge(snapshot).val == (values, [2, 2])
+    assert snapshot.val == (values, [1, 2])
+    with pytest.raises(ValueError):
+        histo.merge(LogLinearHistogram("y", relative_error=0.1))
+
+
+def test_metrics_log_linear_histogram(elasticapm_client):
+    metricset = MetricsSet(MetricsRegistry(elasticapm_client))
+    histo = metricset.log_linear_histogram("x", reset_on_collect=True, unit="us", relative_error=0.1)
+    assert metricset.log_linear_histogram("x") is histo
+    for value in (1, 1, 100, 5000):
+        histo.update(value)
+    data = list(metricset.collect())
+    assert data[0]["samples"]["x"] == {
+        "counts": [2, 1, 1],
+        "values": [1, pytest.approx(100, rel=0.1), pytest.approx(5000, rel=0.1)],
+        "type": "histogram",
+    }
+    assert list(metricset.collect()) == []
+
+
 def test_metrics_labels(elasticapm_client):
     metricset = MetricsSet(MetricsRegistry(elasticapm_client))
     metricset.counter("x", mylabel="a").inc()
@@ -144,6 +235,66 @@ def test_metrics_multithreaded(elasticapm_client):
     assert metricset.counter("x").val == expected
 
 
+def test_metrics_multithreaded_creation(elasticapm_client):
+    metricset = MetricsSet(MetricsRegistry(elasticapm_client))
+    pool = Pool(8)
+
+    def target():
+        for i in range(100):
+            metricset.counter("x", mylabel=i).inc()
+
+    [pool.apply_async(target, ()) for i in range(8)]
+    pool.close()
+    pool.join()
+    data = list(metricset.collect())
+    assert len(data) == 100
+    # metrics are collected in the order they have been created in, regardless of their shard
+    assert [d["tags"]["mylabel"] for d in data] == [str(i) for i in range(100)]
+    assert all(d["samples"]["x"]["value"] == 8 for d in data)
+
+
+@mock.patch("elasticapm.metrics.base_metrics.DISTINCT_LABEL_LIMIT", 50)
+def test_metric_limit_multithreaded_creation(elasticapm_client):
+    metricset = MetricsSet(MetricsRegistry(elasticapm_client))
+    pool = Pool(8)
+
+    def target(thread):
+        for i in range(20):
+            metricset.counter("x", thread=thread, mylabel=i)
+
+    [pool.apply_async(target, (i,)) for i in range(8)]
+    pool.close()
+    pool.join()
+    metrics = metricset._metrics_by_class()[Counter]
+    # the limit holds, even though the metrics have been created concurrently in different shards
+    assert len(metrics) == 50
+    assert not any(isinstance(metric, NoopMetric) for name, labels, metric in metrics)
+
+
+def test_metrics_handles(elasticapm_client):
+    metricset = MetricsSet(MetricsRegistry(elasticapm_client))
+    assert metricset.handle(("x", "a")) is None
+    timer = metricset.bind(("x", "a"), metricset.timer("x", reset_on_collect=True, mylabel="a"))
+    assert metricset.handle(("x", "a")) is timer
+    assert metricset.timer("x", mylabel="a") is timer
+    timer.update(5)
+    list(metricset.collect())
+    # handles stay valid after the metric has been reset on collect
+    metricset.handle(("x", "a")).update(3)
+    data = list(metricset.collect())
+    assert data[0]["samples"]["x.sum"]["value"] == 3
+    assert data[0]["tags"] == {"mylabel": "a"}
+
+
+@mock.patch("elasticapm.metrics.base_metrics.DISTINCT_LABEL_LIMIT", 2)
+def test_metrics_handles_limit(elasticapm_client):
+    metricset = MetricsSet(MetricsRegistry(elasticapm_client))
+    for i in range(3):
+        metricset.bind(i, metricset.counter("x", mylabel=i))
+    assert metricset.handle(1) is not None
+    assert metricset.handle(2) is None
+
+
 @pytest.mark.parametrize("sending_elasticapm_client", [{"metrics_interval": "30s"}], indirect=True)
 def test_metrics_flushed_on_shutdown(sending_elasticapm_client):
     # this is ugly, we need an API for this at some point...
@@ -27,13 +27,17 @@
 #  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 #  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import sys
+import threading
 import time
 
 import mock
 import pytest
 
 import elasticapm
-from elasticapm.utils import compat
+from elasticapm.conf.constants import METRICSET
+from elasticapm.metrics.base_metrics import Counter, Timer
+from elasticapm.traces import ChildDuration
 
 
 def test_bare_transaction(elasticapm_client):
@@ -64,6 +68,49 @@ def test_bare_transaction(elasticapm_client):
     assert transaction_data[0]["samples"]["transaction.duration.sum.us"]["value"] == 5000000
 
 
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [{"transaction_duration_histograms": True, "histogram_relative_error": 0.05}],
+    indirect=True,
+)
+def test_transaction_duration_histogram(elasticapm_client):
+    for duration in (0.01, 0.02, 0.02, 1):
+        elasticapm_client.begin_transaction("request", start=1)
+        elasticapm_client.end_transaction("test", "OK", duration=duration)
+    transaction_metrics = elasticapm_client._metrics.get_metricset(
+        "elasticapm.metrics.sets.transactions.TransactionsMetricSet"
+    )
+    data = list(transaction_metrics.collect())
+    assert len(data) == 1
+    histogram = data[0]["samples"]["transaction.duration.histogram"]
+    assert histogram["counts"] == [1, 2, 1]
+    for value, expected in zip(histogram["values"], (10000, 20000, 1000000)):
+        assert value == pytest.approx(expected, rel=0.05)
+    assert data[0]["transaction"] == {"name": "test", "type": "request"}
+    elasticapm_client.begin_transaction("request", start=1)
+    elasticapm_client.end_transaction("test", "OK", duration=0.01)
+    # validates the histogram against the intake schema
+    elasticapm_client._metrics.collect()
+    assert any("transaction.duration.histogram" in m["samples"] for m in elasticapm_client.events[METRICSET])
+
+
+def test_metric_handles_reused(elasticapm_client):
+    breakdown = elasticapm_client._metrics.get_metricset("elasticapm.metrics.sets.breakdown.BreakdownMetricSet")
+    for _ in range(3):
+        elasticapm_client.begin_transaction("request", start=1)
+        with elasticapm.capture_span("test", span_type="db", span_subtype="mysql", start=2, duration=5):
+            pass
+        elasticapm_client.end_transaction("test", "OK", duration=15)
+    assert set(breakdown._handles) == {
+        ("transaction.breakdown.count", "test", "request"),
+        ("span.self_time", "test", "request", "app", None),
+        ("span.self_time", "test", "request", "db", "mysql"),
+    }
+    timer = breakdown.handle(("span.self_time", "test", "request", "db", "mysql"))
+    assert timer.val == (15000000, 3)
+    assert breakdown.handle(("transaction.breakdown.count", "test", "request")).val == 3
+
+
 def test_single_span(elasticapm_client):
     elasticapm_client.begin_transaction("request", start=0)
     with elasticapm.capture_span("test", span_type="db", span_subtype="mysql", start=10, duration=5):
@@ -198,14 +245,15 @@ def test_metrics_reset_after_collect(elasticapm_client):
         "elasticapm.metrics.sets.transactions.TransactionsMetricSet"
     )
     for metricset in (breakdown, transaction_metrics):
-        for labels, c in compat.iteritems(metricset._counters):
+        metrics = metricset._metrics_by_class()
+        for name, labels, c in metrics[Counter]:
             assert c.val != 0
-        for labels, t in compat.iteritems(metricset._timers):
+        for name, labels, t in metrics[Timer]:
             assert t.val != (0, 0)
         list(metricset.collect())
-        for labels, c in compat.iteritems(metricset._counters):
+        for name, labels, c in metrics[Counter]:
             assert c.val == 0
-        for labels, t in compat.iteritems(metricset._timers):
+        for name, labels, t in metrics[Timer]:
             assert t.val == (0, 0)
 
 
@@ -245,3 +293,108 @@ def test_multiple_transactions(elasticapm_client):
     assert len(transaction_data) == 1
     assert 19999999 <= transaction_data[0]["samples"]["transaction.duration.sum.us"]["value"] <= 20000000
     assert transaction_data[0]["samples"]["transaction.duration.count"]["value"] == 2
+
+
+def test_child_duration():
+    child_durations = ChildDuration()
+    assert child_durations.duration == 0
+    # nested and overlapping children
+    child_durations.start(1)
+    child_durations.start(2)
+    child_durations.stop(3)
+    child_durations.start(2.5)
+    child_durations.stop(4)
+    child_durations.stop(5)
+    # adjacent children
+    child_durations.start(6)
+    child_durations.stop(7)
+    child_durations.start(7)
+    child_durations.stop(8)
+    # zero duration child
+    child_durations.start(9)
+    child_durations.stop(9)
+    # child that hasn't ended yet
+    child_durations.start(10)
+    assert child_durations.duration == 6
+
+
+def test_child_duration_out_of_order():
+    child_durations = ChildDuration()
+    # two parallel children that end in a different order than they started
+    child_durations.start(1)
+    child_durations.start(2)
+    child_durations.stop(4)
+    child_durations.stop(3)
+    assert child_durations.duration == 3
+
+
+def test_spans_ended_in_threads(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("request", start=1)
+    barrier = threading.Barrier(4)
+
+    def run(thread):
+        for i in range(1000):
+            transaction.child_started(1 + thread + i * 0.001)
+        # all children are running at the same time, until the last one ends
+        barrier.wait()
+        for i in range(1000):
+            transaction.child_ended(10 + thread + i * 0.001)
+            transaction.track_span_duration("db", "mysql", 0.5)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert transaction._multithreaded
+    assert transaction._child_durations.duration == pytest.approx(13.999 - 1)
+    elasticapm_client.end_transaction("test", "OK", duration=1000)
+    breakdown = elasticapm_client._metrics.get_metricset("elasticapm.metrics.sets.breakdown.BreakdownMetricSet")
+    samples = {elem["span"]["type"]: elem["samples"] for elem in breakdown.collect() if "span" in elem}
+    assert samples["db"]["span.self_time.count"]["value"] == 4000
+    assert samples["db"]["span.self_time.sum.us"]["value"] == 2000000000
+
+
+def test_switch_to_synchronized_updates_while_starting_thread_updates(elasticapm_client):
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for _ in range(20):
+            transaction = elasticapm_client.begin_transaction("request", start=1)
+            started = threading.Event()
+
+            def run():
+                started.set()
+                for i in range(1000):
+                    transaction.child_started(2)
+                    transaction.child_ended(3)
+
+            thread = threading.Thread(target=run)
+            thread.start()
+            started.wait()
+            # the other thread switches to synchronized updates while this thread keeps updating
+            for i in range(1000):
+                transaction.child_started(2)
+                transaction.child_ended(3)
+            thread.join()
+            assert transaction._child_durations._nesting_level == 0
+            assert not transaction._unsynchronized_update
+            elasticapm_client.end_transaction("test", "OK", duration=10)
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+
+def test_single_threaded_spans_are_not_synchronized(elasticapm_client):
+    transaction = elasticapm_client.begin_transaction("request")
+    with elasticapm.capture_span("parent"):
+        with elasticapm.capture_span("child"):
+            pass
+    assert not transaction._multithreaded
+    assert transaction._span_tree_lock() is None
+    transaction._end_unsynchronized_update()
+    elasticapm_client.end_transaction("test", "OK")
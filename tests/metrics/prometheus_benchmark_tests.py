@@ -0,0 +1,58 @@
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import pytest
+
+from elasticapm.metrics.base_metrics import MetricsRegistry
+from elasticapm.metrics.sets.prometheus import PrometheusMetrics
+
+prometheus_client = pytest.importorskip("prometheus_client")
+pytest.importorskip("pytest_benchmark")
+
+pytestmark = pytest.mark.prometheus_client
+
+
+def test_prometheus_bridge_collect(elasticapm_client, benchmark):
+    registry = prometheus_client.CollectorRegistry()
+    metricset = PrometheusMetrics(MetricsRegistry(elasticapm_client))
+    metricset._prometheus_registry = registry
+    counter = prometheus_client.Counter("requests", "Requests", ["path", "status"], registry=registry)
+    gauge = prometheus_client.Gauge("connections", "Connections", ["pool"], registry=registry)
+    for i in range(400):
+        counter.labels(path="/path/%d" % i, status="200").inc()
+    for i in range(400):
+        gauge.labels(pool="pool-%d" % i).set(i)
+
+    def run():
+        # only a few series change between collections
+        for i in range(10):
+            counter.labels(path="/path/%d" % i, status="200").inc()
+        list(metricset.collect())
+
+    benchmark(run)
@@ -29,6 +29,7 @@
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import platform
 
+import mock
 import pytest
 
 prometheus_client = pytest.importorskip("prometheus_client")
@@ -141,3 +142,43 @@ def test_histogram(elasticapm_client, prometheus):
     assert data[2]["samples"]["prometheus.metrics.histowithlabel"]["values"] == [0.5, 5.5, 55.0, 100.0]
     assert data[2]["samples"]["prometheus.metrics.histowithlabel"]["counts"] == [0, 0, 0, 1]
     assert data[2]["tags"] == {"alabel": "foo", "anotherlabel": "bazzinga"}
+
+
+def test_unchanged_series_are_skipped(elasticapm_client, prometheus):
+    metricset = PrometheusMetrics(MetricsRegistry(elasticapm_client))
+    counter = prometheus_client.Counter("counter_with_labels", "Counter with labels", ["alabel"])
+    gauge = prometheus_client.Gauge("a_bare_gauge", "Bare gauge")
+    histo = prometheus_client.Histogram("histo", "test histogram", buckets=[1, 10, float("inf")])
+    counter.labels(alabel="foo").inc()
+    counter.labels(alabel="bar").inc()
+    gauge.set(5)
+    histo.observe(5)
+    assert len(list(metricset.collect())) == 3
+    assert list(metricset.collect()) == []
+
+    counter.labels(alabel="foo").inc()
+    counter.labels(alabel="baz").inc()
+    histo.observe(5)
+    data = {d.get("tags", {}).get("alabel"): d["samples"] for d in metricset.collect()}
+    assert data == {
+        "foo": {"prometheus.metrics.counter_with_labels": {"value": 2.0}},
+        "baz": {"prometheus.metrics.counter_with_labels": {"value": 1.0}},
+        None: {"prometheus.metrics.histo": {"counts": [0, 2, 0], "values": [0.5, 5.5, 10.0], "type": "histogram"}},
+    }
+
+    gauge.set(0)
+    data = list(metricset.collect())
+    assert len(data) == 1
+    assert data[0]["samples"]["prometheus.metrics.a_bare_gauge"]["value"] == 0
+
+
+def test_series_metrics_are_reused(elasticapm_client, prometheus):
+    metricset = PrometheusMetrics(MetricsRegistry(elasticapm_client))
+    gauge = prometheus_client.Gauge("gauge_with_labels", "Gauge with labels", ["alabel"])
+    gauge.labels(alabel="foo").set(1)
+    list(metricset.collect())
+    gauge.labels(alabel="foo").set(2)
+    with mock.patch.object(metricset, "gauge") as mock_gauge:
+        data = list(metricset.collect())
+    assert not mock_gauge.called
+    assert data[0]["samples"]["prometheus.metrics.gauge_with_labels"]["value"] == 2
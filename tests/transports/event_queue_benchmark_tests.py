@@ -0,0 +1,76 @@
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import random
+
+import pytest
+
+from elasticapm.transport.base import ChilledQueue, PerThreadQueue, Transport
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.parametrize("queue_class", [ChilledQueue, PerThreadQueue])
+@pytest.mark.parametrize("batched", [False, True], ids=["get", "get_many"])
+def test_drain_event_queue(queue_class, batched, benchmark):
+    events = [("error", {"id": i}, False) for i in range(500)]
+
+    def setup():
+        queue = queue_class(maxsize=10000)
+        for event in events:
+            queue.put(event)
+        return (queue,), {}
+
+    def drain(queue):
+        if batched:
+            return queue.get_many(len(events))
+        return [queue.get(block=False) for _ in range(len(events))]
+
+    result = benchmark.pedantic(drain, setup=setup, rounds=200)
+    assert len(result) == len(events)
+
+
+@pytest.mark.parametrize("batch_size", [1, 500])
+def test_process_queue(elasticapm_client, batch_size, benchmark):
+    sent = []
+    transport = Transport(client=elasticapm_client, queue_chill_count=batch_size)
+    transport.send = sent.append
+    transport.start_thread()
+    event = {"id": "x" * 32, "culprit": "foo.bar", "exception": {"message": "x" * 100}}
+
+    def run():
+        for _ in range(5000):
+            transport.queue("error", event)
+        transport.flush()
+
+    try:
+        benchmark.pedantic(run, rounds=20)
+    finally:
+        transport.close()
+    assert sent
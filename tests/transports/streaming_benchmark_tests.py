@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import timeit
+import tracemalloc
+
+import pytest
+
+from elasticapm.transport.http import Transport
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [
+        {"server_version": (8, 0, 0), "api_request_size": "10mb", "api_request_streaming": False},
+        {"server_version": (8, 0, 0), "api_request_size": "10mb", "api_request_streaming": True},
+    ],
+    indirect=True,
+    ids=["buffered", "streaming"],
+)
+def test_flush_10k_events(elasticapm_client, benchmark):
+    flush_times = []
+
+    def send(data, chunked=False):
+        # consume the request body like urllib3 would
+        if chunked:
+            for _ in data:
+                pass
+
+    def flush(buffer):
+        start = timeit.default_timer()
+        original_flush(buffer)
+        flush_times.append(timeit.default_timer() - start)
+
+    transport = Transport("http://localhost:8200", client=elasticapm_client, queue_chill_count=500)
+    transport.send = send
+    original_flush, transport._flush = transport._flush, flush
+    event = {"id": "x" * 32, "culprit": "foo.bar", "exception": {"message": "x" * 200, "type": "ValueError"}}
+
+    def run():
+        for _ in range(10):
+            for _ in range(1000):
+                transport.queue("error", event)
+        transport.flush()
+
+    transport.start_thread()
+    tracemalloc.start()
+    try:
+        benchmark.pedantic(run, rounds=10)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        transport.close()
+    flush_times.sort()
+    benchmark.extra_info["peak_traced_memory"] = peak
+    benchmark.extra_info["p99_flush_time"] = flush_times[int(len(flush_times) * 0.99)]
@@ -0,0 +1,213 @@
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import pytest  # isort:skip
+
+pytest.importorskip("pytest_asyncio")  # isort:skip
+
+import asyncio
+
+import mock
+import urllib3
+
+from elasticapm.conf import constants
+from elasticapm.transport.asyncio_http import AsyncioTransport
+from elasticapm.transport.exceptions import TransportException
+
+# avoid the request for the server version when the transport starts
+known_server_version = pytest.mark.parametrize("elasticapm_client", [{"server_version": (8, 0, 0)}], indirect=True)
+
+
+# the validating server decodes the payloads
+skip_validate = pytest.mark.parametrize("validating_httpserver", [{"skip_validate": True}], indirect=True)
+headers = {"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+
+
+def get_ids(payload):
+    return [line["error"]["id"] for line in payload[1:]]
+
+
+@skip_validate
+@pytest.mark.asyncio
+async def test_send_async(validating_httpserver, elasticapm_client):
+    validating_httpserver.serve_content(code=202, content="", headers={"Location": "http://example.com/foo"})
+    transport = AsyncioTransport(validating_httpserver.url, client=elasticapm_client, headers={"X-Foo": "bar"})
+    url = await transport.send_async(b"x")
+    assert url == "http://example.com/foo"
+    assert validating_httpserver.payloads[0] == "x"
+    assert validating_httpserver.requests[0].headers["X-Foo"] == "bar"
+    # send is synchronous, like in the other transports
+    assert transport.send(b"y") == "http://example.com/foo"
+
+
+@pytest.mark.asyncio
+async def test_send_async_http_error(waiting_httpserver, elasticapm_client):
+    waiting_httpserver.serve_content(code=418, content="I'm a teapot")
+    transport = AsyncioTransport(waiting_httpserver.url, client=elasticapm_client)
+    with pytest.raises(TransportException) as exc_info:
+        await transport.send_async(b"x")
+    for val in (418, "I'm a teapot"):
+        assert str(val) in str(exc_info.value)
+
+
+def test_proxy(elasticapm_client):
+    with mock.patch.dict("os.environ", {"HTTPS_PROXY": "https://example.com"}):
+        transport = AsyncioTransport("http://localhost:9999", client=elasticapm_client)
+    assert isinstance(transport.http, urllib3.ProxyManager)
+
+
+@skip_validate
+@known_server_version
+@pytest.mark.asyncio
+async def test_events_are_sent_from_running_loop(validating_httpserver, elasticapm_client):
+    validating_httpserver.serve_content(code=202, content="")
+    transport = AsyncioTransport(validating_httpserver.url, client=elasticapm_client, headers=headers)
+    transport.start_thread()
+    assert transport._loop is asyncio.get_event_loop()
+    assert transport._loop_thread is None
+    transport.queue("error", {"id": 1})
+    transport.queue("error", {"id": 2}, flush=True)
+    # flush() doesn't block the loop, but returns immediately
+    transport.flush()
+    for _ in range(100):
+        if validating_httpserver.requests:
+            break
+        await asyncio.sleep(0.05)
+    assert get_ids(validating_httpserver.payloads[0]) == [1, 2]
+    # close() doesn't block the loop either, the task finishes in the background
+    transport.close()
+    await asyncio.wait_for(transport._task, 1)
+
+
+@skip_validate
+@known_server_version
+def test_dedicated_loop_without_running_loop(validating_httpserver, elasticapm_client):
+    validating_httpserver.serve_content(code=202, content="")
+    transport = AsyncioTransport(validating_httpserver.url, client=elasticapm_client, headers=headers)
+    transport.start_thread()
+    assert transport._loop is None
+    transport.queue("error", {"id": 1})
+    assert transport._loop_thread.name == "eapm asyncio transport loop"
+    transport.close()
+    assert transport._loop_thread is None
+    assert get_ids(validating_httpserver.payloads[0]) == [1]
+
+
+@skip_validate
+@known_server_version
+def test_payload_after_dropped_flush_is_valid(validating_httpserver, elasticapm_client):
+    validating_httpserver.serve_content(code=202, content="")
+    transport = AsyncioTransport(validating_httpserver.url, client=elasticapm_client, headers=headers)
+    transport.start_thread()
+    for _ in range(3):
+        transport.state.set_fail()
+    transport.queue("error", {"id": 1}, flush=True)
+    transport.flush()
+    transport.state.set_success()
+    transport.queue("error", {"id": 2})
+    transport.close()
+    # the buffer of the dropped payload is reused for the next one
+    assert len(validating_httpserver.payloads) == 1
+    assert get_ids(validating_httpserver.payloads[0]) == [2]
+
+
+@skip_validate
+@pytest.mark.parametrize("elasticapm_client", [{"server_version": (8, 0, 0), "api_request_time": "10s"}], indirect=True)
+def test_close_after_loop_has_stopped(validating_httpserver, elasticapm_client):
+    validating_httpserver.serve_content(code=202, content="")
+    transport = AsyncioTransport(validating_httpserver.url, client=elasticapm_client, headers=headers)
+    loop = asyncio.new_event_loop()
+
+    async def run():
+        transport.start_thread()
+        transport.queue("error", {"id": 1})
+        # let the task write the first event to its buffer
+        await asyncio.sleep(transport._max_chill_time + 0.1)
+        transport.queue("error", {"id": 2})
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+    with mock.patch.object(transport, "_start") as mock_start, mock.patch.object(
+        transport, "fetch_server_info"
+    ) as mock_fetch:
+        transport.close()
+    # the remaining events are sent without starting the task again
+    assert not mock_start.called
+    assert not mock_fetch.called
+    assert len(validating_httpserver.payloads) == 1
+    assert get_ids(validating_httpserver.payloads[0]) == [1, 2]
+
+
+@skip_validate
+@known_server_version
+@pytest.mark.asyncio
+async def test_large_batches_are_compressed_in_executor(validating_httpserver, elasticapm_client):
+    validating_httpserver.serve_content(code=202, content="")
+    transport = AsyncioTransport(validating_httpserver.url, client=elasticapm_client, headers=headers)
+    transport.executor_compression_threshold = 100
+    loop = asyncio.get_event_loop()
+    transport.start_thread()
+    with mock.patch.object(loop, "run_in_executor", wraps=loop.run_in_executor) as mock_executor:
+        transport.queue("error", {"id": 1}, flush=True)
+        await asyncio.sleep(0.1)
+        transport.queue("error", {"id": 2, "message": "x" * 200}, flush=True)
+        for _ in range(100):
+            if len(validating_httpserver.requests) == 2:
+                break
+            await asyncio.sleep(0.05)
+        functions = [call[0][1].__name__ for call in mock_executor.call_args_list]
+    assert functions == ["send", "write", "send"]
+    transport.close()
+    await asyncio.wait_for(transport._task, 1)
+
+
+@known_server_version
+@pytest.mark.asyncio
+async def test_get_config(waiting_httpserver, elasticapm_client):
+    waiting_httpserver.serve_content(
+        code=200, content=b'{"x": "y"}', headers={"Cache-Control": "max-age=5", "Etag": "2"}
+    )
+    transport = AsyncioTransport(
+        waiting_httpserver.url + "/" + constants.EVENTS_API_PATH,
+        client=elasticapm_client,
+        headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"},
+    )
+    transport.start_thread()
+    loop = asyncio.get_event_loop()
+    # the config updater thread fetches the config on its own, independently of the event loop
+    version, data, max_age = await loop.run_in_executor(None, transport.get_config, "1", {})
+    assert version == "2"
+    assert data == {"x": "y"}
+    assert max_age == 5
+    transport.close()
+    await asyncio.wait_for(transport._task, 1)
@@ -29,15 +29,27 @@
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import gzip
+import json
 import random
 import string
+import threading
 import time
 import timeit
+import tracemalloc
 
 import mock
 import pytest
 
-from elasticapm.transport.base import Transport, TransportState
+from elasticapm.transport import base
+from elasticapm.transport.base import (
+    BufferPool,
+    ChilledQueue,
+    CompressionLevelController,
+    PerThreadQueue,
+    PooledBuffer,
+    Transport,
+    TransportState,
+)
 from elasticapm.transport.exceptions import TransportException
 from elasticapm.utils import compat
 from tests.fixtures import DummyTransport, TempStoreClient
@@ -250,3 +262,335 @@ def test_transport_metadata_pid_change(mock_send, elasticapm_client):
     time.sleep(0.2)
     assert transport._metadata
     transport.close()
+
+
+@pytest.mark.parametrize("queue_class", [ChilledQueue, PerThreadQueue])
+def test_queue_get_many(queue_class):
+    queue = queue_class(maxsize=5)
+    for i in range(5):
+        queue.put(i)
+    assert queue.get_many(3) == [0, 1, 2]
+    assert queue.get_many(3) == [3, 4]
+    assert queue.get_many(3) == []
+    # free slots are available again
+    queue.put(5, block=False)
+    assert queue.get_many(3) == [5]
+
+
+def test_per_thread_queue_drops_on_full_buffer():
+    queue = PerThreadQueue(maxsize=2)
+    queue.put(1)
+    queue.put(2)
+    with pytest.raises(compat.queue.Full):
+        queue.put(3)
+    assert queue.get() == 1
+    assert queue.dropped == {threading.current_thread().name: 1}
+    # the buffer has been drained, so there's room again
+    queue.put(4)
+    assert queue.get() == 2
+    assert queue.get() == 4
+    with pytest.raises(compat.queue.Empty):
+        queue.get(block=False)
+
+
+def test_per_thread_queue_keeps_order_across_threads():
+    queue = PerThreadQueue()
+    queue.put("main-1")
+    thread = threading.Thread(target=lambda: (queue.put("thread-1"), queue.put("thread-2")))
+    thread.start()
+    thread.join()
+    queue.put("main-2")
+    assert [queue.get() for _ in range(4)] == ["main-1", "thread-1", "thread-2", "main-2"]
+    assert queue.qsize() == 0
+    # buffers of finished threads are cleaned up once empty
+    assert len(queue._buffers) == 1
+
+
+def test_per_thread_queue_chill():
+    queue = PerThreadQueue(chill_until=2, max_chill_time=60)
+    queue.put(1)
+    queue.put(2)
+    assert not queue._not_empty.is_set()
+    queue.put(3)
+    assert queue._not_empty.is_set()
+    queue._not_empty.clear()
+    queue.put(4, chill=False)
+    assert queue._not_empty.is_set()
+
+
+def test_per_thread_queue_get_timeout():
+    queue = PerThreadQueue()
+    start = timeit.default_timer()
+    with pytest.raises(compat.queue.Empty):
+        queue.get(timeout=0.1)
+    assert timeit.default_timer() - start >= 0.1
+
+
+@mock.patch("elasticapm.transport.base.Transport.send")
+@pytest.mark.parametrize("elasticapm_client", [{"per_thread_event_queue": True}], indirect=True)
+def test_per_thread_queue_transport(mock_send, elasticapm_client):
+    transport = Transport(client=elasticapm_client, compress_level=0)
+    assert isinstance(transport._event_queue, PerThreadQueue)
+    transport.start_thread()
+    try:
+        transport.queue("error", {"id": "foo"})
+        thread = threading.Thread(target=transport.queue, args=("error", {"id": "bar"}))
+        thread.start()
+        thread.join()
+        transport.flush()
+    finally:
+        transport.close()
+    assert mock_send.call_count == 1
+    data = gzip.decompress(mock_send.call_args[0][0]).decode("utf-8").splitlines()
+    assert [json.loads(line) for line in data[1:]] == [{"error": {"id": "foo"}}, {"error": {"id": "bar"}}]
+
+
+def test_process_event_deferred_serialization(elasticapm_client, caplog):
+    transport = Transport(client=elasticapm_client)
+    event = mock.Mock(to_dict=lambda: {"id": "foo"})
+    assert transport._process_event("span", event) == {"id": "foo"}
+    broken_event = mock.Mock(to_dict=mock.Mock(side_effect=ValueError()))
+    with caplog.at_level("WARNING", "elasticapm.transport"):
+        assert transport._process_event("span", broken_event) is None
+    assert_any_record_contains(caplog.records, "exception during serialization", "elasticapm.transport")
+
+
+@mock.patch("elasticapm.transport.base.Transport.send")
+def test_events_are_processed_in_batches(mock_send, elasticapm_client):
+    transport = Transport(client=elasticapm_client, compress_level=0, queue_chill_count=10)
+    for i in range(25):
+        transport.queue("error", {"id": i})
+    transport.queue("close", None)
+    transport.queue("error", {"id": "after close"})
+    with mock.patch.object(gzip.GzipFile, "write", autospec=True, side_effect=gzip.GzipFile.write) as mock_write:
+        # run the event processor in the current thread, it returns after the close event
+        transport._process_queue()
+    # metadata, and three batches of 10, 10 and 5 events
+    assert mock_write.call_count == 4
+    assert mock_send.call_count == 1
+    lines = gzip.decompress(mock_send.call_args[0][0]).decode("utf-8").splitlines()
+    assert [json.loads(line)["error"]["id"] for line in lines[1:]] == list(range(25))
+    assert transport._counts["error"] == 25
+
+
+def test_compression_level_controller_lowers_level_on_backlog():
+    controller = CompressionLevelController(max_level=5)
+    assert controller.update(0.0, 1.0, 5000) == 3
+    assert controller.update(0.0, 1.0, 5000) == 1
+    assert controller.update(0.0, 1.0, 5000) == 0
+    assert controller.update(0.0, 1.0, 5000) == 0
+
+
+def test_compression_level_controller_lowers_level_on_cpu_load():
+    controller = CompressionLevelController(max_level=5, cpu_budget=0.1)
+    assert controller.update(0.2, 1.0, 0) == 3
+
+
+def test_compression_level_controller_raises_level_with_headroom():
+    controller = CompressionLevelController(max_level=5)
+    controller.level = 3
+    # between the thresholds, nothing changes
+    assert controller.update(0.07, 1.0, 0) == 3
+    assert controller.update(0.0, 1.0, 1000) == 3
+    assert controller.update(0.0, 1.0, 0) == 4
+    assert controller.update(0.0, 1.0, 0) == 5
+    assert controller.update(0.0, 1.0, 0) == 5
+
+
+@mock.patch("elasticapm.transport.base.Transport.send")
+@pytest.mark.parametrize("elasticapm_client", [{"adaptive_compression": True}], indirect=True)
+def test_adaptive_compression_changes_level_at_flush(mock_send, elasticapm_client):
+    transport = Transport(client=elasticapm_client, compress_level=5, queue_chill_count=1)
+    # pretend the event queue is always backed up
+    transport._compression_controller.high_backlog = -1
+    transport.queue("error", {"id": 1}, flush=True)
+    transport.queue("error", {"id": 2}, flush=True)
+    transport.queue("close", None)
+    with mock.patch.object(gzip, "GzipFile", wraps=gzip.GzipFile) as mock_gzip:
+        transport._process_queue()
+    assert [call[1]["compresslevel"] for call in mock_gzip.call_args_list] == [5, 3]
+    assert transport._compress_level == 1
+    metricset = elasticapm_client._metrics.get_metricset("elasticapm.metrics.sets.transport.TransportMetricSet")
+    data = list(metricset.collect())
+    assert data[0]["samples"]["agent.transport.compression_level.changes"]["value"] == 2
+    assert "agent.transport.compression_level" in data[0]["samples"]
+
+
+@mock.patch("elasticapm.transport.base.Transport.send")
+def test_compression_level_is_fixed_by_default(mock_send, elasticapm_client):
+    transport = Transport(client=elasticapm_client, compress_level=5)
+    assert transport._compression_controller is None
+    transport.queue("error", {"id": 1}, flush=True)
+    transport.queue("close", None)
+    transport._process_queue()
+    assert transport._compress_level == 5
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_senders": 2, "api_request_size": "1b"}], indirect=True)
+def test_senders_dont_block_event_processor(elasticapm_client):
+    release = threading.Event()
+    sent = []
+
+    def send(data):
+        release.wait(5)
+        sent.append(gzip.decompress(bytes(data)))
+
+    # every event ends up in its own payload
+    transport = Transport(client=elasticapm_client, queue_chill_count=1)
+    transport.send = send
+    transport.start_thread()
+    try:
+        assert len(transport._senders) == 2
+        # two payloads are being sent, two are waiting in the hand-off, while the event processor keeps going
+        for i in range(4):
+            transport.queue("error", {"id": i})
+        timeout = time.time() + 5
+        while transport._counts["error"] < 4 and time.time() < timeout:
+            time.sleep(0.01)
+        assert transport._counts["error"] == 4
+        assert not sent
+    finally:
+        release.set()
+        transport.close()
+    assert len(sent) == 4
+    ids = sorted(json.loads(payload.splitlines()[1])["error"]["id"] for payload in sent)
+    assert ids == list(range(4))
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_senders": 1}], indirect=True)
+@mock.patch("elasticapm.transport.base.Transport.send")
+def test_senders_share_back_off(mock_send, elasticapm_client, caplog):
+    transport = Transport(client=elasticapm_client)
+    transport._start_senders()
+    # after the second failure, the transport backs off for a second
+    transport.state.set_fail()
+    transport.state.set_fail()
+    with caplog.at_level("ERROR", "elasticapm.transport"):
+        payload = PooledBuffer(16)
+        payload.write(b"payload")
+        transport._sender_queue.put(payload)
+        transport._sender_queue.join()
+    transport._stop_senders()
+    assert mock_send.call_count == 0
+    assert_any_record_contains(caplog.records, "dropping flushed data due to transport failure back-off")
+
+
+def test_pooled_buffer():
+    buffer = PooledBuffer(4)
+    assert buffer.write(b"foo") == 3
+    assert buffer.write(b"bar") == 3
+    assert buffer.tell() == 6
+    assert bytes(buffer.getbuffer()) == b"foobar"
+    assert buffer.reset()
+    buffer.write(b"x")
+    assert bytes(buffer.getbuffer()) == b"x"
+
+
+def test_buffer_pool_reuses_buffers():
+    pool = BufferPool(max_free=1)
+    buffer = pool.acquire(16)
+    buffer.write(b"foo")
+    buffer.getbuffer()
+    pool.recycle(buffer)
+    assert pool.acquire(16) is buffer
+    assert buffer.tell() == 0
+    # only up to max_free buffers are kept
+    pool.recycle(buffer)
+    pool.recycle(PooledBuffer(16))
+    assert pool.acquire(16) is buffer
+    assert pool.acquire(16) is not buffer
+
+
+def test_buffer_pool_doesnt_reuse_referenced_buffers():
+    pool = BufferPool()
+    buffer = pool.acquire(16)
+    buffer.write(b"foo")
+    view = buffer.getbuffer()
+    pool.recycle(buffer)
+    assert pool.acquire(16) is not buffer
+    assert bytes(view) == b"foo"
+    # a slice of the view holds on to the data as well
+    data_slice = view[1:]
+    del view
+    pool.recycle(buffer)
+    assert pool.acquire(16) is not buffer
+    assert bytes(data_slice) == b"oo"
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_size": "512kb"}], indirect=True)
+def test_flushes_reuse_buffers(elasticapm_client):
+    # with compress level 0, every payload is larger than 100kb
+    transport = Transport(client=elasticapm_client, compress_level=0, queue_chill_count=10)
+    event = {"message": "x" * 200}
+    payload_buffers = []
+
+    def send(data):
+        assert len(data) > 100 * 1024
+        # the bytearray that backs the payload
+        payload_buffers.append(data.obj)
+
+    transport.send = send
+    transport.start_thread()
+    try:
+        for _ in range(5):
+            for i in range(500):
+                transport.queue("error", event)
+            transport.flush()
+    finally:
+        transport.close()
+    assert len(payload_buffers) == 5
+    # every payload has been written to the same pooled buffer
+    assert all(buffer is payload_buffers[0] for buffer in payload_buffers)
+    assert len(transport._buffer_pool._free) == 1
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_size": "512kb"}], indirect=True)
+def test_flush_allocations_are_bounded(elasticapm_client):
+    transport = Transport(client=elasticapm_client, compress_level=0, queue_chill_count=10)
+    event = {"message": "x" * 200}
+    allocated = []
+
+    def send(data):
+        # memory allocated in the transport module since the previous flush that is still alive
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, base.__file__)])
+        allocated.append(sum(stat.size for stat in snapshot.statistics("filename")))
+        tracemalloc.clear_traces()
+
+    transport.send = send
+    transport.start_thread()
+    tracemalloc.start()
+    try:
+        for _ in range(6):
+            for i in range(500):
+                transport.queue("error", event)
+            transport.flush()
+    finally:
+        tracemalloc.stop()
+        transport.close()
+    assert len(allocated) == 6
+    # the first flush allocates the pooled buffer. Later flushes reuse it, so what is left is the batch
+    # of events that is being processed and some bookkeeping, which is well below the size of the buffer.
+    # The bound is generous, as the exact amount depends on the Python version and on thread timing.
+    buffer_size = elasticapm_client.config.api_request_size
+    assert allocated[0] > buffer_size
+    assert max(allocated[1:]) < buffer_size / 4
+
+
+@mock.patch("elasticapm.transport.base.Transport.send")
+def test_payload_after_dropped_flush_is_valid(mock_send, elasticapm_client):
+    transport = Transport(client=elasticapm_client)
+    transport.start_thread()
+    try:
+        for _ in range(3):
+            transport.state.set_fail()
+        transport.queue("error", {"id": 1})
+        transport.flush()
+        assert mock_send.call_count == 0
+        transport.state.set_success()
+        transport.queue("error", {"id": 2})
+        transport.flush()
+    finally:
+        transport.close()
+    assert mock_send.call_count == 1
+    payload = gzip.decompress(bytes(mock_send.call_args[0][0]))
+    assert json.loads(payload.splitlines()[1])["error"] == {"id": 2}
@@ -0,0 +1,196 @@
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import gzip
+import json
+import os
+
+import mock
+import pytest
+
+from elasticapm.transport.base import Transport, is_retryable
+from elasticapm.transport.exceptions import TransportException
+from elasticapm.transport.spill import SpillQueue, adopt_orphaned_segments
+
+
+def read_all(spill_queue):
+    payloads = []
+    while True:
+        entry = spill_queue.peek()
+        if entry is None:
+            return payloads
+        token, payload = entry
+        payloads.append(payload)
+        spill_queue.commit(token)
+
+
+def test_payloads_are_read_in_order(tmpdir):
+    spill_queue = SpillQueue(str(tmpdir), max_size=1000, segment_size=20)
+    for i in range(5):
+        spill_queue.append(b"payload %d" % i)
+    # every segment holds one payload
+    assert len(tmpdir.listdir()) == 5
+    assert read_all(spill_queue) == [b"payload %d" % i for i in range(5)]
+    # replayed segments are deleted
+    assert tmpdir.listdir() == []
+    assert spill_queue.size == 0
+
+
+def test_payload_is_read_again_if_not_committed(tmpdir):
+    spill_queue = SpillQueue(str(tmpdir), max_size=1000)
+    spill_queue.append(b"foo")
+    spill_queue.append(b"bar")
+    assert spill_queue.peek()[1] == b"foo"
+    assert spill_queue.peek()[1] == b"foo"
+    spill_queue.commit(spill_queue.peek()[0])
+    assert spill_queue.peek()[1] == b"bar"
+
+
+def test_oldest_segments_are_evicted(tmpdir):
+    # every record takes 13 bytes
+    spill_queue = SpillQueue(str(tmpdir), max_size=30, segment_size=20)
+    for i in range(5):
+        spill_queue.append(b"payload %d" % i)
+    assert spill_queue.size == 26
+    assert read_all(spill_queue) == [b"payload 3", b"payload 4"]
+
+
+def test_existing_segments_are_read(tmpdir):
+    spill_queue = SpillQueue(str(tmpdir), max_size=1000, segment_size=20)
+    spill_queue.append(b"foo")
+    spill_queue.append(b"bar")
+    spill_queue.close()
+    assert read_all(SpillQueue(str(tmpdir), max_size=1000)) == [b"foo", b"bar"]
+
+
+def test_truncated_segment_is_skipped(tmpdir):
+    spill_queue = SpillQueue(str(tmpdir), max_size=1000, segment_size=20)
+    spill_queue.append(b"foo")
+    spill_queue.append(b"bar")
+    spill_queue.close()
+    segment = sorted(tmpdir.listdir())[-1]
+    segment.write_binary(segment.read_binary()[:-1])
+    assert read_all(SpillQueue(str(tmpdir), max_size=1000)) == [b"foo"]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="not supported on Windows")
+def test_adopt_orphaned_segments(tmpdir):
+    with mock.patch("elasticapm.transport.spill._is_running", side_effect=lambda pid: pid == 2):
+        SpillQueue(str(tmpdir.join("1")), max_size=1000).append(b"dead")
+        SpillQueue(str(tmpdir.join("2")), max_size=1000).append(b"alive")
+        adopt_orphaned_segments(str(tmpdir), str(tmpdir.join("3")))
+    assert not tmpdir.join("1").exists()
+    assert read_all(SpillQueue(str(tmpdir.join("3")), max_size=1000)) == [b"dead"]
+    assert read_all(SpillQueue(str(tmpdir.join("2")), max_size=1000)) == [b"alive"]
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_spill_dir": "SPILL_DIR"}], indirect=True)
+def test_transport_spills_and_replays(elasticapm_client, tmpdir):
+    elasticapm_client.config.update("1", api_request_spill_dir=str(tmpdir))
+    transport = Transport(client=elasticapm_client)
+    transport.spill_replay_interval = 0.01
+    with mock.patch.object(Transport, "send", side_effect=ValueError("server down")) as mock_send:
+        transport.start_thread()
+        try:
+            transport.queue("error", {"id": 1}, flush=True)
+            transport._flushed.wait(5)
+            # the transport is backing off after the second failure, so the third payload is spilled without sending it
+            transport.queue("error", {"id": 2}, flush=True)
+            transport._flushed.wait(5)
+            transport.queue("error", {"id": 3}, flush=True)
+            transport._flushed.wait(5)
+            assert mock_send.call_count == 2
+            assert transport._spill_queue.size > 0
+            mock_send.side_effect = None
+            transport.state.set_success()
+            for _ in range(500):
+                if transport._spill_queue.peek() is None:
+                    break
+                transport._spill_stop.wait(0.01)
+        finally:
+            transport.close()
+    assert transport._spill_queue.peek() is None
+    assert mock_send.call_count == 5
+    sent = [json.loads(gzip.decompress(call[0][0]).splitlines()[1])["error"]["id"] for call in mock_send.call_args_list]
+    assert sent == [1, 2, 1, 2, 3]
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_spill_dir": "SPILL_DIR"}], indirect=True)
+def test_rejected_payloads_are_not_spilled(elasticapm_client, tmpdir):
+    elasticapm_client.config.update("1", api_request_spill_dir=str(tmpdir))
+    transport = Transport(client=elasticapm_client)
+    with mock.patch.object(Transport, "send", side_effect=TransportException("HTTP 400", status=400)) as mock_send:
+        transport.start_thread()
+        try:
+            transport.queue("error", {"id": 1}, flush=True)
+            transport._flushed.wait(5)
+        finally:
+            transport.close()
+    assert mock_send.call_count == 1
+    assert transport._spill_queue.peek() is None
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_spill_dir": "SPILL_DIR"}], indirect=True)
+def test_rejected_spilled_payloads_are_skipped(elasticapm_client, tmpdir):
+    elasticapm_client.config.update("1", api_request_spill_dir=str(tmpdir))
+    transport = Transport(client=elasticapm_client)
+    transport.spill_replay_interval = 0.01
+    with mock.patch.object(Transport, "send") as mock_send:
+        transport.start_thread()
+        try:
+            transport._spill_queue.append(b"too large")
+            transport._spill_queue.append(b"ok")
+            mock_send.side_effect = [TransportException("HTTP 413", status=413), None]
+            for _ in range(500):
+                if transport._spill_queue.peek() is None:
+                    break
+                transport._spill_stop.wait(0.01)
+        finally:
+            transport.close()
+    assert transport._spill_queue.peek() is None
+    assert [call[0][0] for call in mock_send.call_args_list] == [b"too large", b"ok"]
+    # a rejected payload doesn't put the transport into back-off
+    assert not transport.state.did_fail()
+
+
+@pytest.mark.parametrize(
+    "exception,retryable",
+    [
+        (ValueError("connection refused"), True),
+        (TransportException("Unable to reach APM Server"), True),
+        (TransportException("HTTP 503", status=503), True),
+        (TransportException("Temporarily rate limited", status=429), True),
+        (TransportException("HTTP 400", status=400), False),
+        (TransportException("HTTP 401", status=401), False),
+        (TransportException("HTTP 413", status=413), False),
+    ],
+)
+def test_is_retryable(exception, retryable):
+    assert is_retryable(exception) is retryable
@@ -417,3 +417,48 @@ def test_fetch_server_info_no_version(waiting_httpserver, caplog, elasticapm_cli
         transport.fetch_server_info()
     assert elasticapm_client.server_version is None
     assert_any_record_contains(caplog.records, "No version key found in server response")
+
+
+@pytest.mark.parametrize("validating_httpserver", [{"skip_validate": True}], indirect=True)
+@pytest.mark.parametrize(
+    "elasticapm_client", [{"api_request_streaming": True, "server_version": (8, 0, 0)}], indirect=True
+)
+def test_streaming_request(validating_httpserver, elasticapm_client):
+    validating_httpserver.serve_content(code=202, content="")
+    transport = Transport(
+        validating_httpserver.url,
+        client=elasticapm_client,
+        headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"},
+    )
+    transport.start_thread()
+    try:
+        transport.queue("error", {"id": "foo"})
+        transport.queue("error", {"id": "bar"})
+        transport.flush()
+    finally:
+        transport.close()
+    assert len(validating_httpserver.requests) == 1
+    assert validating_httpserver.requests[0].headers["Transfer-Encoding"] == "chunked"
+    payload = validating_httpserver.payloads[0]
+    assert "metadata" in payload[0]
+    assert payload[1:] == [{"error": {"id": "foo"}}, {"error": {"id": "bar"}}]
+    assert not transport.state.did_fail()
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_streaming": True}], indirect=True)
+def test_streaming_request_error(waiting_httpserver, elasticapm_client):
+    waiting_httpserver.serve_content(code=418, content="I'm a teapot")
+    transport = Transport(waiting_httpserver.url, client=elasticapm_client)
+    transport.start_thread()
+    try:
+        transport.queue("error", {"id": "foo"})
+        transport.flush()
+        assert transport.state.did_fail()
+    finally:
+        transport.close()
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"api_request_senders": 4}], indirect=True)
+def test_connection_pool_size_matches_senders(elasticapm_client):
+    transport = Transport("http://localhost:9999", client=elasticapm_client)
+    assert transport.http.connection_pool_kw["maxsize"] == 4
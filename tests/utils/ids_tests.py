@@ -0,0 +1,85 @@
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import os
+import re
+import sys
+import threading
+
+import pytest
+
+from elasticapm.utils import ids
+
+
+def test_hex_ids():
+    ids_64 = [ids.hex_id_64() for _ in range(1000)]
+    ids_128 = [ids.hex_id_128() for _ in range(1000)]
+    assert all(re.match("^[0-9a-f]{16}$", i) for i in ids_64)
+    assert all(re.match("^[0-9a-f]{32}$", i) for i in ids_128)
+    assert len(set(ids_64)) == 1000
+    assert len(set(ids_128)) == 1000
+
+
+def test_no_duplicate_ids_across_threads():
+    results = []
+
+    def generate():
+        results.extend(ids.hex_id_64() for _ in range(5 * ids.BATCH_SIZE))
+
+    switch_interval = sys.getswitchinterval()
+    # switch threads as often as possible, to provoke concurrent starts of new batches
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=generate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert len(set(results)) == 20 * ids.BATCH_SIZE
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_forked_child_doesnt_reuse_ids():
+    # make sure that there are ids left in the current batches
+    ids.hex_id_64()
+    ids.hex_id_128()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, (ids.hex_id_64() + ids.hex_id_128()).encode("ascii"))
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as reader:
+        child_ids = reader.read().decode("ascii")
+    os.waitpid(pid, 0)
+    assert len(child_ids) == 48
+    assert child_ids != ids.hex_id_64() + ids.hex_id_128()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+#  BSD 3-Clause License
+#
+#  Copyright (c) 2019, Elasticsearch BV
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import datetime
+
+import pytest
+
+from elasticapm.utils import json_encoder
+
+pytest.importorskip("pytest_benchmark")
+
+TRANSACTION = {
+    "transaction": {
+        "id": "a" * 16,
+        "trace_id": "b" * 32,
+        "name": "GET /users/{id}",
+        "type": "request",
+        "duration": 12.345,
+        "timestamp": 1500000000000000,
+        "result": "HTTP 2xx",
+        "outcome": "success",
+        "sampled": True,
+        "sample_rate": 1.0,
+        "span_count": {"started": 10, "dropped": 0},
+        "context": {
+            "request": {
+                "method": "GET",
+                "url": {"full": "http://example.com/users/1?x=y", "pathname": "/users/1", "search": "?x=y"},
+                "headers": {"accept": "*/*", "user-agent": "curl/7.64.1", "host": "example.com"},
+                "socket": {"remote_address": "127.0.0.1"},
+            },
+            "response": {"status_code": 200, "headers": {"content-type": "application/json"}},
+            "tags": {"tenant": "foo", "shard": 3},
+            "custom": {"created": datetime.datetime(2020, 1, 1), "roles": {"admin"}},
+        },
+    }
+}
+
+
+def test_dumps_standard_library(benchmark):
+    benchmark(lambda: json_encoder.dumps(TRANSACTION).encode("utf-8"))
+
+
+def test_dumps_bytes(benchmark):
+    # uses orjson if it is installed
+    benchmark(json_encoder.dumps_bytes, TRANSACTION)
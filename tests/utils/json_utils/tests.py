@@ -36,6 +36,8 @@ import datetime
 import decimal
 import uuid
 
+import pytest
+
 from elasticapm.utils import compat
 from elasticapm.utils import json_encoder as json
 
@@ -71,3 +73,45 @@ def test_bytes():
 def test_decimal():
     res = decimal.Decimal("1.0")
     assert json.dumps(res) == "1.0"
+
+
+def test_dumps_bytes():
+    res = {
+        "set": {"foo"},
+        "decimal": decimal.Decimal("1.5"),
+        "datetime": datetime.datetime(day=1, month=1, year=2011, hour=1, minute=1, second=1),
+        "bytes": b"foobar",
+        1: "non-string key",
+        "big": 2 ** 70,
+    }
+    result = json.dumps_bytes(res)
+    assert isinstance(result, bytes)
+    assert json.loads(result.decode("utf-8")) == {
+        "set": ["foo"],
+        "decimal": 1.5,
+        "datetime": "2011-01-01T01:01:01.000000Z",
+        "bytes": "foobar",
+        "1": "non-string key",
+        "big": 2 ** 70,
+    }
+
+
+def test_dumps_bytes_not_serializable():
+    with pytest.raises(TypeError):
+        json.dumps_bytes({"foo": object()})
+
+
+@pytest.mark.skipif(json.orjson is None, reason="orjson not installed")
+def test_dumps_bytes_same_output_as_standard_library():
+    res = {
+        "set": {"foo"},
+        "datetime": datetime.datetime(day=1, month=1, year=2011, hour=1, minute=1, second=1),
+        "looks_like_uuid": "12345678-1234-5678-1234-567812345678",
+    }
+    assert json.loads(json.dumps_bytes(res).decode("utf-8")) == json.loads(json.dumps(res))
+
+
+@pytest.mark.skipif(json.orjson is None, reason="orjson not installed")
+def test_dumps_bytes_uuid_with_orjson():
+    res = {"uuid": uuid.UUID("12345678-1234-5678-1234-567812345678")}
+    assert json.dumps_bytes(res) == b'{"uuid":"12345678-1234-5678-1234-567812345678"}'